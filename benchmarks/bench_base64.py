@@ -0,0 +1,91 @@
+"""
+Compare the peak memory of encoding output images in base64.
+
+Writes a few 4K PNGs filled with noise (so they barely compress, like detailed
+photos) and runs `process_output_images` over them with the old encoder, that
+read the whole file and encoded it at once, and with the chunked
+`base64_encode` (COMFY_BASE64_MAX_BYTES is raised, so that they are returned
+at all). Reports the tracemalloc peak, as a multiple of the total size
+of the images, and the time.
+
+Usage:
+    python -m benchmarks.bench_base64 [--images 4] [--width 3840] [--height 2160]
+"""
+
+import argparse
+import base64
+import json
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+from unittest.mock import patch
+
+from PIL import Image
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "src")))
+from src import rp_handler
+
+
+def legacy_base64_encode(img_path):
+    with open(img_path, "rb") as image_file:
+        return base64.b64encode(image_file.read()).decode("utf-8")
+
+
+def run(name, encoder, folder, outputs, total_bytes):
+    with patch.object(rp_handler, "base64_encode", encoder), patch.object(
+        rp_handler, "COMFY_BASE64_MAX_BYTES", total_bytes
+    ):
+        tracemalloc.start()
+        started = time.perf_counter()
+        result = rp_handler.process_output_images(outputs, "bench", folder)
+        elapsed = time.perf_counter() - started
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+    assert result["status"] == "success", result
+    return {
+        "encoder": name,
+        "images": len(result["images"]),
+        "image_mib": round(total_bytes / 2**20, 1),
+        "peak_mib": round(peak / 2**20, 1),
+        "peak_x_images": round(peak / total_bytes, 2),
+        "seconds": round(elapsed, 3),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--images", type=int, default=4)
+    parser.add_argument("--width", type=int, default=3840)
+    parser.add_argument("--height", type=int, default=2160)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as folder:
+        filenames = [f"ComfyUI_{i:05}_.png" for i in range(args.images)]
+        for filename in filenames:
+            noise = os.urandom(args.width * args.height * 3)
+            image = Image.frombytes("RGB", (args.width, args.height), noise)
+            image.save(os.path.join(folder, filename), compress_level=1)
+        outputs = {
+            "9": {
+                "images": [
+                    {"filename": filename, "subfolder": "", "type": "output"}
+                    for filename in filenames
+                ]
+            }
+        }
+        total_bytes = sum(
+            os.path.getsize(os.path.join(folder, filename)) for filename in filenames
+        )
+
+        for name, encoder in (
+            ("read_all", legacy_base64_encode),
+            ("chunked", rp_handler.base64_encode),
+        ):
+            print(json.dumps(run(name, encoder, folder, outputs, total_bytes)))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,101 @@
+"""
+Measure the per-request overhead of talking to ComfyUI.
+
+Sends the same `GET /history/{id}` and `POST /prompt` requests to the fake
+ComfyUI with a fresh connection per request (`urllib.request.urlopen` and bare
+`requests`, like the handler used to do) and with the pooled keep-alive
+`ComfyUIClient`. The clients take turns for several rounds and the fastest round of
+each one is reported, so a busy machine affects all of them alike.
+
+Usage:
+    python -m benchmarks.bench_client [--requests 500] [--rounds 5]
+"""
+
+import argparse
+import json
+import os
+import sys
+import time
+import urllib.request
+
+import requests
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "src")))
+from src import rp_handler
+from tests.fake_comfyui import FakeComfyUI
+
+
+def measure(name, fake, count, get, post):
+    connections_before = fake.connections
+    started = time.perf_counter()
+    for i in range(count):
+        if i % 10 == 0:
+            post()
+        else:
+            get()
+    elapsed = time.perf_counter() - started
+    return {
+        "client": name,
+        "requests": count,
+        "us_per_request": round(elapsed / count * 1e6, 1),
+        "connections": fake.connections - connections_before,
+    }
+
+
+def fastest(results):
+    """The round of every client with the lowest time per request"""
+    best = {}
+    for result in results:
+        current = best.get(result["client"])
+        if current is None or result["us_per_request"] < current["us_per_request"]:
+            best[result["client"]] = result
+    return list(best.values())
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--requests", type=int, default=500)
+    parser.add_argument("--rounds", type=int, default=5)
+    args = parser.parse_args()
+
+    # Nothing gets executed, only the HTTP layer is measured
+    workflow = json.dumps({"prompt": {}}).encode()
+
+    with FakeComfyUI(execution_time=0) as fake:
+        base = f"http://{fake.host}"
+
+        def urlopen_get():
+            with urllib.request.urlopen(f"{base}/history/123") as response:
+                json.loads(response.read())
+
+        def urlopen_post():
+            request = urllib.request.Request(f"{base}/prompt", data=workflow)
+            json.loads(urllib.request.urlopen(request).read())
+
+        client = rp_handler.ComfyUIClient(fake.host)
+        results = []
+        for _ in range(args.rounds):
+            results += [
+                measure("urlopen", fake, args.requests, urlopen_get, urlopen_post),
+                measure(
+                    "requests",
+                    fake,
+                    args.requests,
+                    lambda: requests.get(f"{base}/history/123").json(),
+                    lambda: requests.post(f"{base}/prompt", data=workflow).json(),
+                ),
+                measure(
+                    "ComfyUIClient",
+                    fake,
+                    args.requests,
+                    lambda: client.get_history("123"),
+                    lambda: client.queue_prompt({}),
+                ),
+            ]
+
+    for result in fastest(results):
+        print(json.dumps(result))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,67 @@
+"""
+Compare how fast the handler notices that ComfyUI finished a prompt.
+
+Runs the same workflow through `rp_handler.handler` against the fake ComfyUI
+once with websocket events and once with history polling, and reports the
+completion-detection latency (handler returned - prompt finished).
+
+Usage:
+    python -m benchmarks.bench_completion [--jobs 20] [--execution-time 0.5]
+"""
+
+import argparse
+import json
+import os
+import statistics
+import sys
+import time
+from unittest.mock import patch
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "src")))
+from src import rp_handler
+from tests.fake_comfyui import FakeComfyUI
+
+TEST_INPUT = os.path.join(os.path.dirname(__file__), "..", "test_input.json")
+
+
+def run(mode, jobs, execution_time):
+    with open(TEST_INPUT) as f:
+        job_input = json.load(f)["input"]
+
+    latencies = []
+    with FakeComfyUI(execution_time=execution_time) as fake, patch.object(
+        rp_handler, "comfy", rp_handler.ComfyUIClient(fake.host)
+    ), patch.object(rp_handler, "COMFY_COMPLETION_MODE", mode), patch.dict(
+        os.environ, {"COMFY_OUTPUT_PATH": fake.output_dir}
+    ):
+        for i in range(jobs):
+            result = rp_handler.handler({"id": f"bench-{i}", "input": job_input})
+            returned_at = time.monotonic()
+            assert result.get("status") == "success", result
+            prompt_id = max(fake.completed_at, key=fake.completed_at.get)
+            latencies.append((returned_at - fake.completed_at[prompt_id]) * 1000)
+        history_calls = fake.count("/history")
+        queue_calls = fake.count("/queue")
+
+    return {
+        "mode": mode,
+        "jobs": jobs,
+        "p50_ms": round(statistics.median(latencies), 2),
+        "max_ms": round(max(latencies), 2),
+        "history_calls_per_job": round(history_calls / jobs, 1),
+        "queue_calls_per_job": round(queue_calls / jobs, 1),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--jobs", type=int, default=20)
+    parser.add_argument("--execution-time", type=float, default=0.5)
+    args = parser.parse_args()
+
+    for mode in ("polling", "websocket"):
+        print(json.dumps(run(mode, args.jobs, args.execution_time)))
+
+
+if __name__ == "__main__":
+    main()
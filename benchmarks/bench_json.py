@@ -0,0 +1,98 @@
+"""
+Compare the JSON work of a job with the json module and with orjson.
+
+For every workflow in test_resources/workflows/ (and test_input.json) times
+parsing the job input, serializing the /prompt payload and the key of the
+result cache, and decoding a /queue response with --pending prompts of that
+workflow in it, like every poll does. Also reports the time of a poll when
+the prompt is not in the response, which is no longer decoded at all.
+Without orjson installed only the json module is measured.
+
+Usage:
+    python -m benchmarks.bench_json [--repeat 2000] [--pending 8]
+"""
+
+import argparse
+import glob
+import json
+import os
+import statistics
+import sys
+import time
+import uuid
+from unittest.mock import patch
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "src")))
+from src import rp_handler
+
+ROOT = os.path.join(os.path.dirname(__file__), "..")
+WORKFLOWS = sorted(
+    glob.glob(os.path.join(ROOT, "test_resources", "workflows", "*.json"))
+)
+WORKFLOWS.append(os.path.join(ROOT, "test_input.json"))
+
+
+def microseconds(function, repeat):
+    timings = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        function()
+        timings.append((time.perf_counter() - started) * 1e6)
+    return round(statistics.median(timings), 2)
+
+
+def run(path, library, repeat, pending):
+    with open(path, "rb") as f:
+        request = f.read()
+    workflow = json.loads(request)["input"]["workflow"]
+    prompt_ids = [str(uuid.uuid4()) for _ in range(pending + 1)]
+    queue = json.dumps(
+        {
+            "queue_running": [[0, prompt_ids[0], workflow, {}, ["9"]]],
+            "queue_pending": [
+                [number, prompt_id, workflow, {}, ["9"]]
+                for number, prompt_id in enumerate(prompt_ids[1:], start=1)
+            ],
+        }
+    ).encode()
+    payload = {"prompt": workflow, "client_id": prompt_ids[0]}
+
+    def poll(prompt_id):
+        if prompt_id.encode("utf-8") in queue:
+            rp_handler.json_loads(queue)
+
+    orjson = rp_handler.orjson if library == "orjson" else None
+    with patch.object(rp_handler, "orjson", orjson):
+        return {
+            "workflow": os.path.basename(path),
+            "json": library,
+            "request_bytes": len(request),
+            "parse_input_us": microseconds(
+                lambda: rp_handler.json_loads(request), repeat
+            ),
+            "dump_prompt_us": microseconds(
+                lambda: rp_handler.json_dumps(payload), repeat
+            ),
+            "cache_key_us": microseconds(
+                lambda: rp_handler.result_cache_key(workflow, None), repeat
+            ),
+            "queue_bytes": len(queue),
+            "poll_queued_us": microseconds(lambda: poll(prompt_ids[-1]), repeat),
+            "poll_other_us": microseconds(lambda: poll("another-prompt"), repeat),
+        }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--repeat", type=int, default=2000)
+    parser.add_argument("--pending", type=int, default=8)
+    args = parser.parse_args()
+
+    libraries = ["json"] + (["orjson"] if rp_handler.orjson else [])
+    for path in WORKFLOWS:
+        for library in libraries:
+            print(json.dumps(run(path, library, args.repeat, args.pending)))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,263 @@
+"""
+Load-test the handler against the fake ComfyUI at a target rate.
+
+Replays the workflows in test_resources/workflows/ and test_input.json one
+after the other, starting a job every 1/--rate seconds (open loop: the latency
+of a job counts from the moment it was due, so a handler that falls behind
+shows up in the percentiles) with up to --concurrency jobs running at the same
+time, like the RunPod SDK does with concurrency_modifier. The fake ComfyUI runs
+in its own process, so the CPU time and the RSS that are reported are the ones
+of the handler only.
+
+Reports the p50/p95/p99 latency, the jobs/s, the CPU and the RSS and saves them
+as JSON to --output. With --baseline, the change of every metric compared to
+an earlier run is printed as well.
+
+Usage:
+    python -m benchmarks.bench_load [--rate 5] [--duration 20] [--execution-time 0.1]
+        [--concurrency 1] [--image-size 512] [--output bench_load.json] [--baseline old.json]
+"""
+
+import argparse
+import glob
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from unittest.mock import patch
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "src")))
+from src import rp_handler
+from tests.fake_comfyui import FakeComfyUI
+
+ROOT = os.path.join(os.path.dirname(__file__), "..")
+WORKFLOWS = sorted(
+    glob.glob(os.path.join(ROOT, "test_resources", "workflows", "*.json"))
+)
+WORKFLOWS.append(os.path.join(ROOT, "test_input.json"))
+
+# Metrics that get worse when they grow, for the comparison with --baseline
+LOWER_IS_BETTER = (
+    "errors",
+    "seconds",
+    "latency_ms",
+    "cpu_s",
+    "cpu_percent",
+    "rss_mib",
+    "p50_ms_per_workflow",
+)
+
+
+def serve_fake_comfyui(connection, options):
+    """
+    Runs the fake ComfyUI in a child process until the parent sends anything.
+    """
+    with FakeComfyUI(**options) as fake:
+        connection.send(fake.host)
+        connection.recv()
+
+
+def load_inputs():
+    inputs = []
+    for path in WORKFLOWS:
+        with open(path) as f:
+            inputs.append((os.path.basename(path), json.load(f)["input"]))
+    return inputs
+
+
+def percentile(values, p):
+    """
+    Nearest-rank percentile of the values.
+    """
+    ordered = sorted(values)
+    index = max(int(round(p / 100 * len(ordered) + 0.5)) - 1, 0)
+    return ordered[min(index, len(ordered) - 1)]
+
+
+def rss_mib():
+    with open("/proc/self/statm") as f:
+        return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 2**20
+
+
+class RSSSampler(threading.Thread):
+    """
+    Samples the resident memory of this process every `interval` seconds.
+    """
+
+    def __init__(self, interval=0.05):
+        super().__init__(daemon=True)
+        self.interval = interval
+        self.samples = []
+        self._stopped = threading.Event()
+
+    def run(self):
+        while not self._stopped.is_set():
+            self.samples.append(rss_mib())
+            self._stopped.wait(self.interval)
+
+    def stop(self):
+        self._stopped.set()
+        self.join()
+
+
+def run(args):
+    inputs = load_inputs()
+    jobs = max(int(args.rate * args.duration), 1)
+    output_dir = tempfile.mkdtemp()
+    parent, child = multiprocessing.Pipe()
+    fake = multiprocessing.Process(
+        target=serve_fake_comfyui,
+        args=(
+            child,
+            {
+                "execution_time": args.execution_time,
+                "output_dir": output_dir,
+                "image_size": (args.image_size, args.image_size),
+            },
+        ),
+        daemon=True,
+    )
+    fake.start()
+    host = parent.recv()
+
+    latencies = []
+    per_workflow = {}
+    errors = []
+    lock = threading.Lock()
+
+    def run_one(index, due):
+        name, job_input = inputs[index % len(inputs)]
+        result = rp_handler.handler({"id": f"load-{index}", "input": job_input})
+        latency = (time.monotonic() - due) * 1000
+        with lock:
+            if result.get("status") == "success":
+                latencies.append(latency)
+                per_workflow.setdefault(name, []).append(latency)
+            else:
+                errors.append(result.get("error") or result.get("message"))
+
+    try:
+        with patch.object(
+            rp_handler, "comfy", rp_handler.ComfyUIClient(host)
+        ), patch.object(
+            rp_handler, "readiness", rp_handler.ComfyUIReadiness()
+        ), patch.dict(
+            os.environ, {"COMFY_OUTPUT_PATH": output_dir}
+        ):
+            sampler = RSSSampler()
+            sampler.start()
+            usage = resource.getrusage(resource.RUSAGE_SELF)
+            started = time.monotonic()
+            with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+                for index in range(jobs):
+                    due = started + index / args.rate
+                    time.sleep(max(due - time.monotonic(), 0))
+                    executor.submit(run_one, index, due)
+            elapsed = time.monotonic() - started
+            end_usage = resource.getrusage(resource.RUSAGE_SELF)
+            sampler.stop()
+    finally:
+        parent.send("stop")
+        fake.join(timeout=5)
+
+    if not latencies:
+        sys.exit(f"Every job failed, the first error was: {errors[0]}")
+
+    cpu = (end_usage.ru_utime - usage.ru_utime) + (end_usage.ru_stime - usage.ru_stime)
+    result = {
+        "config": {
+            "rate": args.rate,
+            "duration": args.duration,
+            "jobs": jobs,
+            "execution_time": args.execution_time,
+            "concurrency": args.concurrency,
+            "image_size": args.image_size,
+            "workflows": [name for name, _ in inputs],
+            "python": platform.python_version(),
+        },
+        "results": {
+            "jobs": len(latencies),
+            "errors": len(errors),
+            "seconds": round(elapsed, 3),
+            "jobs_per_s": round(len(latencies) / elapsed, 2),
+            "latency_ms": {
+                "p50": round(percentile(latencies, 50), 2),
+                "p95": round(percentile(latencies, 95), 2),
+                "p99": round(percentile(latencies, 99), 2),
+                "max": round(max(latencies), 2),
+            },
+            "cpu_s": round(cpu, 3),
+            "cpu_percent": round(cpu / elapsed * 100, 1),
+            "rss_mib": {
+                "peak": round(max(sampler.samples), 1),
+                "mean": round(sum(sampler.samples) / len(sampler.samples), 1),
+            },
+            "p50_ms_per_workflow": {
+                name: round(percentile(values, 50), 2)
+                for name, values in sorted(per_workflow.items())
+            },
+        },
+    }
+    if errors:
+        result["results"]["first_error"] = errors[0]
+    return result
+
+
+def compare(results, baseline, prefix=""):
+    """
+    Yields (metric, baseline, current, change in percent, worse) for every number.
+    """
+    for key, value in results.items():
+        name = f"{prefix}{key}"
+        if isinstance(value, dict):
+            yield from compare(value, baseline.get(key, {}), f"{name}.")
+        elif isinstance(value, (int, float)) and isinstance(
+            baseline.get(key), (int, float)
+        ):
+            old = baseline[key]
+            change = (value - old) / old * 100 if old else 0.0
+            worse = change > 0 if name.startswith(LOWER_IS_BETTER) else change < 0
+            yield name, old, value, round(change, 1), worse
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--rate", type=float, default=5)
+    parser.add_argument("--duration", type=float, default=20)
+    parser.add_argument("--execution-time", type=float, default=0.1)
+    parser.add_argument("--concurrency", type=int, default=1)
+    parser.add_argument("--image-size", type=int, default=512)
+    parser.add_argument("--output", default="bench_load.json")
+    parser.add_argument("--baseline")
+    args = parser.parse_args()
+
+    result = run(args)
+    with open(args.output, "w") as f:
+        json.dump(result, f, indent=2)
+    print(json.dumps(result["results"]))
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)["results"]
+        for name, old, new, change, worse in compare(result["results"], baseline):
+            print(
+                json.dumps(
+                    {
+                        "metric": name,
+                        "baseline": old,
+                        "current": new,
+                        "change_percent": change,
+                        "worse": worse,
+                    }
+                )
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,75 @@
+"""
+Compare the time of getting input images into the input folder of ComfyUI.
+
+Runs `upload_images` with a few base64 encoded images once with the multipart
+upload through /upload/image of the fake ComfyUI ("http") and once with the
+images written straight into its input folder ("local"). The input image cache
+is disabled, so every round transfers every image. Reports the milliseconds
+per image (median of the rounds, decoding included) and the throughput.
+
+Usage:
+    python -m benchmarks.bench_staging [--images 4] [--size-kib 2048] [--rounds 10]
+"""
+
+import argparse
+import base64
+import json
+import os
+import statistics
+import sys
+import time
+from unittest.mock import patch
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "src")))
+from src import rp_handler
+from tests.fake_comfyui import FakeComfyUI
+
+
+def run(mode, fake, images, rounds):
+    staging = rp_handler.InputStaging(mode, fake.input_dir)
+    with patch.object(rp_handler, "input_staging", staging):
+        timings = []
+        for _ in range(rounds):
+            started = time.perf_counter()
+            result = rp_handler.upload_images(images)
+            timings.append((time.perf_counter() - started) * 1000 / len(images))
+            assert result["status"] == "success", result
+
+    ms_per_image = statistics.median(timings)
+    size = len(base64.b64decode(images[0]["image"]))
+    return {
+        "mode": mode,
+        "images": len(images),
+        "image_kib": size // 1024,
+        "ms_per_image": round(ms_per_image, 2),
+        "mib_per_s": round(size / 2**20 / (ms_per_image / 1000), 1),
+        "uploads": fake.count("/upload/image"),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--images", type=int, default=4)
+    parser.add_argument("--size-kib", type=int, default=2048)
+    parser.add_argument("--rounds", type=int, default=10)
+    args = parser.parse_args()
+
+    images = [
+        {
+            "name": f"input_{i}.png",
+            "image": base64.b64encode(os.urandom(args.size_kib * 1024)).decode(),
+        }
+        for i in range(args.images)
+    ]
+    with FakeComfyUI() as fake, patch.object(
+        rp_handler, "comfy", rp_handler.ComfyUIClient(fake.host)
+    ), patch.object(
+        rp_handler, "input_image_cache", rp_handler.InputImageCache(max_bytes=0)
+    ):
+        for mode in ("http", "local"):
+            fake.request_counts.clear()
+            print(json.dumps(run(mode, fake, images, args.rounds)))
+
+
+if __name__ == "__main__":
+    main()
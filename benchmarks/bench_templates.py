@@ -0,0 +1,105 @@
+"""
+Compare jobs that send their whole workflow with jobs that name a template.
+
+Uses every workflow in test_resources/workflows/ as a template and changes its
+prompt and seed, once sent as {"workflow": ...} with the new values in it and
+once as {"template": ..., "overrides": ...}. Reports the size of the request,
+the microseconds to parse and validate the input (json.loads and
+validate_input) and to check the workflow against the node definitions in
+test_resources/object_info.json, all of it and only the changed nodes.
+
+Usage:
+    python -m benchmarks.bench_templates [--repeat 2000]
+"""
+
+import argparse
+import json
+import os
+import statistics
+import sys
+import time
+from unittest.mock import patch
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "src")))
+from src import rp_handler
+
+ROOT = os.path.join(os.path.dirname(__file__), "..")
+WORKFLOWS = os.path.join(ROOT, "test_resources", "workflows")
+
+
+def changed_values(workflow):
+    """The overrides of a typical job: a new prompt and a new seed"""
+    overrides = {}
+    for node_id, node in workflow.items():
+        for name in node.get("inputs", {}):
+            if name == "text" and not overrides.get("text"):
+                overrides["text"] = (f"{node_id}.inputs.text", "a red fox in the snow")
+            if name in ("seed", "noise_seed") and not overrides.get("seed"):
+                overrides["seed"] = (f"{node_id}.inputs.{name}", 42)
+    return dict(overrides.values())
+
+
+def microseconds(function, repeat):
+    timings = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        function()
+        timings.append((time.perf_counter() - started) * 1e6)
+    return round(statistics.median(timings), 1)
+
+
+def run(path, object_info, repeat):
+    name = os.path.splitext(os.path.basename(path))[0]
+    with open(path) as f:
+        workflow = json.load(f)["input"]["workflow"]
+    template = rp_handler.WorkflowTemplate(name, workflow)
+    templates = rp_handler.WorkflowTemplates(WORKFLOWS)
+    templates.templates = {name: template}
+
+    overrides = changed_values(workflow)
+    variant, error_message = template.apply(overrides)
+    assert error_message is None, error_message
+    full = json.dumps({"input": {"workflow": variant}})
+    compact = json.dumps({"input": {"template": name, "overrides": overrides}})
+    changed = [
+        node_id for node_id in variant if variant[node_id] is not workflow[node_id]
+    ]
+
+    def parse(payload):
+        job_input, error_message = rp_handler.validate_input(
+            json.loads(payload)["input"]
+        )
+        assert error_message is None, error_message
+
+    with patch.object(rp_handler, "workflow_templates", templates):
+        return {
+            "workflow": name,
+            "overrides": len(overrides),
+            "workflow_bytes": len(full),
+            "template_bytes": len(compact),
+            "workflow_parse_us": microseconds(lambda: parse(full), repeat),
+            "template_parse_us": microseconds(lambda: parse(compact), repeat),
+            "workflow_check_us": microseconds(
+                lambda: rp_handler.check_workflow(variant, object_info), repeat
+            ),
+            "template_check_us": microseconds(
+                lambda: rp_handler.check_workflow(variant, object_info, changed), repeat
+            ),
+        }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--repeat", type=int, default=2000)
+    args = parser.parse_args()
+
+    with open(os.path.join(ROOT, "test_resources", "object_info.json")) as f:
+        object_info = json.load(f)
+    for filename in sorted(os.listdir(WORKFLOWS)):
+        print(
+            json.dumps(run(os.path.join(WORKFLOWS, filename), object_info, args.repeat))
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,126 @@
+"""
+Measure the job throughput of the worker, one job at a time vs. concurrent jobs.
+
+Runs a number of jobs (each with a reference image to upload) against the fake
+ComfyUI, which executes one prompt after the other in a fixed time and takes
+some time per `/upload/image` request. "sequential" calls `handler` for one job
+after the other, like the worker with COMFY_CONCURRENCY=1. "pipelined" runs
+`async_handler` with at most --concurrency jobs in flight, like the RunPod SDK
+does with `concurrency_modifier`.
+
+Usage:
+    python -m benchmarks.bench_throughput [--jobs 20] [--execution-time 0.5] [--upload-latency 0.1] [--concurrency 3]
+"""
+
+import argparse
+import asyncio
+import base64
+import json
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from unittest.mock import patch
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "src")))
+from src import rp_handler
+from tests.fake_comfyui import FakeComfyUI, png_bytes
+
+WORKFLOW_PATH = os.path.join(os.path.dirname(__file__), "..", "test_input.json")
+
+
+def make_jobs(count):
+    with open(WORKFLOW_PATH) as f:
+        workflow = json.load(f)["input"]["workflow"]
+    return [
+        {
+            "id": f"job-{i}",
+            "input": {
+                "workflow": workflow,
+                "images": [
+                    {
+                        "name": f"reference_{i}.png",
+                        "image": base64.b64encode(
+                            png_bytes(512, 512, (i % 256, 0, 0))
+                        ).decode(),
+                    }
+                ],
+            },
+        }
+        for i in range(count)
+    ]
+
+
+def run_sequential(jobs):
+    return [rp_handler.handler(job) for job in jobs]
+
+
+def run_pipelined(jobs, concurrency):
+    async def run_all():
+        slots = asyncio.Semaphore(concurrency)
+
+        async def run_one(job):
+            async with slots:
+                return await rp_handler.async_handler(job)
+
+        return await asyncio.gather(*(run_one(job) for job in jobs))
+
+    with patch.object(
+        rp_handler, "job_executor", ThreadPoolExecutor(max_workers=concurrency)
+    ):
+        return asyncio.run(run_all())
+
+
+def run(mode, jobs, execution_time, upload_latency, concurrency):
+    with FakeComfyUI(
+        execution_time=execution_time, upload_time=upload_latency
+    ) as fake, patch.object(
+        rp_handler, "comfy", rp_handler.ComfyUIClient(fake.host)
+    ), patch.object(
+        rp_handler, "input_image_cache", rp_handler.InputImageCache()
+    ), patch.dict(
+        os.environ, {"COMFY_OUTPUT_PATH": fake.output_dir}
+    ):
+        started = time.perf_counter()
+        if mode == "sequential":
+            results = run_sequential(jobs)
+        else:
+            results = run_pipelined(jobs, concurrency)
+        elapsed = time.perf_counter() - started
+
+    assert all(result.get("status") == "success" for result in results), results
+    return {
+        "mode": mode,
+        "concurrency": 1 if mode == "sequential" else concurrency,
+        "jobs": len(jobs),
+        "seconds": round(elapsed, 3),
+        "jobs_per_minute": round(len(jobs) / elapsed * 60, 1),
+        "gpu_busy": round(len(jobs) * execution_time / elapsed, 3),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--jobs", type=int, default=20)
+    parser.add_argument("--execution-time", type=float, default=0.5)
+    parser.add_argument("--upload-latency", type=float, default=0.1)
+    parser.add_argument("--concurrency", type=int, default=3)
+    args = parser.parse_args()
+
+    jobs = make_jobs(args.jobs)
+    for mode in ("sequential", "pipelined"):
+        print(
+            json.dumps(
+                run(
+                    mode,
+                    jobs,
+                    args.execution_time,
+                    args.upload_latency,
+                    args.concurrency,
+                )
+            )
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,92 @@
+"""
+Compare the response size and the time of transcoding the output images.
+
+Runs `process_output_images` over the images in test_resources/images (or any
+other folder) once without output options, like before, and once for every
+format / quality / max_dimension combination, and reports the bytes on disk,
+the bytes of the returned images, the length of the base64 payload and the
+milliseconds per image.
+
+Usage:
+    python -m benchmarks.bench_transcode [--images test_resources/images] [--repeat 3]
+"""
+
+import argparse
+import json
+import os
+import statistics
+import sys
+import time
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "src")))
+from src import rp_handler
+
+IMAGES = os.path.join(os.path.dirname(__file__), "..", "test_resources", "images")
+
+OPTIONS = [
+    None,
+    {"format": "png"},
+    {"format": "webp", "quality": 90},
+    {"format": "webp", "quality": 80},
+    {"format": "jpeg", "quality": 90},
+    {"format": "jpeg", "quality": 80},
+    {"format": "avif", "quality": 60},
+    {"format": "webp", "quality": 80, "max_dimension": 256},
+]
+
+
+def run(folder, options, repeat):
+    filenames = sorted(
+        name
+        for name in os.listdir(folder)
+        if os.path.splitext(name)[1].lower() in (".png", ".jpg", ".jpeg", ".webp")
+    )
+    outputs = {
+        "9": {
+            "images": [
+                {"filename": name, "subfolder": "", "type": "output"}
+                for name in filenames
+            ]
+        }
+    }
+
+    timings = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        result = rp_handler.process_output_images(outputs, "bench", folder, options)
+        timings.append((time.perf_counter() - started) * 1000 / len(filenames))
+
+    assert result["status"] == "success", result
+    images = result["images"]
+    return {
+        "options": options,
+        "images": len(images),
+        "original_bytes": sum(
+            os.path.getsize(os.path.join(folder, name)) for name in filenames
+        ),
+        "bytes": sum(
+            image.get("bytes", os.path.getsize(os.path.join(folder, name)))
+            for image, name in zip(images, filenames)
+        ),
+        "base64_bytes": sum(len(image["data"]) for image in images),
+        "ms_per_image": round(statistics.median(timings), 2),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--images", default=IMAGES)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    for options in OPTIONS:
+        if options:
+            options, error_message = rp_handler.validate_output_options(options)
+            if error_message:
+                print(json.dumps({"skipped": error_message}))
+                continue
+        print(json.dumps(run(args.images, options, args.repeat)))
+
+
+if __name__ == "__main__":
+    main()
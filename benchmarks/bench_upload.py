@@ -0,0 +1,61 @@
+"""
+Measure how long `upload_images` takes for a job with many reference images.
+
+Uploads the same set of base64 encoded images to the fake ComfyUI (which
+simulates some latency per `/upload/image` request) with a single upload worker
+(the old sequential behaviour) and with COMFY_UPLOAD_WORKERS workers.
+
+Usage:
+    python -m benchmarks.bench_upload [--images 12] [--size-kb 2048] [--latency 0.05]
+"""
+
+import argparse
+import base64
+import json
+import os
+import sys
+import time
+from unittest.mock import patch
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "src")))
+from src import rp_handler
+from tests.fake_comfyui import FakeComfyUI
+
+
+def run(images, workers, latency):
+    with FakeComfyUI(upload_time=latency) as fake, patch.object(
+        rp_handler, "comfy", rp_handler.ComfyUIClient(fake.host)
+    ), patch.object(rp_handler, "COMFY_UPLOAD_WORKERS", workers):
+        started = time.perf_counter()
+        result = rp_handler.upload_images(images)
+        elapsed = time.perf_counter() - started
+
+    assert result["status"] == "success", result
+    return {
+        "workers": workers,
+        "images": len(images),
+        "seconds": round(elapsed, 3),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--images", type=int, default=12)
+    parser.add_argument("--size-kb", type=int, default=2048)
+    parser.add_argument("--latency", type=float, default=0.05)
+    args = parser.parse_args()
+
+    images = [
+        {
+            "name": f"reference_{i}.png",
+            "image": base64.b64encode(os.urandom(args.size_kb * 1024)).decode(),
+        }
+        for i in range(args.images)
+    ]
+
+    for workers in sorted({1, rp_handler.COMFY_UPLOAD_WORKERS}):
+        print(json.dumps(run(images, workers, args.latency)))
+
+
+if __name__ == "__main__":
+    main()
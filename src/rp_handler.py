@@ -1,27 +1,594 @@
 import runpod
+import asyncio
 from runpod.serverless.utils import rp_upload
+from boto3.s3.transfer import TransferConfig
 import json
-import urllib.request
 import urllib.parse
 import time
 import os
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import NewConnectionError
 import base64
+import copy
+import binascii
+import uuid
+import tempfile
+import shutil
+import hashlib
+import itertools
+import mimetypes
+import threading
+import sys
+from collections import OrderedDict, deque
+from contextlib import closing, contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from concurrent.futures import ThreadPoolExecutor
 from io import BytesIO
 
+try:
+    import websocket
+except ImportError:  # websocket-client is optional, fall back to polling
+    websocket = None
+
+try:
+    from PIL import Image
+except ImportError:  # Pillow is optional, only needed to transcode output images
+    Image = None
+
+try:
+    import orjson
+except ImportError:  # orjson is optional, the json module is used without it
+    orjson = None
+
 # Time to wait between API check attempts in milliseconds
 COMFY_API_AVAILABLE_INTERVAL_MS = 50
-# Maximum number of API check attempts
-COMFY_API_AVAILABLE_MAX_RETRIES = 500
+# Upper limit of the exponential backoff between API check attempts in milliseconds
+COMFY_API_AVAILABLE_MAX_INTERVAL_MS = 2000
+# Seconds that jobs wait for ComfyUI to come up after the worker started
+COMFY_STARTUP_TIMEOUT_S = float(os.environ.get("COMFY_STARTUP_TIMEOUT_S", 300))
+# Consecutive failed connections after which ComfyUI is considered down
+COMFY_LIVENESS_FAILURES = int(os.environ.get("COMFY_LIVENESS_FAILURES", 3))
+# Comma separated JSON files (in the format of test_input.json, or a list of such inputs)
+# with workflows that run before the worker takes jobs, so that the models are loaded
+COMFY_WARMUP_WORKFLOWS = os.environ.get("COMFY_WARMUP_WORKFLOWS", "/warmup_input.json")
+# Seconds every warmup workflow may take
+COMFY_WARMUP_TIMEOUT_S = float(os.environ.get("COMFY_WARMUP_TIMEOUT_S", 600))
 # Time to wait between poll attempts in milliseconds
 COMFY_POLLING_INTERVAL_MS = int(os.environ.get("COMFY_POLLING_INTERVAL_MS", 250))
 # Maximum number of poll attempts
 COMFY_POLLING_MAX_RETRIES = int(os.environ.get("COMFY_POLLING_MAX_RETRIES", 500))
+# Seconds a job may take unless its input sets "timeout", by default the time that
+# COMFY_POLLING_MAX_RETRIES polls used to take
+COMFY_JOB_TIMEOUT_S = float(
+    os.environ.get(
+        "COMFY_JOB_TIMEOUT_S",
+        COMFY_POLLING_MAX_RETRIES * COMFY_POLLING_INTERVAL_MS / 1000,
+    )
+)
+# Time to wait before the first poll in milliseconds, grows by half after every poll
+COMFY_POLLING_MIN_INTERVAL_MS = int(os.environ.get("COMFY_POLLING_MIN_INTERVAL_MS", 25))
+# Upper limit of the time between polls in milliseconds
+COMFY_POLLING_MAX_INTERVAL_MS = int(
+    os.environ.get("COMFY_POLLING_MAX_INTERVAL_MS", 1000)
+)
 # Host where ComfyUI is running
-COMFY_HOST = "127.0.0.1:8188"
+COMFY_HOST = os.environ.get("COMFY_HOST", "127.0.0.1:8188")
+# Timeouts in seconds for connecting to ComfyUI and for waiting on its responses
+COMFY_CONNECT_TIMEOUT_S = float(os.environ.get("COMFY_CONNECT_TIMEOUT_S", 3))
+COMFY_READ_TIMEOUT_S = float(os.environ.get("COMFY_READ_TIMEOUT_S", 30))
+# Number of retries for failed requests to ComfyUI
+COMFY_HTTP_RETRIES = int(os.environ.get("COMFY_HTTP_RETRIES", 3))
+# Initial backoff between retries in seconds, doubled on every retry
+COMFY_HTTP_BACKOFF_S = float(os.environ.get("COMFY_HTTP_BACKOFF_S", 0.1))
+# Maximum number of keep-alive connections to ComfyUI
+COMFY_HTTP_POOL_SIZE = int(os.environ.get("COMFY_HTTP_POOL_SIZE", 16))
+# Maximum number of input images that are uploaded to ComfyUI at the same time
+COMFY_UPLOAD_WORKERS = int(os.environ.get("COMFY_UPLOAD_WORKERS", 4))
+# Size of the chunks in which input images are base64 decoded (a multiple of 4)
+BASE64_DECODE_CHUNK_SIZE = 1024 * 1024
+# The folder where ComfyUI reads the input images from
+COMFY_INPUT_PATH = os.environ.get("COMFY_INPUT_PATH", "/comfyui/input")
+# How input images get into the input folder: "local" writes them into COMFY_INPUT_PATH,
+# "http" uploads them through /upload/image, "auto" writes them if ComfyUI reads that folder
+COMFY_INPUT_STAGING = os.environ.get("COMFY_INPUT_STAGING", "auto").lower()
+# Folder inside the input folder where images are written before they are renamed into place
+INPUT_STAGING_FOLDER = ".staging"
+# Total size in bytes of the uploaded images that are remembered, so that identical
+# images are not uploaded again (0 disables the cache)
+COMFY_INPUT_CACHE_MAX_BYTES = int(
+    os.environ.get("COMFY_INPUT_CACHE_MAX_BYTES", 1024 * 1024 * 1024)
+)
+# Folder inside the input folder with the remembered images, one subfolder per content hash
+INPUT_CACHE_FOLDER = "cached"
+# Folder of the cache of the input images that jobs reference by "url"
+COMFY_DOWNLOAD_CACHE_PATH = os.environ.get(
+    "COMFY_DOWNLOAD_CACHE_PATH",
+    os.path.join(tempfile.gettempdir(), "runpod-worker-comfy", "downloads"),
+)
+# Maximum total size of the downloaded input images in bytes, the least recently used
+# are evicted (0 disables the cache)
+COMFY_DOWNLOAD_CACHE_MAX_BYTES = int(
+    os.environ.get("COMFY_DOWNLOAD_CACHE_MAX_BYTES", 2 * 1024 * 1024 * 1024)
+)
+# URL schemes that input images can be downloaded from
+INPUT_URL_SCHEMES = ("http", "https", "s3")
+# Size of the chunks in which input images are downloaded
+DOWNLOAD_CHUNK_BYTES = 1024 * 1024
+# Maximum number of output images that are encoded or uploaded to S3 at the same time
+COMFY_OUTPUT_WORKERS = int(os.environ.get("COMFY_OUTPUT_WORKERS", 8))
+# Largest output file in bytes that is returned as base64, bigger files need an AWS S3 bucket
+COMFY_BASE64_MAX_BYTES = int(os.environ.get("COMFY_BASE64_MAX_BYTES", 10 * 1024 * 1024))
+# Size in bytes of the parts of multipart uploads to AWS S3, smaller files are uploaded at once
+COMFY_S3_PART_SIZE_BYTES = int(
+    os.environ.get("COMFY_S3_PART_SIZE_BYTES", 16 * 1024 * 1024)
+)
+# Maximum number of parts of one file that are uploaded to AWS S3 at the same time
+COMFY_S3_UPLOAD_CONCURRENCY = int(os.environ.get("COMFY_S3_UPLOAD_CONCURRENCY", 4))
+# Return the outputs of an identical earlier job (same workflow and input images) from disk
+COMFY_RESULT_CACHE = os.environ.get("COMFY_RESULT_CACHE", "false").lower() == "true"
+# Folder of the result cache
+COMFY_RESULT_CACHE_PATH = os.environ.get(
+    "COMFY_RESULT_CACHE_PATH",
+    os.path.join(tempfile.gettempdir(), "runpod-worker-comfy", "results"),
+)
+# Maximum total size of the cached outputs in bytes, the least recently used are evicted
+COMFY_RESULT_CACHE_MAX_BYTES = int(
+    os.environ.get("COMFY_RESULT_CACHE_MAX_BYTES", 2 * 1024 * 1024 * 1024)
+)
+# Seconds after which cached outputs are not used anymore
+COMFY_RESULT_CACHE_TTL_S = float(os.environ.get("COMFY_RESULT_CACHE_TTL_S", 24 * 3600))
+# How the handler detects that a prompt is done: "websocket" or "polling"
+COMFY_COMPLETION_MODE = os.environ.get("COMFY_COMPLETION_MODE", "websocket").lower()
+# Seconds to wait for a single websocket message before double-checking the history
+COMFY_WEBSOCKET_RECV_TIMEOUT_S = float(
+    os.environ.get("COMFY_WEBSOCKET_RECV_TIMEOUT_S", 10)
+)
+# Stream progress and images while the job is running, see generator_handler
+COMFY_STREAM_OUTPUT = os.environ.get("COMFY_STREAM_OUTPUT", "false").lower() == "true"
+# Number of jobs the worker runs at the same time. With more than one, the next job
+# uploads its images and queues its prompt while ComfyUI is still busy with the current one
+COMFY_CONCURRENCY = int(os.environ.get("COMFY_CONCURRENCY", 1))
+# Check workflows against the node definitions of ComfyUI before queuing them
+COMFY_VALIDATE_WORKFLOW = (
+    os.environ.get("COMFY_VALIDATE_WORKFLOW", "true").lower() == "true"
+)
+# Folder where the node definitions of ComfyUI (/object_info) are cached
+COMFY_OBJECT_INFO_CACHE_PATH = os.environ.get(
+    "COMFY_OBJECT_INFO_CACHE_PATH",
+    os.path.join(tempfile.gettempdir(), "runpod-worker-comfy"),
+)
+# The custom nodes of ComfyUI, the cached node definitions are only used for the same custom nodes
+COMFY_CUSTOM_NODES_PATH = os.environ.get(
+    "COMFY_CUSTOM_NODES_PATH", "/comfyui/custom_nodes"
+)
+# Minimum seconds between two refreshes of the node definitions because a workflow didn't match them
+OBJECT_INFO_REFRESH_INTERVAL_S = 60
+# Bytes that are base64 encoded at once, a multiple of 3 so that chunks need no padding
+BASE64_CHUNK_BYTES = 3 * 256 * 1024
 # Enforce a clean state after each job is done
 # see https://docs.runpod.io/docs/handler-additional-controls#refresh-worker
 REFRESH_WORKER = os.environ.get("REFRESH_WORKER", "false").lower() == "true"
+# Release memory between jobs through /free of ComfyUI instead of refreshing the worker:
+# unload the models once a GPU has less than this many MiB of free VRAM after a job (0 disables it)
+COMFY_FREE_VRAM_BELOW_MB = int(os.environ.get("COMFY_FREE_VRAM_BELOW_MB", 0))
+# Free the cached node outputs once more than this percentage of the RAM is used (0 disables it)
+COMFY_FREE_RAM_ABOVE_PERCENT = float(os.environ.get("COMFY_FREE_RAM_ABOVE_PERCENT", 0))
+# Models used by at least this many of the last HOT_MODELS_WINDOW jobs stay loaded (0 disables it)
+COMFY_HOT_MODEL_JOBS = int(os.environ.get("COMFY_HOT_MODEL_JOBS", 3))
+# Number of recent jobs whose models are counted
+HOT_MODELS_WINDOW = 10
+# Extensions of the files that the loader nodes take, to find the models of a workflow
+MODEL_EXTENSIONS = (".safetensors", ".ckpt", ".pt", ".pth", ".bin", ".gguf", ".sft")
+# Seconds ComfyUI gets to release the memory before the freed memory is logged
+FREE_MEMORY_SETTLE_S = 2
+
+# When the worker started, the cold start timings are measured from here
+WORKER_STARTED = time.monotonic()
+
+# Maximum number of variants (overrides or workflows) of a batch job
+COMFY_BATCH_MAX_VARIANTS = int(os.environ.get("COMFY_BATCH_MAX_VARIANTS", 64))
+
+# Folder with the workflow templates (<name>.json) that jobs can refer to by name
+COMFY_TEMPLATES_PATH = os.environ.get("COMFY_TEMPLATES_PATH", "/templates")
+
+# Keys of the node outputs that list files: images and the animations and videos of
+# nodes like "VHS_VideoCombine"
+OUTPUT_KINDS = ("images", "gifs", "videos")
+
+# Add the seconds every stage of the job took to the result as "timings"
+COMFY_TIMINGS = os.environ.get("COMFY_TIMINGS", "false").lower() == "true"
+# File that the stage histograms are written to in the Prometheus text format after every job
+COMFY_METRICS_FILE = os.environ.get("COMFY_METRICS_FILE", "")
+# Port that serves the stage histograms on /metrics when running with --rp_serve_api (0 disables it)
+COMFY_METRICS_PORT = int(os.environ.get("COMFY_METRICS_PORT", 8001))
+# Upper bounds in seconds of the buckets of the stage histograms
+METRICS_BUCKETS_S = (0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+
+# Formats that output images can be transcoded to, mapped to their Pillow format
+OUTPUT_FORMATS = {"png": "PNG", "webp": "WEBP", "jpeg": "JPEG", "avif": "AVIF"}
+
+
+def json_dumps(value, sort_keys=False):
+    """
+    Serializes a value to compact JSON, with orjson if it is installed
+
+    Returns:
+        bytes: The JSON in UTF-8
+    """
+    if orjson is not None:
+        option = orjson.OPT_NON_STR_KEYS
+        if sort_keys:
+            option |= orjson.OPT_SORT_KEYS
+        try:
+            return orjson.dumps(value, option=option)
+        except TypeError:
+            pass  # e.g. integers beyond 64 bits, which the json module can write
+    return json.dumps(
+        value, sort_keys=sort_keys, separators=(",", ":"), ensure_ascii=False
+    ).encode("utf-8")
+
+
+def json_loads(data):
+    """
+    Parses JSON from bytes or a string, with orjson if it is installed
+
+    Raises:
+        json.JSONDecodeError: If the data is not JSON
+    """
+    if orjson is not None:
+        try:
+            return orjson.loads(data)
+        except orjson.JSONDecodeError:
+            pass  # e.g. NaN, which ComfyUI can send and the json module reads
+    return json.loads(data)
+
+
+def response_json(response):
+    """The parsed JSON body of a response of ComfyUI"""
+    return json_loads(response.content)
+
+
+def describe_node_errors(node_errors):
+    """
+    Args:
+        node_errors (list): {"node_id", "class_type", "message", "details"} of every problem
+
+    Returns:
+        str: One line that lists every problem
+    """
+    return "; ".join(
+        f"node {e['node_id']} ({e['class_type']}): {e['message']}"
+        + (f": {e['details']}" if e.get("details") else "")
+        for e in node_errors
+    )
+
+
+class ComfyUIPromptError(Exception):
+    """
+    ComfyUI rejected a workflow, details has the errors of every node that failed the validation.
+    """
+
+    def __init__(self, message, details):
+        super().__init__(message)
+        self.details = details
+
+    @classmethod
+    def from_response(cls, body):
+        """
+        Args:
+            body (dict): The JSON body of the rejected /prompt request
+
+        Returns:
+            ComfyUIPromptError: With a message that lists every failed node
+        """
+        error = body.get("error") or {}
+        if not isinstance(error, dict):
+            error = {"message": str(error)}
+        node_errors = []
+        for node_id, node_error in (body.get("node_errors") or {}).items():
+            for item in node_error.get("errors", []):
+                node_errors.append(
+                    {
+                        "node_id": node_id,
+                        "class_type": node_error.get("class_type"),
+                        "type": item.get("type"),
+                        "message": item.get("message"),
+                        "details": item.get("details"),
+                    }
+                )
+
+        message = error.get("message") or "ComfyUI rejected the workflow"
+        if node_errors:
+            message = f"{message}: {describe_node_errors(node_errors)}"
+        elif error.get("details"):
+            message = f"{message}: {error['details']}"
+
+        details = {
+            "type": error.get("type", "invalid_prompt"),
+            "message": error.get("message"),
+            "node_errors": node_errors,
+        }
+        return cls(message, details)
+
+
+class ComfyUISession(requests.Session):
+    """
+    A requests.Session that sends requests straight to the transport adapter.
+
+    requests.Session.request merges the environment, cookies, auth and hooks into every
+    request and checks for redirects, which costs more than the request itself when
+    ComfyUI runs on the same machine. ComfyUI needs none of that, so requests are
+    prepared with the headers of the session only. Redirects are not followed, the API
+    of ComfyUI doesn't send any. Requests with other options go through
+    requests.Session.request.
+    """
+
+    def request(
+        self,
+        method,
+        url,
+        params=None,
+        data=None,
+        headers=None,
+        json=None,
+        timeout=None,
+        stream=False,
+        allow_redirects=True,
+        **kwargs,
+    ):
+        if kwargs:
+            return super().request(
+                method,
+                url,
+                params=params,
+                data=data,
+                headers=headers,
+                json=json,
+                timeout=timeout,
+                stream=stream,
+                allow_redirects=allow_redirects,
+                **kwargs,
+            )
+        prepared = requests.PreparedRequest()
+        prepared.prepare(
+            method=method,
+            url=url,
+            headers={**self.headers, **headers} if headers else self.headers,
+            data=data,
+            params=params,
+            json=json,
+        )
+        response = self.get_adapter(url).send(prepared, timeout=timeout, stream=stream)
+        if not stream:
+            # Read the body, which gives the connection back to the pool
+            response.content
+        return response
+
+
+class ComfyUIClient:
+    """
+    Client for the ComfyUI API that is shared by every job of the worker.
+
+    All requests go through one ComfyUISession with a pool of keep-alive connections,
+    so a job doesn't pay for a new TCP handshake on every call. Every request has a
+    connect and read timeout, so a hung ComfyUI can't block the worker forever.
+    Failed requests are retried with exponential backoff. Requests that may already
+    have reached ComfyUI are only retried when they are idempotent (GET).
+    consecutive_failures counts the requests in a row that couldn't connect at all and is
+    reset by every response, see ComfyUIReadiness.
+
+    Args:
+        host (str): "host:port" where ComfyUI is listening
+        connect_timeout (float): Seconds to wait for a connection
+        read_timeout (float): Seconds to wait for a response
+        retries (int): How often a failed request is retried
+        backoff (float): Seconds to wait before the first retry, doubled on every retry
+        pool_size (int): Maximum number of pooled connections
+    """
+
+    RETRY_STATUS_CODES = (502, 503, 504)
+
+    def __init__(
+        self,
+        host=COMFY_HOST,
+        connect_timeout=COMFY_CONNECT_TIMEOUT_S,
+        read_timeout=COMFY_READ_TIMEOUT_S,
+        retries=COMFY_HTTP_RETRIES,
+        backoff=COMFY_HTTP_BACKOFF_S,
+        pool_size=COMFY_HTTP_POOL_SIZE,
+    ):
+        self.host = host
+        self.timeout = (connect_timeout, read_timeout)
+        self.retries = retries
+        self.backoff = backoff
+        self.consecutive_failures = 0
+
+        self.session = ComfyUISession()
+        # ComfyUI runs next to the worker, skip the proxy and .netrc lookups
+        self.session.trust_env = False
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+    @property
+    def base_url(self):
+        return f"http://{self.host}"
+
+    def ws_url(self, client_id):
+        """The websocket URL that receives the events of prompts queued with client_id"""
+        return f"ws://{self.host}/ws?clientId={client_id}"
+
+    def request(self, method, path, retries=None, **kwargs):
+        """
+        Send a request to ComfyUI, retrying failed attempts with exponential backoff
+
+        Args:
+            method (str): The HTTP method
+            path (str): The path of the endpoint, e.g. "/prompt"
+            retries (int, optional): Overrides the number of retries of the client
+
+        Returns:
+            requests.Response: The response of the last attempt
+
+        Raises:
+            requests.RequestException: If the last attempt failed
+        """
+        retries = self.retries if retries is None else retries
+        kwargs.setdefault("timeout", self.timeout)
+        idempotent = method.upper() in ("GET", "HEAD")
+
+        for attempt in range(retries + 1):
+            if attempt and hasattr(kwargs.get("data"), "seek"):
+                # Streamed uploads have to be sent from the start again
+                kwargs["data"].seek(0)
+            try:
+                response = self.session.request(method, self.base_url + path, **kwargs)
+                self.consecutive_failures = 0
+                if (
+                    not idempotent
+                    or response.status_code not in self.RETRY_STATUS_CODES
+                    or attempt >= retries
+                ):
+                    return response
+            except (requests.ConnectionError, requests.Timeout) as e:
+                if attempt >= retries or not (idempotent or _is_connect_error(e)):
+                    if isinstance(e, requests.ConnectionError):
+                        self.consecutive_failures += 1
+                    raise
+            time.sleep(self.backoff * 2**attempt)
+
+    def get(self, path, **kwargs):
+        return self.request("GET", path, **kwargs)
+
+    def post(self, path, **kwargs):
+        return self.request("POST", path, **kwargs)
+
+    def queue_prompt(self, workflow, client_id=None):
+        """
+        Send the workflow to /prompt and return the JSON response
+
+        Raises:
+            ComfyUIPromptError: If ComfyUI rejected the workflow
+        """
+        # The top level element "prompt" is required by ComfyUI
+        payload = {"prompt": workflow}
+        if client_id:
+            payload["client_id"] = client_id
+        response = self.post("/prompt", data=json_dumps(payload))
+        if response.status_code == 400:
+            try:
+                body = response_json(response)
+            except ValueError:
+                body = None
+            if isinstance(body, dict):
+                raise ComfyUIPromptError.from_response(body)
+        response.raise_for_status()
+        return response_json(response)
+
+    def get_history(self, prompt_id):
+        """Return the history of the prompt, which is empty while the prompt is not done"""
+        response = self.get(f"/history/{prompt_id}")
+        response.raise_for_status()
+        # Most polls happen while the prompt runs, there is nothing to parse then
+        if prompt_id.encode("utf-8") not in response.content:
+            return {}
+        return response_json(response)
+
+    def upload_image(
+        self, name, file, content_type="image/png", overwrite=True, subfolder=""
+    ):
+        """Stream an image file object into (a subfolder of) the input folder of ComfyUI"""
+        fields = {"overwrite": "true" if overwrite else "false"}
+        if subfolder:
+            fields["subfolder"] = subfolder
+        body = MultipartFileBody(
+            fields,
+            "image",
+            name,
+            file,
+            content_type,
+        )
+        return self.post(
+            "/upload/image", data=body, headers={"Content-Type": body.content_type}
+        )
+
+
+class MultipartFileBody:
+    """
+    A multipart/form-data request body that streams the file from its current location
+    instead of loading it into memory, like requests does for `files=`.
+
+    Args:
+        fields (dict): Plain form fields that are sent before the file
+        field_name (str): The form field of the file
+        filename (str): The name of the file
+        file (file object): A seekable file object with the content
+        content_type (str): The content type of the file
+    """
+
+    def __init__(self, fields, field_name, filename, file, content_type):
+        boundary = uuid.uuid4().hex
+        self.content_type = f"multipart/form-data; boundary={boundary}"
+
+        head = "".join(
+            f'--{boundary}\r\nContent-Disposition: form-data; name="{key}"\r\n\r\n'
+            f"{value}\r\n"
+            for key, value in fields.items()
+        )
+        head += (
+            f'--{boundary}\r\nContent-Disposition: form-data; name="{field_name}"; '
+            f'filename="{filename}"\r\nContent-Type: {content_type}\r\n\r\n'
+        )
+        tail = f"\r\n--{boundary}--\r\n"
+
+        file.seek(0, os.SEEK_END)
+        file_size = file.tell()
+        self._parts = [BytesIO(head.encode("utf-8")), file, BytesIO(tail.encode())]
+        self._length = len(head.encode("utf-8")) + file_size + len(tail)
+        self.seek(0)
+
+    def __len__(self):
+        return self._length
+
+    def __iter__(self):
+        while True:
+            chunk = self.read(64 * 1024)
+            if not chunk:
+                return
+            yield chunk
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        # Only rewinding is needed to retry a request
+        for part in self._parts:
+            part.seek(0)
+        self._current = 0
+
+    def read(self, size=-1):
+        chunks = []
+        while self._current < len(self._parts) and size != 0:
+            chunk = self._parts[self._current].read(size)
+            if not chunk:
+                self._current += 1
+                continue
+            chunks.append(chunk)
+            if size > 0:
+                size -= len(chunk)
+        return b"".join(chunks)
+
+
+def _is_connect_error(error):
+    """
+    True if the request failed before it reached ComfyUI, so it is safe to send it again
+    """
+    if isinstance(error, requests.exceptions.ConnectTimeout):
+        return True
+    reason = getattr(error.args[0], "reason", None) if error.args else None
+    return isinstance(reason, NewConnectionError)
+
+
+# The client that is used by all the helpers below
+comfy = ComfyUIClient()
 
 
 def validate_input(job_input):
@@ -42,12 +609,30 @@ def validate_input(job_input):
     # Check if input is a string and try to parse it as JSON
     if isinstance(job_input, str):
         try:
-            job_input = json.loads(job_input)
+            job_input = json_loads(job_input)
         except json.JSONDecodeError:
             return None, "Invalid JSON format in input"
 
-    # Validate 'workflow' in input
-    workflow = job_input.get("workflow")
+    # Validate 'workflow' in input, or the 'template' it is based on
+    template, error_message = validate_template(job_input)
+    if error_message:
+        return None, error_message
+    workflow = template.workflow if template else job_input.get("workflow")
+
+    # Apply an object of 'overrides', a list of them (or 'workflows') is a batch
+    variants = None
+    overrides = job_input.get("overrides")
+    if isinstance(overrides, dict) and isinstance(workflow, dict):
+        if template:
+            workflow, error_message = template.apply(overrides)
+        else:
+            workflow, error_message = apply_overrides(workflow, overrides)
+    else:
+        variants, error_message = validate_batch(job_input, template)
+    if error_message:
+        return None, error_message
+    if variants:
+        workflow = variants[0]
     if workflow is None:
         return None, "Missing 'workflow' parameter"
 
@@ -55,33 +640,255 @@ def validate_input(job_input):
     images = job_input.get("images")
     if images is not None:
         if not isinstance(images, list) or not all(
-            "name" in image and "image" in image for image in images
+            isinstance(image, dict)
+            and "name" in image
+            and ("image" in image or "url" in image)
+            for image in images
         ):
             return (
                 None,
-                "'images' must be a list of objects with 'name' and 'image' keys",
+                "'images' must be a list of objects with 'name' and 'image' or 'url' keys",
             )
+        for image in images:
+            if "image" not in image and (
+                not isinstance(image["url"], str)
+                or urllib.parse.urlparse(image["url"]).scheme not in INPUT_URL_SCHEMES
+            ):
+                return (
+                    None,
+                    f"The 'url' of image '{image['name']}' must start with "
+                    + ", ".join(f"{scheme}://" for scheme in INPUT_URL_SCHEMES),
+                )
+
+    validated_data = {"workflow": workflow, "images": images}
+    if variants:
+        validated_data["variants"] = variants
+    if template:
+        validated_data["template"] = template
+
+    # Validate 'timeout' in input, if provided
+    if "timeout" in job_input:
+        timeout = job_input["timeout"]
+        if (
+            isinstance(timeout, bool)
+            or not isinstance(timeout, (int, float))
+            or timeout <= 0
+        ):
+            return None, "'timeout' must be a positive number of seconds"
+        validated_data["timeout"] = timeout
+
+    # Validate 'output' in input, if provided
+    if "output" in job_input:
+        options, error_message = validate_output_options(job_input["output"])
+        if error_message:
+            return None, error_message
+        if options:
+            validated_data["output"] = options
 
     # Return validated data and no error
-    return {"workflow": workflow, "images": images}, None
+    return validated_data, None
+
+
+def validate_template(job_input):
+    """
+    Looks up the 'template' that the workflow of the job is based on.
+
+    Args:
+        job_input (dict): The input of the job
+
+    Returns:
+        tuple: (template, error_message) where template is the WorkflowTemplate, or
+               None if the job sends its workflow.
+    """
+    name = job_input.get("template")
+    if name is None:
+        return None, None
+    if "workflow" in job_input or "workflows" in job_input:
+        return None, "Use either 'template' or 'workflow', not both"
+    if not isinstance(name, str):
+        return None, "'template' must be the name of a template"
+
+    template = workflow_templates.get(name)
+    if template is None:
+        names = ", ".join(workflow_templates.load())
+        if not names:
+            return None, f"Unknown template '{name}', there are no templates"
+        return None, f"Unknown template '{name}', available: {names}"
+    return template, None
+
+
+def validate_batch(job_input, template=None):
+    """
+    Validates the variants of a batch job: either a base 'workflow' (or 'template')
+    with a list of 'overrides', or a list of 'workflows'.
+
+    Args:
+        job_input (dict): The input of the job
+        template (WorkflowTemplate, optional): The template of the job
+
+    Returns:
+        tuple: (variants, error_message) where variants is the list of workflows to
+               queue, or None if the job is not a batch.
+    """
+    overrides = job_input.get("overrides")
+    workflows = job_input.get("workflows")
+    if overrides is None and workflows is None:
+        return None, None
+    if overrides is not None and workflows is not None:
+        return None, "Use either 'overrides' or 'workflows', not both"
+
+    if workflows is not None:
+        if "workflow" in job_input:
+            return None, "Use either 'workflow' or 'workflows', not both"
+        if not isinstance(workflows, list) or not all(
+            isinstance(workflow, dict) for workflow in workflows
+        ):
+            return None, "'workflows' must be a list of workflows"
+        variants = workflows
+    else:
+        workflow = template.workflow if template else job_input.get("workflow")
+        if not isinstance(workflow, dict):
+            return None, "'overrides' need a 'workflow' or 'template' to apply them to"
+        if not isinstance(overrides, list) or not all(
+            isinstance(override, dict) for override in overrides
+        ):
+            return None, "'overrides' must be an object or a list of objects"
+        variants = []
+        for index, override in enumerate(overrides):
+            if template:
+                variant, error_message = template.apply(override)
+            else:
+                variant, error_message = apply_overrides(workflow, override)
+            if error_message:
+                return None, f"Override {index}: {error_message}"
+            variants.append(variant)
+
+    if not variants:
+        return None, "A batch needs at least one variant"
+    if len(variants) > COMFY_BATCH_MAX_VARIANTS:
+        return (
+            None,
+            f"A batch can have at most {COMFY_BATCH_MAX_VARIANTS} variants, "
+            f"got {len(variants)}",
+        )
+    return variants, None
+
+
+def apply_overrides(workflow, overrides):
+    """
+    Returns a copy of the workflow with new values at dotted paths, like
+    {"3.inputs.seed": 42}. Only the nodes that change are copied, the variants of a
+    batch share all other nodes with the base workflow.
+
+    Args:
+        workflow (dict): The base workflow
+        overrides (dict): The dotted paths ("<node id>.inputs.<input>") and their values
+
+    Returns:
+        tuple: (workflow, error_message)
+    """
+    variant = dict(workflow)
+    copied = set()
+    for path, value in overrides.items():
+        node_id, _, rest = path.partition(".")
+        if node_id not in variant:
+            return None, f"'{path}': node {node_id} is not in the workflow"
+        if not rest:
+            return None, f"'{path}' must name a value of the node, like '3.inputs.seed'"
+        if node_id not in copied:
+            variant[node_id] = copy.deepcopy(workflow[node_id])
+            copied.add(node_id)
+
+        target = variant[node_id]
+        *parents, key = rest.split(".")
+        for parent in parents:
+            target = target.get(parent) if isinstance(target, dict) else None
+            if not isinstance(target, dict):
+                return None, f"'{path}': '{parent}' is not in the workflow"
+        if not isinstance(target, dict):
+            return None, f"'{path}': node {node_id} is not an object"
+        target[key] = value
+    return variant, None
+
+
+def validate_output_options(options):
+    """
+    Validates the options for transcoding the output images.
+
+    Args:
+        options (dict): The "output" of the input, with the optional keys "format"
+                        (png, webp, jpeg or avif), "quality" (1-100) and "max_dimension".
+
+    Returns:
+        tuple: A tuple containing the validated options and an error message, if any.
+               The structure is (options, error_message).
+    """
+    if not isinstance(options, dict):
+        return None, "'output' must be an object"
+
+    unknown = sorted(set(options) - {"format", "quality", "max_dimension"})
+    if unknown:
+        return None, f"Unknown 'output' option(s): {', '.join(unknown)}"
+
+    validated = {}
+    if "format" in options:
+        output_format = str(options["format"]).lower()
+        output_format = "jpeg" if output_format == "jpg" else output_format
+        if output_format not in OUTPUT_FORMATS:
+            return (
+                None,
+                f"'output.format' must be one of: {', '.join(OUTPUT_FORMATS)}",
+            )
+        validated["format"] = output_format
+
+    for name, low, high in (("quality", 1, 100), ("max_dimension", 1, None)):
+        if name not in options:
+            continue
+        value = options[name]
+        if (
+            isinstance(value, bool)
+            or not isinstance(value, int)
+            or value < low
+            or (high is not None and value > high)
+        ):
+            limits = f"between {low} and {high}" if high else "a positive integer"
+            return None, f"'output.{name}' must be {limits}"
+        validated[name] = value
 
+    if not validated:
+        return None, None
 
-def check_server(url, retries=500, delay=50):
+    if Image is None:
+        return None, "Transcoding output images requires Pillow, which is not installed"
+    Image.init()
+    if OUTPUT_FORMATS.get(validated.get("format"), "PNG") not in Image.SAVE:
+        return (
+            None,
+            f"This worker can't write {validated['format']} images, "
+            "Pillow was built without support for it",
+        )
+
+    return validated, None
+
+
+def check_server(url, retries=500, delay=50, max_delay=None):
     """
     Check if a server is reachable via HTTP GET request
 
     Args:
-    - url (str): The URL to check
-    - retries (int, optional): The number of times to attempt connecting to the server. Default is 50
-    - delay (int, optional): The time in milliseconds to wait between retries. Default is 500
+    - url (str): The URL to check, None for the address of ComfyUI at the time of every attempt
+    - retries (int, optional): The number of times to attempt connecting to the server, None to keep trying. Default is 500
+    - delay (int, optional): The time in milliseconds to wait between retries. Default is 50
+    - max_delay (int, optional): Doubles the delay after every retry up to this many milliseconds. Default is a fixed delay
 
     Returns:
     bool: True if the server is reachable within the given number of retries, otherwise False
     """
 
-    for i in range(retries):
+    attempts = itertools.count() if retries is None else range(retries)
+    for i in attempts:
         try:
-            response = requests.get(url)
+            response = comfy.session.get(url or comfy.base_url, timeout=comfy.timeout)
 
             # If the response status code is 200, the server is up and running
             if response.status_code == 200:
@@ -93,258 +900,3518 @@ def check_server(url, retries=500, delay=50):
 
         # Wait for the specified delay before retrying
         time.sleep(delay / 1000)
+        if max_delay is not None:
+            delay = min(delay * 2, max_delay)
 
     print(
-        f"runpod-worker-comfy - Failed to connect to server at {url} after {retries} attempts."
+        f"runpod-worker-comfy - Failed to connect to server at {url or comfy.base_url} after {retries} attempts."
     )
     return False
 
 
-def upload_images(images):
+class ComfyUIReadiness:
     """
-    Upload a list of base64 encoded images to the ComfyUI server using the /upload/image endpoint.
+    Tracks whether ComfyUI can take jobs, without a request on the path of every job.
 
-    Args:
-        images (list): A list of dictionaries, each containing the 'name' of the image and the 'image' as a base64 encoded string.
-        server_address (str): The address of the ComfyUI server.
+    start() probes ComfyUI in a background thread with exponential backoff until it
+    answers, which is when the state goes from "starting" to "ready". After that, the
+    requests of the jobs themselves are the liveness check: once COMFY_LIVENESS_FAILURES
+    requests in a row couldn't connect, the state is "down" and the probe starts again.
+    Jobs wait for the first probe for up to startup_timeout seconds, but fail right away
+    while ComfyUI is down.
 
-    Returns:
-        list: A list of responses from the server for each image upload.
+    Args:
+        startup_timeout (float): Seconds to wait for ComfyUI after start()
+        max_failures (int): Consecutive failed connections that mark ComfyUI as down
+        interval_ms (int): Milliseconds between the first probes
+        max_interval_ms (int): Upper limit of the time between probes
     """
-    if not images:
-        return {"status": "success", "message": "No images to upload", "details": []}
 
-    responses = []
-    upload_errors = []
+    STARTING = "starting"
+    READY = "ready"
+    DOWN = "down"
 
-    print(f"runpod-worker-comfy - image(s) upload")
+    def __init__(
+        self,
+        startup_timeout=COMFY_STARTUP_TIMEOUT_S,
+        max_failures=COMFY_LIVENESS_FAILURES,
+        interval_ms=COMFY_API_AVAILABLE_INTERVAL_MS,
+        max_interval_ms=COMFY_API_AVAILABLE_MAX_INTERVAL_MS,
+    ):
+        self.startup_timeout = startup_timeout
+        self.max_failures = max_failures
+        self.interval_ms = interval_ms
+        self.max_interval_ms = max_interval_ms
+        self.state = self.STARTING
+        self.startup_deadline = None
+        self._ready = threading.Event()
+        self._lock = threading.Lock()
+        self._probing = False
 
-    for image in images:
-        name = image["name"]
-        image_data = image["image"]
-        blob = base64.b64decode(image_data)
+    def start(self):
+        """
+        Starts probing ComfyUI in the background, unless a probe is already running.
+        """
+        with self._lock:
+            if self.startup_deadline is None:
+                self.startup_deadline = time.monotonic() + self.startup_timeout
+            if not self._probing:
+                self._probing = True
+                threading.Thread(target=self._probe, daemon=True).start()
 
-        # Prepare the form data
-        files = {
-            "image": (name, BytesIO(blob), "image/png"),
-            "overwrite": (None, "true"),
-        }
+    def _probe(self):
+        check_server(
+            None,
+            retries=None,
+            delay=self.interval_ms,
+            max_delay=self.max_interval_ms,
+        )
+        with self._lock:
+            comfy.consecutive_failures = 0
+            self.state = self.READY
+            self._probing = False
+            self._ready.set()
+        metrics.observe_startup("comfyui_ready", time.monotonic() - WORKER_STARTED)
 
-        # POST request to upload the image
-        response = requests.post(f"http://{COMFY_HOST}/upload/image", files=files)
-        if response.status_code != 200:
-            upload_errors.append(f"Error uploading {name}: {response.text}")
-        else:
-            responses.append(f"Successfully uploaded {name}")
+    def check(self):
+        """
+        Returns None if ComfyUI can take a job, otherwise why it can't.
 
-    if upload_errors:
-        print(f"runpod-worker-comfy - image(s) upload with errors")
-        return {
-            "status": "error",
-            "message": "Some images failed to upload",
-            "details": upload_errors,
-        }
+        Only waits while ComfyUI is still starting, doesn't send any request itself.
 
-    print(f"runpod-worker-comfy - image(s) upload complete")
-    return {
-        "status": "success",
-        "message": "All images uploaded successfully",
-        "details": responses,
-    }
+        Returns:
+            str: The error message, or None if ComfyUI is ready
+        """
+        if self.state == self.READY and comfy.consecutive_failures < self.max_failures:
+            return None
 
+        if self.state == self.READY:
+            with self._lock:
+                self.state = self.DOWN
+                self._ready.clear()
+            print(
+                f"runpod-worker-comfy - ComfyUI at {comfy.base_url} stopped responding"
+            )
+        self.start()
 
-def queue_workflow(workflow):
-    """
-    Queue a workflow to be processed by ComfyUI
+        if self.state == self.STARTING:
+            remaining = self.startup_deadline - time.monotonic()
+            if self._ready.wait(max(remaining, 0)):
+                return None
+            return (
+                f"ComfyUI at {comfy.base_url} did not become ready within "
+                f"{self.startup_timeout:g} seconds"
+            )
 
-    Args:
-        workflow (dict): A dictionary containing the workflow to be processed
+        return f"ComfyUI at {comfy.base_url} is not reachable"
 
-    Returns:
-        dict: The JSON response from ComfyUI after processing the workflow
-    """
 
-    # The top level element "prompt" is required by ComfyUI
-    data = json.dumps({"prompt": workflow}).encode("utf-8")
+readiness = ComfyUIReadiness()
 
-    req = urllib.request.Request(f"http://{COMFY_HOST}/prompt", data=data)
-    return json.loads(urllib.request.urlopen(req).read())
+# ID of the job -> ID of the prompt that ComfyUI is working on for it
+in_flight_prompts = {}
 
 
-def get_history(prompt_id):
-    """
-    Retrieve the history of a given prompt using its ID
+def is_link(value):
+    """An input that is connected to the output of another node: ["node_id", output_index]"""
+    return (
+        isinstance(value, list)
+        and len(value) == 2
+        and isinstance(value[0], (str, int))
+        and isinstance(value[1], int)
+    )
 
-    Args:
-        prompt_id (str): The ID of the prompt whose history is to be retrieved
 
-    Returns:
-        dict: The history of the prompt, containing all the processing steps and results
-    """
-    with urllib.request.urlopen(f"http://{COMFY_HOST}/history/{prompt_id}") as response:
-        return json.loads(response.read())
+def types_match(output_type, input_type):
+    """Whether an output of type output_type can be connected to an input of type input_type"""
+    if isinstance(input_type, list) or input_type == "COMBO":
+        return True
+    if output_type == "*" or input_type == "*":
+        return True
+    return bool(set(str(output_type).split(",")) & set(str(input_type).split(",")))
 
 
-def base64_encode(img_path):
+def check_input_value(name, value, input_type, options, input_files=()):
     """
-    Returns base64 encoded image.
+    Checks a value that is set directly on an input (a widget) against its definition
 
     Args:
-        img_path (str): The path to the image
+        input_files (set, optional): Paths of the images that the job put into the input folder
 
     Returns:
-        str: The base64 encoded image
+        tuple: (error_type, message, details) of the problem or None
     """
-    with open(img_path, "rb") as image_file:
-        encoded_string = base64.b64encode(image_file.read()).decode("utf-8")
-        return f"{encoded_string}"
+    if isinstance(input_type, list) or input_type == "COMBO":
+        choices = input_type if isinstance(input_type, list) else options.get("options")
+        # Lists of input files don't have the images that the job just uploaded
+        if (
+            options.get("image_upload")
+            or options.get("video_upload")
+            or not choices
+            or value in input_files
+        ):
+            return None
+        if value not in choices:
+            shown = ", ".join(repr(choice) for choice in choices[:10])
+            if len(choices) > 10:
+                shown += f", ... ({len(choices)} in total)"
+            return (
+                "value_not_in_list",
+                "Value not in list",
+                f"{name}: {value!r} not in [{shown}]",
+            )
+        return None
+
+    if input_type in ("INT", "FLOAT"):
+        try:
+            number = int(value) if input_type == "INT" else float(value)
+        except (TypeError, ValueError):
+            return (
+                "invalid_input_type",
+                f"Failed to convert an input value to a {input_type} value",
+                f"{name}, {value!r}",
+            )
+        if options.get("min") is not None and number < options["min"]:
+            return (
+                "value_smaller_than_min",
+                f"Value {number} smaller than min of {options['min']}",
+                name,
+            )
+        if options.get("max") is not None and number > options["max"]:
+            return (
+                "value_bigger_than_max",
+                f"Value {number} bigger than max of {options['max']}",
+                name,
+            )
+    return None
 
 
-def process_output_images(outputs, job_id):
+def check_workflow(workflow, object_info, node_ids=None, input_files=()):
     """
-    This function takes the "outputs" from image generation and the job ID,
-    then determines the correct way to return the image, either as a direct URL
-    to an AWS S3 bucket or as a base64 encoded string, depending on the
-    environment configuration.
+    Finds every problem of a workflow, based on the node definitions of ComfyUI
+
+    Checks that every node is known and that the workflow has an output node. Like
+    ComfyUI, only the output nodes and the nodes they take inputs from (directly or
+    not) are checked further: that they have their required inputs, link to existing
+    outputs of a matching type and that the values of their inputs are valid. The links
+    must not form a cycle. Every node and input is looked at once.
 
     Args:
-        outputs (dict): A dictionary containing the outputs from image generation,
-                        typically includes node IDs and their respective output data.
-        job_id (str): The unique identifier for the job.
+        workflow (dict): The workflow in the API format
+        object_info (dict): The response of /object_info
+        node_ids (list, optional): Only check these nodes, because the others are known
+                                   to be fine. Their links are still resolved against
+                                   the whole workflow, but cycles aren't looked for.
+        input_files (set, optional): Paths of the images that the job put into the input
+                                     folder, which are valid values of any list
 
     Returns:
-        dict: A dictionary with the status ('success' or 'error') and the message,
-              which is either the URL to the image in the AWS S3 bucket or a base64
-              encoded string of the image. In case of error, the message details the issue.
-
-    The function works as follows:
-    - It first determines the output path for the images from an environment variable,
-      defaulting to "/comfyui/output" if not set.
-    - It then iterates through the outputs to find the filenames of the generated images.
-    - After confirming the existence of the image in the output folder, it checks if the
-      AWS S3 bucket is configured via the BUCKET_ENDPOINT_URL environment variable.
-    - If AWS S3 is configured, it uploads the image to the bucket and returns the URL.
-    - If AWS S3 is not configured, it encodes the image in base64 and returns the string.
-    - If the image file does not exist in the output folder, it returns an error status
-      with a message indicating the missing image file.
+        list: {"node_id", "class_type", "type", "message", "details"} of every problem
     """
+    errors = []
 
-    # The path where ComfyUI stores the generated images
-    COMFY_OUTPUT_PATH = os.environ.get("COMFY_OUTPUT_PATH", "/comfyui/output")
+    def add(node_id, class_type, error_type, message, details=""):
+        errors.append(
+            {
+                "node_id": node_id,
+                "class_type": class_type,
+                "type": error_type,
+                "message": message,
+                "details": details,
+            }
+        )
 
-    output_images = {}
+    if not isinstance(workflow, dict) or not workflow:
+        add(None, None, "invalid_prompt", "The workflow must be an object of nodes")
+        return errors
 
-    for node_id, node_output in outputs.items():
-        if "images" in node_output:
-            for image in node_output["images"]:
-                output_images = os.path.join(image["subfolder"], image["filename"])
+    checked = set(workflow if node_ids is None else node_ids)
+    definitions = {}
+    for node_id, node in workflow.items():
+        if (
+            not isinstance(node, dict)
+            or "class_type" not in node
+            or not isinstance(node.get("inputs", {}), dict)
+        ):
+            if node_id in checked:
+                add(
+                    node_id,
+                    None,
+                    "invalid_prompt",
+                    "Node needs a class_type and inputs",
+                )
+            continue
+        definition = object_info.get(node["class_type"])
+        if definition is None and node_id in checked:
+            add(
+                node_id,
+                node["class_type"],
+                "missing_node_type",
+                f"Node type {node['class_type']!r} is not installed",
+            )
+        if definition is not None:
+            definitions[node_id] = definition
 
-    print(f"runpod-worker-comfy - image generation is done")
+    # ComfyUI doesn't look at the nodes that no output depends on
+    outputs = [node_id for node_id, d in definitions.items() if d.get("output_node")]
+    if not outputs and node_ids is None:
+        add(None, None, "prompt_no_outputs", "Prompt has no outputs")
+    used = set()
+    pending = list(outputs)
+    while pending:
+        node_id = pending.pop()
+        if node_id in used or not isinstance(workflow.get(node_id), dict):
+            continue
+        used.add(node_id)
+        inputs = workflow[node_id].get("inputs", {})
+        pending.extend(str(v[0]) for v in inputs.values() if is_link(v))
 
-    # expected image output folder
-    local_image_path = f"{COMFY_OUTPUT_PATH}/{output_images}"
+    # ID of a node -> IDs of the nodes it takes inputs from
+    dependencies = {}
+    for node_id, definition in definitions.items():
+        if node_id not in checked or node_id not in used:
+            continue
+        class_type = workflow[node_id]["class_type"]
+        inputs = workflow[node_id].get("inputs", {})
+        input_definitions = definition.get("input", {})
+        required = input_definitions.get("required", {})
+        optional = input_definitions.get("optional", {})
 
-    print(f"runpod-worker-comfy - {local_image_path}")
+        for name in required:
+            if name not in inputs:
+                add(
+                    node_id,
+                    class_type,
+                    "required_input_missing",
+                    "Required input is missing",
+                    name,
+                )
 
-    # The image is in the output folder
-    if os.path.exists(local_image_path):
-        if os.environ.get("BUCKET_ENDPOINT_URL", False):
-            # URL to image in AWS S3
-            image = rp_upload.upload_image(job_id, local_image_path)
-            print(
-                "runpod-worker-comfy - the image was generated and uploaded to AWS S3"
-            )
-        else:
-            # base64 image
-            image = base64_encode(local_image_path)
-            print(
-                "runpod-worker-comfy - the image was generated and converted to base64"
-            )
+        for name, value in inputs.items():
+            spec = required.get(name) or optional.get(name)
+            if not spec:
+                # ComfyUI ignores inputs that the node doesn't have
+                continue
+            input_type = spec[0]
+            options = spec[1] if len(spec) > 1 and isinstance(spec[1], dict) else {}
 
-        return {
-            "status": "success",
-            "message": image,
-        }
-    else:
-        print("runpod-worker-comfy - the image does not exist in the output folder")
-        return {
-            "status": "error",
-            "message": f"the image does not exist in the specified output folder: {local_image_path}",
-        }
+            if is_link(value):
+                source_id, index = str(value[0]), value[1]
+                if source_id not in workflow:
+                    add(
+                        node_id,
+                        class_type,
+                        "bad_linked_input",
+                        f"Input links to node {source_id}, which doesn't exist",
+                        name,
+                    )
+                    continue
+                dependencies.setdefault(node_id, []).append(source_id)
+                if source_id not in definitions:
+                    continue
+                outputs = definitions[source_id].get("output", [])
+                if not 0 <= index < len(outputs):
+                    add(
+                        node_id,
+                        class_type,
+                        "bad_linked_input",
+                        f"Node {source_id} has no output {index}",
+                        name,
+                    )
+                elif not types_match(outputs[index], input_type):
+                    add(
+                        node_id,
+                        class_type,
+                        "return_type_mismatch",
+                        f"Return type mismatch between linked nodes: {outputs[index]} != {input_type}",
+                        name,
+                    )
+                continue
 
+            problem = check_input_value(name, value, input_type, options, input_files)
+            if problem:
+                add(node_id, class_type, *problem)
 
-def handler(job):
-    """
-    The main function that handles a job of generating an image.
+    for node_id in nodes_in_cycles(dependencies) if node_ids is None else []:
+        add(
+            node_id,
+            workflow[node_id].get("class_type"),
+            "dependency_cycle",
+            "Node is part of a dependency cycle",
+        )
+
+    return errors
 
-    This function validates the input, sends a prompt to ComfyUI for processing,
-    polls ComfyUI for result, and retrieves generated images.
 
+def nodes_in_cycles(dependencies):
+    """
     Args:
-        job (dict): A dictionary containing job details and input parameters.
+        dependencies (dict): ID of a node -> IDs of the nodes it takes inputs from
 
     Returns:
-        dict: A dictionary containing either an error message or a success status with generated images.
+        list: The IDs of the nodes that are part of a cycle (or between two cycles)
     """
-    job_input = job["input"]
+    dependents = {}
+    for node_id, sources in dependencies.items():
+        for source_id in sources:
+            dependents.setdefault(source_id, []).append(node_id)
 
-    # Make sure that the input is valid
-    validated_data, error_message = validate_input(job_input)
-    if error_message:
-        return {"error": error_message}
+    # Peel off nodes without inputs and nodes without outputs until only cycles are left
+    remaining = set(dependencies) | set(dependents)
+    for edges, reverse in ((dependencies, dependents), (dependents, dependencies)):
+        counts = {
+            node_id: sum(1 for n in edges.get(node_id, []) if n in remaining)
+            for node_id in remaining
+        }
+        ready = [node_id for node_id, count in counts.items() if count == 0]
+        while ready:
+            node_id = ready.pop()
+            remaining.discard(node_id)
+            for other in reverse.get(node_id, []):
+                if other in remaining:
+                    counts[other] -= 1
+                    if counts[other] == 0:
+                        ready.append(other)
 
-    # Extract validated data
-    workflow = validated_data["workflow"]
-    images = validated_data.get("images")
+    return sorted(remaining, key=node_order)
 
-    # Make sure that the ComfyUI API is available
-    check_server(
-        f"http://{COMFY_HOST}",
-        COMFY_API_AVAILABLE_MAX_RETRIES,
-        COMFY_API_AVAILABLE_INTERVAL_MS,
-    )
 
-    # Upload images if they exist
-    upload_result = upload_images(images)
+class WorkflowValidator:
+    """
+    Checks workflows against the node definitions of ComfyUI before they are queued.
 
-    if upload_result["status"] == "error":
-        return upload_result
+    The node definitions (/object_info) are fetched once and kept in memory and on disk.
+    The file on disk is named after the content of the custom_nodes folder, so a worker
+    with the same custom nodes doesn't have to fetch them again and a worker with other
+    custom nodes doesn't use them. When a workflow doesn't match the definitions (for
+    example because models were added to a network volume), they are fetched again, at
+    most every OBJECT_INFO_REFRESH_INTERVAL_S seconds, before the workflow is rejected.
+    If ComfyUI doesn't return its node definitions, workflows aren't checked.
 
-    # Queue the workflow
-    try:
-        queued_workflow = queue_workflow(workflow)
-        prompt_id = queued_workflow["prompt_id"]
-        print(f"runpod-worker-comfy - queued workflow with ID {prompt_id}")
-    except Exception as e:
-        return {"error": f"Error queuing workflow: {str(e)}"}
+    Args:
+        cache_path (str): Folder for the cached node definitions
+        custom_nodes_path (str): The custom_nodes folder of ComfyUI
+    """
 
-    # Poll for completion
+    def __init__(
+        self,
+        cache_path=COMFY_OBJECT_INFO_CACHE_PATH,
+        custom_nodes_path=COMFY_CUSTOM_NODES_PATH,
+    ):
+        self.cache_path = cache_path
+        self.custom_nodes_path = custom_nodes_path
+        self.object_info = None
+        self.fetched_at = None
+        self._lock = threading.Lock()
+
+    def cache_file(self):
+        """The file for the node definitions of the installed custom nodes"""
+        try:
+            entries = sorted(
+                f"{entry.name}:{entry.stat().st_mtime_ns}"
+                for entry in os.scandir(self.custom_nodes_path)
+            )
+        except OSError:
+            entries = []
+        key = hashlib.sha256("\n".join(entries).encode()).hexdigest()[:16]
+        return os.path.join(self.cache_path, f"object_info-{key}.json")
+
+    def fetch(self):
+        """Fetches the node definitions from ComfyUI and stores them on disk"""
+        response = comfy.get("/object_info")
+        response.raise_for_status()
+        object_info = response_json(response)
+        self.object_info = object_info
+        self.fetched_at = time.monotonic()
+
+        try:
+            os.makedirs(self.cache_path, exist_ok=True)
+            path = self.cache_file()
+            with tempfile.NamedTemporaryFile(
+                "wb", dir=self.cache_path, delete=False
+            ) as f:
+                f.write(json_dumps(object_info))
+            os.replace(f.name, path)
+        except OSError as e:
+            print(f"runpod-worker-comfy - could not cache the node definitions: {e}")
+        return object_info
+
+    def load(self):
+        """Returns the node definitions from memory, disk or ComfyUI"""
+        with self._lock:
+            if self.object_info is not None:
+                return self.object_info
+            try:
+                with open(self.cache_file(), "rb") as f:
+                    self.object_info = json_loads(f.read())
+                return self.object_info
+            except (OSError, ValueError):
+                pass
+            return self.fetch()
+
+    def validate(self, workflow, node_ids=None, input_files=()):
+        """
+        Args:
+            workflow (dict): The workflow in the API format
+            node_ids (list, optional): Only check these nodes, see check_workflow()
+            input_files (set, optional): Paths of the images of the job, see check_workflow()
+
+        Returns:
+            dict: {"error": ..., "details": {"type": "invalid_workflow", "node_errors": [...]}}
+                  if the workflow has problems, otherwise None
+        """
+        try:
+            errors = check_workflow(workflow, self.load(), node_ids, input_files)
+            if errors and (
+                self.fetched_at is None
+                or time.monotonic() - self.fetched_at > OBJECT_INFO_REFRESH_INTERVAL_S
+            ):
+                with self._lock:
+                    errors = check_workflow(
+                        workflow, self.fetch(), node_ids, input_files
+                    )
+        except (requests.RequestException, ValueError) as e:
+            print(f"runpod-worker-comfy - skipping the workflow validation: {e}")
+            return None
+
+        if not errors:
+            return None
+        return {
+            "error": f"Invalid workflow: {describe_node_errors(errors)}",
+            "details": {"type": "invalid_workflow", "node_errors": errors},
+        }
+
+
+workflow_validator = WorkflowValidator()
+
+
+class WorkflowTemplate:
+    """
+    A workflow that jobs refer to by name and only send the values that change.
+
+    The workflow is parsed once and a setter is prepared for every value of its nodes,
+    so applying overrides is a dictionary lookup per value instead of walking and
+    checking the path. The variants only copy the dictionaries on the path to a changed
+    value and share everything else with the template, which also tells validate()
+    which nodes it has to check.
+
+    Args:
+        name (str): The name jobs use in "template"
+        workflow (dict): The workflow in the API format
+    """
+
+    def __init__(self, name, workflow):
+        self.name = name
+        self.workflow = workflow
+        self.valid = False
+        # "3.inputs.seed" -> the keys of the dictionaries on the way and of the value
+        self.setters = {}
+        for node_id, node in workflow.items():
+            self._add_setters((node_id,), node)
+
+    def _add_setters(self, keys, value):
+        if not isinstance(value, dict) or not value:
+            if len(keys) > 1:
+                self.setters[".".join(keys)] = (keys[:-1], keys[-1])
+            return
+        for key, child in value.items():
+            self._add_setters(keys + (str(key),), child)
+
+    def apply(self, overrides):
+        """
+        Returns a variant of the template with new values at dotted paths, like
+        {"3.inputs.seed": 42}. Only values that are in the template can be set.
+
+        Args:
+            overrides (dict): The dotted paths and their values
+
+        Returns:
+            tuple: (workflow, error_message)
+        """
+        variant = dict(self.workflow)
+        # Keys of a dictionary of the template -> the copy of it in the variant
+        copies = {}
+        for path, value in overrides.items():
+            setter = self.setters.get(path)
+            if setter is None:
+                return None, f"'{path}' is not a value of the template '{self.name}'"
+            parents, key = setter
+            target = variant
+            for depth in range(1, len(parents) + 1):
+                copied = copies.get(parents[:depth])
+                if copied is None:
+                    copied = copies[parents[:depth]] = dict(target[parents[depth - 1]])
+                    target[parents[depth - 1]] = copied
+                target = copied
+            target[key] = value
+        return variant, None
+
+    def validate(self, workflow=None, input_files=()):
+        """
+        Checks the template against the node definitions of ComfyUI, until it passed
+        once, and then only the nodes in which the workflow differs from the template.
+
+        Args:
+            workflow (dict, optional): A variant of the template, see apply()
+            input_files (set, optional): Paths of the images of the job, see check_workflow()
+
+        Returns:
+            dict: The error result like WorkflowValidator.validate() or None
+        """
+        if not self.valid:
+            error_result = workflow_validator.validate(self.workflow)
+            if error_result:
+                return {
+                    **error_result,
+                    "error": f"Template '{self.name}': {error_result['error']}",
+                }
+            self.valid = True
+        if workflow is None:
+            return None
+
+        changed = [
+            node_id
+            for node_id, node in workflow.items()
+            if node is not self.workflow.get(node_id)
+        ]
+        if not changed:
+            return None
+        # A new link can close a cycle, which only the whole workflow shows
+        new_links = any(
+            is_link(value)
+            and value != self.workflow[node_id].get("inputs", {}).get(name)
+            for node_id in changed
+            for name, value in workflow[node_id].get("inputs", {}).items()
+        )
+        return workflow_validator.validate(
+            workflow, None if new_links else changed, input_files
+        )
+
+
+class WorkflowTemplates:
+    """
+    The workflow templates of this worker, read from the JSON files in a folder once.
+
+    Every file is a workflow in the API format, or a job input with one (like the
+    files in test_resources/workflows), named after the file without ".json".
+    Files that can't be read are reported and skipped.
+
+    Args:
+        path (str): The folder with the templates
+    """
+
+    def __init__(self, path=COMFY_TEMPLATES_PATH):
+        self.path = path
+        self.templates = None
+        self._lock = threading.Lock()
+
+    def load(self):
+        """Reads the templates, unless they were already read"""
+        with self._lock:
+            if self.templates is not None:
+                return self.templates
+            templates = {}
+            try:
+                filenames = sorted(os.listdir(self.path))
+            except OSError:
+                filenames = []
+            for filename in filenames:
+                name, extension = os.path.splitext(filename)
+                if extension.lower() != ".json":
+                    continue
+                try:
+                    with open(os.path.join(self.path, filename), "rb") as f:
+                        workflow = json_loads(f.read())
+                    if isinstance(workflow.get("input"), dict):
+                        workflow = workflow["input"]["workflow"]
+                    if not isinstance(workflow, dict) or not all(
+                        isinstance(node, dict) for node in workflow.values()
+                    ):
+                        raise ValueError("not a workflow in the API format")
+                except (OSError, ValueError, KeyError, AttributeError) as e:
+                    print(
+                        f"runpod-worker-comfy - could not read the template {filename}: {e}"
+                    )
+                    continue
+                templates[name] = WorkflowTemplate(name, workflow)
+            if templates:
+                print(
+                    f"runpod-worker-comfy - loaded the templates "
+                    f"{', '.join(templates)} from {self.path}"
+                )
+            self.templates = templates
+            return templates
+
+    def get(self, name):
+        """The template with this name, or None"""
+        return self.load().get(name)
+
+    def validate(self):
+        """Checks every template before the first job uses it, problems are reported"""
+        for template in self.load().values():
+            error_result = template.validate()
+            if error_result:
+                print(f"runpod-worker-comfy - {error_result['error']}")
+
+    def validate_when_ready(self):
+        """
+        Checks every template in the background as soon as ComfyUI is ready, so the
+        first jobs that use them only check the nodes they change.
+
+        Returns:
+            threading.Thread: The thread that checks the templates
+        """
+
+        def run():
+            error_message = readiness.check()
+            if error_message:
+                print(
+                    f"runpod-worker-comfy - not checking the templates: {error_message}"
+                )
+                return
+            self.validate()
+
+        thread = threading.Thread(target=run, daemon=True)
+        thread.start()
+        return thread
+
+
+workflow_templates = WorkflowTemplates()
+
+
+class InputImageCache:
+    """
+    Content-hash index of the images that this worker uploaded into the input folder of ComfyUI.
+
+    A remembered image is stored as INPUT_CACHE_FOLDER/<content hash>/<name>, see path(),
+    and workflows are pointed to that path. The file of a path never gets other content,
+    so two jobs that send different images with the same name, even at the same time,
+    don't overwrite each other's image. The least recently used images are forgotten once
+    their total size exceeds max_bytes. Forgotten images stay in the input folder, because
+    a prompt that is still queued may reference them. If the input folder is reachable
+    from the worker, hits are double-checked against the files on disk.
+
+    Args:
+        max_bytes (int): Maximum total size of the remembered images
+        input_path (str): The input folder of ComfyUI
+    """
+
+    def __init__(
+        self, max_bytes=COMFY_INPUT_CACHE_MAX_BYTES, input_path=COMFY_INPUT_PATH
+    ):
+        self.max_bytes = max_bytes
+        self.input_path = input_path
+        self.total_bytes = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _local_path(self, name):
+        if not os.path.isdir(self.input_path):
+            return None
+        return os.path.join(self.input_path, name)
+
+    @staticmethod
+    def path(name, digest):
+        """The path of the image with this name and content hash inside the input folder"""
+        return f"{INPUT_CACHE_FOLDER}/{digest}/{name}"
+
+    def contains(self, name, digest):
+        """True if the image with this name and content hash is already uploaded"""
+        path = self.path(name, digest)
+        with self._lock:
+            if path not in self._entries:
+                return False
+            local_path = self._local_path(path)
+            if local_path is not None and not os.path.exists(local_path):
+                self._remove(path)
+                return False
+            self._entries.move_to_end(path)
+            return True
+
+    def add(self, name, digest, size):
+        """Remember that the image with this name and content hash is uploaded"""
+        path = self.path(name, digest)
+        if size > self.max_bytes:
+            self.discard(name, digest)
+            return
+        with self._lock:
+            self._remove(path)
+            self._entries[path] = size
+            self.total_bytes += size
+            while self.total_bytes > self.max_bytes:
+                self._remove(next(iter(self._entries)))
+
+    def discard(self, name, digest):
+        """Forget the image, e.g. because its upload failed"""
+        with self._lock:
+            self._remove(self.path(name, digest))
+
+    def _remove(self, path):
+        size = self._entries.pop(path, None)
+        if size is not None:
+            self.total_bytes -= size
+
+
+# Images that were already uploaded during the lifetime of this worker
+input_image_cache = InputImageCache()
+
+
+def resolve_url(url):
+    """
+    Returns the HTTP URL of an input image URL: s3:// URLs are presigned with the
+    credentials of the bucket (BUCKET_ENDPOINT_URL), http(s):// URLs are returned as is.
+
+    Raises:
+        ValueError: If the URL is on S3 but no bucket is configured
+    """
+    parsed = urllib.parse.urlparse(url)
+    if parsed.scheme != "s3":
+        return url
+    boto_client, _ = rp_upload.get_boto_client()
+    if boto_client is None:
+        raise ValueError(
+            "s3:// URLs need BUCKET_ENDPOINT_URL, BUCKET_ACCESS_KEY_ID and "
+            "BUCKET_SECRET_ACCESS_KEY"
+        )
+    return boto_client.generate_presigned_url(
+        "get_object",
+        Params={"Bucket": parsed.netloc, "Key": parsed.path.lstrip("/")},
+        ExpiresIn=3600,
+    )
+
+
+class DownloadCache:
+    """
+    On-disk cache of the input images that jobs reference by URL, so that an image that
+    many jobs use is downloaded once per worker.
+
+    Entries are keyed by the URL and validated with the ETag of the server: a cached
+    image is requested with If-None-Match and only downloaded again if the server has a
+    new version. Responses without an ETag can't be validated and are not cached. The
+    least recently used images are evicted once their total size is above max_bytes.
+    Next to every image is a .json with its URL and ETag, the index is rebuilt from them
+    on start. All downloads share one requests.Session with a pool of keep-alive
+    connections.
+
+    Args:
+        path (str): Folder of the cache
+        max_bytes (int): Maximum total size of the cached images
+        pool_size (int): Maximum number of pooled connections per host
+    """
+
+    def __init__(
+        self,
+        path=COMFY_DOWNLOAD_CACHE_PATH,
+        max_bytes=COMFY_DOWNLOAD_CACHE_MAX_BYTES,
+        pool_size=COMFY_UPLOAD_WORKERS,
+    ):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.total_bytes = 0
+        self.hits = 0
+        self.downloads = 0
+        # URL -> (ETag, size)
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=pool_size)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self._load_index()
+
+    def _file(self, url):
+        return os.path.join(self.path, hashlib.sha256(url.encode("utf-8")).hexdigest())
+
+    def _load_index(self):
+        try:
+            names = os.listdir(self.path)
+        except OSError:
+            return
+        entries = []
+        for name in names:
+            if not name.endswith(".json"):
+                continue
+            index_file = os.path.join(self.path, name)
+            # Skip files that are not from the cache or were cut off
+            try:
+                with open(index_file, "rb") as f:
+                    entry = json_loads(f.read())
+                size = os.path.getsize(index_file[: -len(".json")])
+                entries.append(
+                    (os.path.getmtime(index_file), entry["url"], entry["etag"], size)
+                )
+            except (OSError, ValueError, KeyError, TypeError):
+                continue
+        for _, url, etag, size in sorted(entries):
+            self._entries[url] = (etag, size)
+            self.total_bytes += size
+
+    def open(self, url):
+        """
+        Returns the image at the URL as an open file, downloading it only if the cached
+        version is outdated, and its ETag (None if the server sent none).
+
+        Raises:
+            requests.RequestException: If the download failed
+            OSError: If the image could not be written
+            ValueError: If the URL can't be resolved, see resolve_url()
+        """
+        cached, headers = None, {}
+        with self._lock:
+            entry = self._entries.get(url)
+            if entry is not None:
+                try:
+                    # Opened before the request, so that an eviction can't remove it
+                    cached = open(self._file(url), "rb")
+                    headers["If-None-Match"] = entry[0]
+                except OSError:
+                    self._remove(url)
+
+        try:
+            with self.session.get(
+                resolve_url(url),
+                headers=headers,
+                stream=True,
+                timeout=(COMFY_CONNECT_TIMEOUT_S, COMFY_READ_TIMEOUT_S),
+            ) as response:
+                if cached is not None and response.status_code == 304:
+                    with self._lock:
+                        if url in self._entries:
+                            self._entries.move_to_end(url)
+                        self.hits += 1
+                    return cached, entry[0]
+                if cached is not None:
+                    cached.close()
+                response.raise_for_status()
+                return self._download(url, response)
+        except BaseException:
+            if cached is not None:
+                cached.close()
+            raise
+
+    def _download(self, url, response):
+        etag = response.headers.get("ETag")
+        use_cache = etag is not None and self.max_bytes > 0
+        if use_cache:
+            os.makedirs(self.path, exist_ok=True)
+        blob = tempfile.NamedTemporaryFile(
+            dir=self.path if use_cache else None, prefix=".", delete=False
+        )
+        try:
+            for chunk in response.iter_content(DOWNLOAD_CHUNK_BYTES):
+                blob.write(chunk)
+            size = blob.tell()
+            blob.seek(0)
+            with self._lock:
+                self.downloads += 1
+                if use_cache and size <= self.max_bytes:
+                    self._remove(url)
+                    with open(self._file(url) + ".json", "wb") as f:
+                        f.write(json_dumps({"url": url, "etag": etag}))
+                    os.replace(blob.name, self._file(url))
+                    self._entries[url] = (etag, size)
+                    self.total_bytes += size
+                    while self.total_bytes > self.max_bytes:
+                        self._remove(next(iter(self._entries)))
+                else:
+                    # The open file stays readable until it is closed
+                    os.remove(blob.name)
+        except BaseException:
+            blob.close()
+            try:
+                os.remove(blob.name)
+            except OSError:
+                pass
+            raise
+        return blob, etag
+
+    def _remove(self, url):
+        entry = self._entries.pop(url, None)
+        if entry is not None:
+            self.total_bytes -= entry[1]
+        for path in (self._file(url), self._file(url) + ".json"):
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+
+# Input images that were downloaded from their URL during the lifetime of this worker
+download_cache = DownloadCache()
+
+
+class InputStaging:
+    """
+    Writes input images straight into the input folder of ComfyUI, when the worker
+    shares it with ComfyUI, instead of sending them through /upload/image, where
+    ComfyUI has to parse the multipart body and write the image to disk again.
+
+    Every image is written into a staging folder of its job inside INPUT_STAGING_FOLDER
+    and then renamed into place, so ComfyUI never reads a half-written image. Concurrent
+    jobs don't get in each other's way, because every job has its own folder for the
+    images that are not cached, see job_input_folder(). In the "auto" mode, whether ComfyUI
+    reads the folder is checked once, by writing a file into it and requesting it
+    through /view. Otherwise, the images are uploaded through HTTP.
+
+    Args:
+        mode (str): "auto", "local" or "http"
+        input_path (str): The input folder of ComfyUI
+    """
+
+    def __init__(self, mode=COMFY_INPUT_STAGING, input_path=COMFY_INPUT_PATH):
+        self.mode = mode
+        self.input_path = os.path.abspath(input_path)
+        self._shared = None if mode == "auto" else mode == "local"
+        self._lock = threading.Lock()
+
+    @property
+    def local(self):
+        """Whether images are written into the input folder directly"""
+        if self._shared is None:
+            with self._lock:
+                if self._shared is None:
+                    self._shared = self._check_shared()
+                    if self._shared is not None:
+                        print(
+                            f"runpod-worker-comfy - input images are "
+                            f"{'written into' if self._shared else 'uploaded to'} "
+                            f"{self.input_path if self._shared else '/upload/image'}"
+                        )
+        return bool(self._shared)
+
+    def _check_shared(self):
+        """True if ComfyUI reads the input folder, None if that can't be told yet"""
+        name = f".runpod-worker-comfy-{uuid.uuid4().hex}"
+        path = os.path.join(self.input_path, name)
+        try:
+            with open(path, "w") as f:
+                f.write(name)
+        except OSError:
+            return False
+        try:
+            response = comfy.get(
+                "/view", params={"filename": name, "type": "input"}, retries=0
+            )
+            return response.status_code == 200 and response.text == name
+        except requests.RequestException:
+            return None
+        finally:
+            os.remove(path)
+
+    @contextmanager
+    def job_folder(self):
+        """
+        Yields a new staging folder for the images of a job and removes it afterwards, or
+        yields None if the images have to be uploaded through HTTP.
+        """
+        if not self.local:
+            yield None
+            return
+        try:
+            root = os.path.join(self.input_path, INPUT_STAGING_FOLDER)
+            os.makedirs(root, exist_ok=True)
+            folder = tempfile.mkdtemp(dir=root)
+        except OSError as e:
+            print(f"runpod-worker-comfy - could not create a staging folder: {e}")
+            yield None
+            return
+        try:
+            yield folder
+        finally:
+            shutil.rmtree(folder, ignore_errors=True)
+
+    def remove_job_inputs(self, job_id):
+        """
+        Deletes the folder with the images of a job once its prompts are done. Images
+        that were uploaded to ComfyUI on another machine can't be deleted and stay.
+        """
+        shutil.rmtree(
+            os.path.join(self.input_path, job_input_folder(job_id)), ignore_errors=True
+        )
+
+    def stage(self, folder, path, write):
+        """
+        Writes an image into the staging folder and renames it into the input folder.
+
+        Args:
+            folder (str): The staging folder of the job, see job_folder()
+            path (str): The path of the image inside the input folder
+            write (callable): Writes the content of the image into the file it gets
+
+        Returns:
+            int: The size of the image
+
+        Raises:
+            OSError: If the image could not be written
+            ValueError: If the path points outside of the input folder
+        """
+        target = os.path.abspath(os.path.join(self.input_path, path))
+        if ".." in path.split("/") or not target.startswith(self.input_path + os.sep):
+            raise ValueError(f"'{path}' is outside of the input folder")
+        staged = os.path.join(folder, uuid.uuid4().hex)
+        try:
+            with open(staged, "wb") as f:
+                write(f)
+                size = f.tell()
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            os.replace(staged, target)
+        except BaseException:
+            try:
+                os.remove(staged)
+            except OSError:
+                pass
+            raise
+        return size
+
+
+# Writes the input images into the input folder of ComfyUI, if it is shared with the worker
+input_staging = InputStaging()
+
+
+def job_input_folder(job_id):
+    """The folder inside the input folder with the images of a job that are not cached"""
+    return "".join(c if c.isalnum() or c in "-_" else "_" for c in job_id) or "_"
+
+
+def hash_base64(data):
+    """
+    Returns the SHA-256 hex digest of a base64 string without decoding it.
+    """
+    digest = hashlib.sha256()
+    for start in range(0, len(data), BASE64_DECODE_CHUNK_SIZE):
+        digest.update(data[start : start + BASE64_DECODE_CHUNK_SIZE].encode("ascii"))
+    return digest.hexdigest()
+
+
+def decode_base64_to_file(data, blob=None):
+    """
+    Decode a base64 string into a temporary file, chunk by chunk
+
+    Only one chunk of the decoded image is held in memory at any time. Small images
+    stay in memory, bigger ones are spooled to disk.
+
+    Args:
+        data (str): The base64 encoded image, optionally as a data URI
+        blob (file object, optional): The file to write into instead of a temporary file
+
+    Returns:
+        file object: The decoded image, positioned at the start
+
+    Raises:
+        binascii.Error: If the data is not valid base64
+    """
+    # Strip the "data:image/png;base64," prefix of data URIs
+    if data.startswith("data:"):
+        data = data.partition(",")[2]
+    # Chunks are only aligned to the 4 character base64 blocks without whitespace
+    if any(char in data for char in " \n\r\t"):
+        data = "".join(data.split())
+
+    if blob is None:
+        blob = tempfile.SpooledTemporaryFile(max_size=BASE64_DECODE_CHUNK_SIZE)
+    for start in range(0, len(data), BASE64_DECODE_CHUNK_SIZE):
+        blob.write(base64.b64decode(data[start : start + BASE64_DECODE_CHUNK_SIZE]))
+    blob.seek(0)
+    return blob
+
+
+def upload_image(image, timings=None, staging_folder=None, folder=""):
+    """
+    Decode a single base64 encoded image and upload it to ComfyUI
+
+    Images that are already in the input folder with the same name and content are
+    skipped, without decoding them. Images with a 'url' instead are downloaded, see
+    upload_image_from_url(). With a staging folder, the image is decoded straight into
+    the input folder instead of being uploaded, see InputStaging. Images that the input
+    image cache doesn't remember are put into the folder of the job.
+
+    Args:
+        image (dict): A dictionary with the 'name' of the image and the 'image' as a base64 encoded string.
+        timings (JobTimings, optional): Records the "image_decode" and "image_upload" stages.
+        staging_folder (str, optional): The staging folder of the job, see InputStaging.job_folder()
+        folder (str, optional): The folder of the job inside the input folder, see job_input_folder()
+
+    Returns:
+        tuple: (success, message, path) where message is the line for the upload details
+               and path is where the image is inside the input folder
+    """
+    if timings is None:
+        timings = JobTimings()
+    if "image" not in image:
+        return upload_image_from_url(image, timings, staging_folder, folder)
+    name = image["name"]
+    digest = None
+    if input_image_cache.max_bytes > 0:
+        try:
+            digest = hash_base64(image["image"])
+        except UnicodeEncodeError as e:
+            return False, f"Error uploading {name}: {e}", None
+        if input_image_cache.contains(name, digest):
+            return (
+                True,
+                f"Successfully uploaded {name} (already in the input folder)",
+                input_image_cache.path(name, digest),
+            )
+
+    if staging_folder:
+        with timings.measure("image_decode"):
+            return stage_image(
+                name,
+                staging_folder,
+                lambda f: decode_base64_to_file(image["image"], f),
+                digest,
+                folder,
+            )
+
+    try:
+        with timings.measure("image_decode"):
+            blob = decode_base64_to_file(image["image"])
+    except ValueError as e:
+        return False, f"Error uploading {name}: {e}", None
+    with blob:
+        return send_image(name, blob, digest, timings, folder=folder)
+
+
+def upload_image_from_url(image, timings, staging_folder=None, folder=""):
+    """
+    Download an image that is referenced by its 'url' and upload it to ComfyUI
+
+    The image comes from the download cache if the server still has the same version
+    (ETag) and isn't uploaded again if that version is already in the input folder.
+
+    Args:
+        image (dict): A dictionary with the 'name' of the image and its http(s):// or s3:// 'url'.
+        timings (JobTimings): Records the "image_download" and "image_upload" stages.
+        staging_folder (str, optional): The staging folder of the job, see InputStaging.job_folder()
+        folder (str, optional): The folder of the job inside the input folder, see job_input_folder()
+
+    Returns:
+        tuple: (success, message, path), see upload_image()
+    """
+    name, url = image["name"], image["url"]
+    try:
+        with timings.measure("image_download"):
+            blob, etag = download_cache.open(url)
+    except (OSError, ValueError, requests.RequestException) as e:
+        return False, f"Error downloading {name}: {e}", None
+
+    digest = None
+    if etag and input_image_cache.max_bytes > 0:
+        digest = hashlib.sha256(f"{url}\n{etag}".encode("utf-8")).hexdigest()
+        if input_image_cache.contains(name, digest):
+            blob.close()
+            return (
+                True,
+                f"Successfully uploaded {name} (already in the input folder)",
+                input_image_cache.path(name, digest),
+            )
+    content_type = mimetypes.guess_type(name)[0] or "image/png"
+    with blob:
+        if staging_folder:
+            with timings.measure("image_upload"):
+                return stage_image(
+                    name,
+                    staging_folder,
+                    lambda f: shutil.copyfileobj(blob, f, DOWNLOAD_CHUNK_BYTES),
+                    digest,
+                    folder,
+                )
+        return send_image(name, blob, digest, timings, content_type, folder)
+
+
+def image_path(name, digest, folder):
+    """Where an image goes inside the input folder, see InputImageCache and job_input_folder()"""
+    if digest:
+        return input_image_cache.path(name, digest)
+    return f"{folder}/{name}" if folder else name
+
+
+def stage_image(name, staging_folder, write, digest, folder=""):
+    """
+    Write an image into the input folder of ComfyUI and remember it in the input image cache
+
+    Args:
+        name (str): The name of the image
+        staging_folder (str): The staging folder of the job, see InputStaging.job_folder()
+        write (callable): Writes the content of the image into the file it gets
+        digest (str): Identifies the content for the input image cache, None to not remember it
+        folder (str): The folder of the job for images that are not remembered
+
+    Returns:
+        tuple: (success, message, path), see upload_image()
+    """
+    path = image_path(name, digest, folder)
+    try:
+        size = input_staging.stage(staging_folder, path, write)
+    except (OSError, ValueError) as e:
+        return False, f"Error uploading {name}: {e}", None
+    if digest:
+        input_image_cache.add(name, digest, size)
+    return True, f"Successfully uploaded {name} (written into the input folder)", path
+
+
+def send_image(name, blob, digest, timings, content_type="image/png", folder=""):
+    """
+    Upload an image file to ComfyUI and remember it in the input image cache
+
+    Args:
+        name (str): The name of the image
+        blob (file object): The content of the image
+        digest (str): Identifies the content for the input image cache, None to not remember it
+        timings (JobTimings): Records the "image_upload" stage.
+        content_type (str): The content type of the image
+        folder (str): The folder of the job for images that are not remembered
+
+    Returns:
+        tuple: (success, message, path), see upload_image()
+    """
+    path = image_path(name, digest, folder)
+    subfolder = os.path.dirname(path)
+    try:
+        size = blob.seek(0, os.SEEK_END)
+        # POST request to upload the image
+        with timings.measure("image_upload"):
+            response = comfy.upload_image(
+                os.path.basename(path), blob, content_type, subfolder=subfolder
+            )
+    except (OSError, requests.RequestException) as e:
+        return False, f"Error uploading {name}: {e}", None
+
+    if response.status_code != 200:
+        return False, f"Error uploading {name}: {response.text}", None
+    if digest:
+        input_image_cache.add(name, digest, size)
+    return True, f"Successfully uploaded {name}", path
+
+
+def upload_images(images, timings=None):
+    """
+    Upload a list of base64 encoded images to the ComfyUI server using the /upload/image endpoint.
+
+    Up to COMFY_UPLOAD_WORKERS images are decoded (or downloaded) and uploaded at the same time.
+    If the worker shares the input folder with ComfyUI, the images are written into it
+    instead, see InputStaging. Where the images end up is told by upload_input_images().
+
+    Args:
+        images (list): A list of dictionaries, each containing the 'name' of the image and the 'image' as a base64 encoded string or its 'url'.
+        timings (JobTimings, optional): Records the "image_decode", "image_download" and "image_upload" stages.
+
+    Returns:
+        dict: The status, a message and the details of every upload in the order of the images.
+    """
+    return upload_input_images(images, timings)[0]
+
+
+def upload_input_images(images, timings=None, job_id=None):
+    """
+    Like upload_images(), but also returns where every image is inside the input folder.
+
+    Args:
+        images (list): The images, see upload_images()
+        timings (JobTimings, optional): Records the stages, see upload_images()
+        job_id (str, optional): Puts the images that are not cached into the folder of
+                                this job, see job_input_folder(), instead of the input folder
+
+    Returns:
+        tuple: (result, paths) where result is the result of upload_images() and paths
+               maps the name of every image to its path, see point_to_images()
+    """
+    if not images:
+        return {
+            "status": "success",
+            "message": "No images to upload",
+            "details": [],
+        }, {}
+
+    print(f"runpod-worker-comfy - image(s) upload")
+
+    folder = job_input_folder(job_id) if job_id else ""
+    workers = max(min(COMFY_UPLOAD_WORKERS, len(images)), 1)
+    with input_staging.job_folder() as staging_folder, ThreadPoolExecutor(
+        max_workers=workers
+    ) as executor:
+        results = list(
+            executor.map(
+                lambda image: upload_image(image, timings, staging_folder, folder),
+                images,
+            )
+        )
+
+    responses = [message for success, message, _ in results if success]
+    upload_errors = [message for success, message, _ in results if not success]
+
+    if upload_errors:
+        print(f"runpod-worker-comfy - image(s) upload with errors")
+        return {
+            "status": "error",
+            "message": "Some images failed to upload",
+            "details": upload_errors,
+        }, {}
+
+    print(f"runpod-worker-comfy - image(s) upload complete")
+    paths = {image["name"]: path for image, (_, _, path) in zip(images, results)}
+    return {
+        "status": "success",
+        "message": "All images uploaded successfully",
+        "details": responses,
+    }, paths
+
+
+def point_to_images(workflow, paths):
+    """
+    Points the inputs of the workflow that name an input image to where it was uploaded.
+
+    Only the nodes that change are copied, the workflow and its nodes are left as they
+    are, because they may be shared with a template.
+
+    Args:
+        workflow (dict): The workflow in the API format
+        paths (dict): The path inside the input folder of every image name, see upload_input_images()
+
+    Returns:
+        dict: The workflow that references the uploaded images
+    """
+    paths = {name: path for name, path in paths.items() if name != path}
+    if not paths:
+        return workflow
+    workflow = dict(workflow)
+    for node_id, node in workflow.items():
+        inputs = node.get("inputs") if isinstance(node, dict) else None
+        if not isinstance(inputs, dict):
+            continue
+        changed = {
+            key: paths[value]
+            for key, value in inputs.items()
+            if isinstance(value, str) and value in paths
+        }
+        if changed:
+            workflow[node_id] = {**node, "inputs": {**inputs, **changed}}
+    return workflow
+
+
+def queue_workflow(workflow, client_id=None):
+    """
+    Queue a workflow to be processed by ComfyUI
+
+    Args:
+        workflow (dict): A dictionary containing the workflow to be processed
+        client_id (str, optional): The websocket client that should receive the execution events
+
+    Returns:
+        dict: The JSON response from ComfyUI after processing the workflow
+    """
+
+    return comfy.queue_prompt(workflow, client_id)
+
+
+def get_history(prompt_id):
+    """
+    Retrieve the history of a given prompt using its ID
+
+    Args:
+        prompt_id (str): The ID of the prompt whose history is to be retrieved
+
+    Returns:
+        dict: The history of the prompt, containing all the processing steps and results
+    """
+    return comfy.get_history(prompt_id)
+
+
+def open_websocket(client_id):
+    """
+    Open a websocket connection to ComfyUI to receive the execution events of our prompts
+
+    Args:
+        client_id (str): The ID that is also sent along with the prompt
+
+    Returns:
+        websocket.WebSocket: The connection, or None if the websocket is not available
+    """
+    if websocket is None:
+        print("runpod-worker-comfy - websocket-client is not installed, using polling")
+        return None
+
+    try:
+        ws = websocket.create_connection(
+            comfy.ws_url(client_id), timeout=COMFY_WEBSOCKET_RECV_TIMEOUT_S
+        )
+    except (websocket.WebSocketException, OSError) as e:
+        print(f"runpod-worker-comfy - websocket unavailable, using polling: {e}")
+        return None
+
+    return ws
+
+
+def iter_prompt_events(ws, prompt_id, deadline):
+    """
+    Yields the websocket events that ComfyUI sends for the prompt
+
+    Besides the events of ComfyUI, ("idle", None) is yielded whenever no message arrived
+    for COMFY_WEBSOCKET_RECV_TIMEOUT_S and ("disconnected", None) when the connection
+    dropped. Binary messages (previews) and events of other prompts are skipped.
+
+    Args:
+        ws (websocket.WebSocket): The open connection
+        prompt_id (str): The ID of the prompt
+        deadline (float): time.monotonic() value after which no more events are read
+
+    Yields:
+        tuple: (event_type, data)
+    """
+    while time.monotonic() < deadline:
+        try:
+            ws.settimeout(
+                min(
+                    COMFY_WEBSOCKET_RECV_TIMEOUT_S,
+                    max(deadline - time.monotonic(), 0.01),
+                )
+            )
+            message = ws.recv()
+        except websocket.WebSocketTimeoutException:
+            yield "idle", None
+            continue
+        except (websocket.WebSocketException, OSError) as e:
+            print(f"runpod-worker-comfy - websocket connection lost: {e}")
+            yield "disconnected", None
+            return
+
+        # Binary messages are previews, we don't need them
+        if not isinstance(message, str):
+            continue
+        if not message:
+            print("runpod-worker-comfy - websocket connection closed by ComfyUI")
+            yield "disconnected", None
+            return
+
+        event = json_loads(message)
+        data = event.get("data") or {}
+        if data.get("prompt_id") == prompt_id:
+            yield event.get("type"), data
+
+
+def get_queue_position(prompt_id):
+    """
+    Where the prompt is in the queue of ComfyUI
+
+    Args:
+        prompt_id (str): The ID of the prompt
+
+    Returns:
+        int: 0 if the prompt is running, n if it is the n-th pending prompt
+             or None if it isn't queued (anymore)
+    """
+    response = comfy.get("/queue")
+    response.raise_for_status()
+    # The queue has the whole workflow of every prompt, only parse it if ours is there
+    if prompt_id.encode("utf-8") not in response.content:
+        return None
+    queue = response_json(response)
+
+    if any(item[1] == prompt_id for item in queue.get("queue_running", [])):
+        return 0
+    pending = sorted(queue.get("queue_pending", []), key=lambda item: item[0])
+    for position, item in enumerate(pending, start=1):
+        if item[1] == prompt_id:
+            return position
+    return None
+
+
+def wait_for_prompt_polling(prompt_id, deadline):
+    """
+    Poll ComfyUI until the prompt is in the history or the deadline passed
+
+    While the prompt is queued, only its position in the queue is polled, the history
+    is fetched once it left the queue. The first poll happens after
+    COMFY_POLLING_MIN_INTERVAL_MS, the interval then grows by half up to
+    COMFY_POLLING_MAX_INTERVAL_MS, so short jobs are picked up right away and long jobs
+    don't flood ComfyUI. Whenever the prompt moves up in the queue (or starts running),
+    the interval is tight again. If the queue can't be read, the history is polled.
+
+    Args:
+        prompt_id (str): The ID of the prompt to wait for
+        deadline (float): time.monotonic() value after which polling stops
+
+    Returns:
+        dict: The history of the prompt, or None if the deadline passed
+    """
+    interval_ms = COMFY_POLLING_MIN_INTERVAL_MS
+    last_position = None
+
+    while True:
+        try:
+            position = get_queue_position(prompt_id)
+        except (requests.RequestException, ValueError, LookupError, TypeError):
+            position = -1
+
+        if position is None or position < 0:
+            history = get_history(prompt_id)
+            if prompt_id in history:
+                return history
+        elif last_position is not None and position < last_position:
+            interval_ms = COMFY_POLLING_MIN_INTERVAL_MS
+        last_position = position
+
+        # Wait before trying again
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            return None
+        time.sleep(min(interval_ms / 1000, remaining))
+        interval_ms = min(interval_ms * 1.5, COMFY_POLLING_MAX_INTERVAL_MS)
+
+
+def has_outputs(history, prompt_id):
+    return prompt_id in history and bool(history[prompt_id].get("outputs"))
+
+
+def execution_error_result(event_type, data):
+    """
+    Turns an "execution_error" or "execution_interrupted" message of ComfyUI into the result of the job
+
+    Args:
+        event_type (str): The type of the message
+        data (dict): The data of the message, from the websocket or the status of the history
+
+    Returns:
+        dict: {"error": message, "details": {...}} with the failed node and the exception
+    """
+    details = {
+        "type": event_type,
+        "node_id": data.get("node_id"),
+        "node_type": data.get("node_type"),
+    }
+    if event_type == "execution_interrupted":
+        return {"error": "ComfyUI execution was interrupted", "details": details}
+
+    details["exception_type"] = data.get("exception_type")
+    details["exception_message"] = data.get("exception_message", "unknown error")
+    return {
+        "error": f"ComfyUI execution error in node {details['node_id']} "
+        f"({details['node_type']}): {details['exception_message']}",
+        "details": details,
+    }
+
+
+def history_result(history, prompt_id):
+    """
+    Checks the history of a prompt that ComfyUI finished
+
+    A prompt failed if the status of its history says so, even if some output nodes
+    already produced images.
+
+    Args:
+        history (dict): The history that contains the prompt
+        prompt_id (str): The ID of the prompt
+
+    Returns:
+        tuple: (history, error_result), one of them is None
+    """
+    status = history[prompt_id].get("status") or {}
+    if status.get("status_str") == "error":
+        for event_type, data in reversed(status.get("messages") or []):
+            if event_type in ("execution_error", "execution_interrupted"):
+                return None, execution_error_result(event_type, data)
+        return None, {"error": "ComfyUI execution failed", "details": status}
+
+    if not has_outputs(history, prompt_id):
+        return None, {"error": "ComfyUI finished the prompt without any outputs"}
+
+    return history, None
+
+
+def watch_prompt(prompt_id, ws=None, deadline=None):
+    """
+    Follow the prompt until ComfyUI finished it
+
+    The websocket is used when available, as it reports the end of the prompt the moment
+    it happens: an "executing" message whose node is null (older versions of ComfyUI) or
+    an "execution_success" message. Failures are reported as "execution_error" or
+    "execution_interrupted". Whenever no message arrives for COMFY_WEBSOCKET_RECV_TIMEOUT_S,
+    the history is checked in case an event was missed. If there is no websocket or the
+    connection drops, the history is polled. Either way the job fails as soon as
+    ComfyUI reports that the prompt failed.
+
+    Args:
+        prompt_id (str): The ID of the prompt to wait for
+        ws (websocket.WebSocket, optional): A websocket that was opened before queuing the prompt
+        deadline (float, optional): time.monotonic() value after which waiting stops,
+                                    COMFY_JOB_TIMEOUT_S from now by default
+
+    Yields:
+        tuple: ("executing" | "progress" | "executed", data) for the websocket events of
+               the prompt and finally ("done", (history, error_result)), where one of
+               history and error_result ({"error": ...[, "details": ...]}) is None.
+    """
+    if deadline is None:
+        deadline = time.monotonic() + COMFY_JOB_TIMEOUT_S
+    timeout_result = {"error": "Timeout reached while waiting for image generation"}
+
+    if ws is not None:
+        finished = False
+        for event_type, data in iter_prompt_events(ws, prompt_id, deadline):
+            if event_type in ("execution_error", "execution_interrupted"):
+                yield "done", (None, execution_error_result(event_type, data))
+                return
+            if event_type == "execution_success" or (
+                event_type == "executing" and data.get("node") is None
+            ):
+                finished = True
+            elif event_type == "idle":
+                finished = prompt_id in get_history(prompt_id)
+            elif event_type in ("executing", "progress", "executed"):
+                yield event_type, data
+            if finished or event_type == "disconnected":
+                break
+        else:
+            yield "done", (None, timeout_result)
+            return
+
+        if finished:
+            history = get_history(prompt_id)
+            if prompt_id in history:
+                yield "done", history_result(history, prompt_id)
+                return
+        print("runpod-worker-comfy - falling back to polling the history")
+
+    history = wait_for_prompt_polling(prompt_id, deadline)
+    if history is None:
+        yield "done", (None, timeout_result)
+        return
+
+    yield "done", history_result(history, prompt_id)
+
+
+def cancel_prompt(prompt_id):
+    """
+    Removes the prompt from the queue of ComfyUI, or interrupts it if it is already
+    running, so that the next job doesn't have to wait for work that nobody collects.
+
+    The prompt is only interrupted if /queue reports it as running right before. Newer
+    ComfyUI versions only interrupt the prompt_id that is sent along, but ComfyUI 0.3.26
+    (see the Dockerfile) interrupts whatever runs. If the prompt finishes between the
+    check and the interrupt, the prompt of the next job is interrupted with it.
+
+    Args:
+        prompt_id (str): The ID of the prompt
+    """
+    try:
+        position = get_queue_position(prompt_id)
+        if position:
+            comfy.post("/queue", json={"delete": [prompt_id]})
+            # It may have started before it was deleted
+            position = get_queue_position(prompt_id)
+        if position == 0:
+            comfy.post("/interrupt", json={"prompt_id": prompt_id})
+            print(f"runpod-worker-comfy - interrupted prompt {prompt_id}")
+    except (requests.RequestException, ValueError, LookupError, TypeError) as e:
+        print(f"runpod-worker-comfy - could not cancel prompt {prompt_id}: {e}")
+
+
+def wait_for_completion(prompt_id, ws=None, deadline=None):
+    """
+    Wait until ComfyUI finished the prompt, see watch_prompt
+
+    Args:
+        prompt_id (str): The ID of the prompt to wait for
+        ws (websocket.WebSocket, optional): A websocket that was opened before queuing the prompt
+        deadline (float, optional): time.monotonic() value after which waiting stops
+
+    Returns:
+        tuple: (history, error_result), one of them is None
+    """
+    for event_type, data in watch_prompt(prompt_id, ws, deadline):
+        if event_type == "done":
+            return data
+
+
+def submit_workflow(workflow, client_id, timings):
+    """
+    Queues the workflow of a job in ComfyUI
+
+    Args:
+        workflow (dict): The workflow in the API format
+        client_id (str): The ID that the websocket of the job was opened with
+        timings (JobTimings): Records the time in "queue_submit"
+
+    Returns:
+        tuple: (prompt_id, error_result), one of them is None
+    """
+    try:
+        with timings.measure("queue_submit"):
+            prompt_id = queue_workflow(workflow, client_id)["prompt_id"]
+    except ComfyUIPromptError as e:
+        return None, {
+            "error": f"Error queuing workflow: {str(e)}",
+            "details": e.details,
+        }
+    except Exception as e:
+        return None, {"error": f"Error queuing workflow: {str(e)}"}
+    print(f"runpod-worker-comfy - queued workflow with ID {prompt_id}")
+    return prompt_id, None
+
+
+def follow_prompt(job_id, prompt_id, ws, deadline, timings, queued_after=()):
+    """
+    Yields the events of watch_prompt() for the prompt of a job
+
+    While it is followed, the prompt is in in_flight_prompts, so that cancel_job() can
+    cancel it. Only the time spent waiting for the next event counts as waiting for
+    ComfyUI. If no history came back, because the prompt failed, the job timed out or
+    the caller stopped reading, the prompt is cancelled so that it doesn't keep the GPU
+    busy. When the job timed out or was cancelled, the prompts that the job queued
+    after this one are removed first, so that ComfyUI doesn't start one of them instead.
+
+    Args:
+        job_id (str): The ID of the job
+        prompt_id (str): The ID of the prompt
+        ws (websocket.WebSocket): The websocket of the job or None
+        deadline (float): time.monotonic() value after which waiting stops
+        timings (JobTimings): Records the time in the queue and the execution
+        queued_after (list): The IDs of the later prompts of the job
+
+    Yields:
+        tuple: (event_type, data), see watch_prompt(). Errors while waiting are
+               reported in the final "done" event as well.
+
+    Returns:
+        str: "was cancelled" or "timed out" if the job stopped, otherwise None
+    """
+    in_flight_prompts[job_id] = prompt_id
+    events = watch_prompt(prompt_id, ws, deadline)
+    history = None
+    waited = 0
+    try:
+        while True:
+            resumed = time.monotonic()
+            try:
+                event_type, data = next(events)
+            except Exception as e:
+                error_result = {
+                    "error": f"Error waiting for image generation: {str(e)}"
+                }
+                event_type, data = "done", (None, error_result)
+            waited += time.monotonic() - resumed
+            if event_type == "done":
+                history = data[0]
+                yield event_type, data
+                break
+            yield event_type, data
+    finally:
+        timings.add_wait(waited, history, prompt_id)
+        cancelled = in_flight_prompts.pop(job_id, None) is None
+        stopped = None
+        if cancelled:
+            stopped = "was cancelled"
+        elif time.monotonic() >= deadline:
+            stopped = "timed out"
+        if stopped:
+            for later in queued_after:
+                cancel_prompt(later)
+        # cancel_job() already cancelled the prompt of a cancelled job
+        if not cancelled and history is None:
+            cancel_prompt(prompt_id)
+    return stopped
+
+
+def wait_for_job(job_id, prompt_id, ws, deadline, timings, queued_after=()):
+    """
+    Waits until ComfyUI finished the prompt of a job, see follow_prompt()
+
+    Returns:
+        tuple: (history, error_result, stopped), one of history and error_result is
+               None and stopped is the return value of follow_prompt()
+    """
     print(f"runpod-worker-comfy - wait until image generation is complete")
-    retries = 0
+    events = follow_prompt(job_id, prompt_id, ws, deadline, timings, queued_after)
+    history, error_result = None, None
+    while True:
+        try:
+            event_type, data = next(events)
+        except StopIteration as stop:
+            return history, error_result, stop.value
+        if event_type == "done":
+            history, error_result = data
+
+
+def base64_encode(img_path):
+    """
+    Returns base64 encoded image.
+
+    Args:
+        img_path (str): The path to the image
+
+    Returns:
+        str: The base64 encoded image
+    """
+    with open(img_path, "rb") as image_file:
+        return base64_encode_stream(image_file)
+
+
+def base64_encode_stream(stream):
+    """
+    Returns the base64 encoded content of a binary file object, read in chunks.
+
+    Reading the whole file and encoding it at once holds the file, the encoded bytes
+    and the decoded string at the same time, about 3x the size of the file. Here only
+    one chunk is read at a time and appended to the string, which CPython grows in
+    place, so the peak is about the size of the encoded string (4/3 of the file).
+
+    Args:
+        stream: The file object, like an open file or a BytesIO
+
+    Returns:
+        str: The base64 encoded content
+    """
+    encoded = ""
+    while True:
+        chunk = stream.read(BASE64_CHUNK_BYTES)
+        if not chunk:
+            return encoded
+        encoded += binascii.b2a_base64(chunk, newline=False).decode("ascii")
+
+
+def node_order(node_id):
+    """
+    Sort key for node IDs: numeric IDs in numeric order, followed by all other IDs.
+    """
+    return (0, int(node_id), "") if node_id.isdigit() else (1, 0, node_id)
+
+
+def collect_output_images(outputs):
+    """
+    Returns every file that the output nodes saved, in a deterministic order.
+
+    The nodes are sorted by their ID (numerically where possible), the files of a node
+    keep the order in which ComfyUI reported them, images before animations and videos
+    (see OUTPUT_KINDS). Temporary files, like the images of "PreviewImage" nodes, are
+    not written to the output folder and are skipped.
+
+    Args:
+        outputs (dict): The "outputs" of the prompt history, keyed by node ID
+
+    Returns:
+        list: (node_id, image) tuples, where image is the dict reported by ComfyUI
+    """
+
+    images = []
+    for node_id in sorted(outputs, key=node_order):
+        for kind in OUTPUT_KINDS:
+            for image in outputs[node_id].get(kind) or []:
+                if not isinstance(image, dict) or "filename" not in image:
+                    continue
+                if image.get("type", "output") == "temp":
+                    continue
+                images.append((node_id, image))
+    return images
+
+
+def transcode_image(img_path, options):
+    """
+    Re-encodes an image in another format, quality or size.
+
+    Args:
+        img_path (str): The path to the image
+        options (dict): The validated "output" options, see validate_output_options()
+
+    Returns:
+        tuple: (data, extension) with the bytes of the transcoded image and the file
+               extension that matches its format, like ".webp". None for animations,
+               which are returned as they are.
+    """
+    with Image.open(img_path) as img:
+        if getattr(img, "is_animated", False):
+            return None
+
+        img_format = OUTPUT_FORMATS.get(options.get("format")) or img.format or "PNG"
+
+        max_dimension = options.get("max_dimension")
+        if max_dimension and max(img.size) > max_dimension:
+            # Keeps the aspect ratio, images are never made larger
+            img.thumbnail((max_dimension, max_dimension), Image.LANCZOS)
+
+        # JPEG has no alpha channel and no palette
+        if img_format == "JPEG" and img.mode not in ("RGB", "L"):
+            img = img.convert("RGB")
+
+        save_options = {}
+        if "quality" in options and img_format != "PNG":
+            save_options["quality"] = options["quality"]
+
+        buffer = BytesIO()
+        img.save(buffer, format=img_format, **save_options)
+
+    return buffer.getvalue(), f".{img_format.lower()}"
+
+
+def upload_output_file(job_id, path):
+    """
+    Uploads an output file to the AWS S3 bucket.
+
+    Small images are uploaded by rp_upload in one request. Videos and every file that
+    is bigger than COMFY_S3_PART_SIZE_BYTES are streamed from disk as a multipart
+    upload with up to COMFY_S3_UPLOAD_CONCURRENCY parts in flight, so only about that
+    many parts are in memory at the same time, whatever the size of the file.
+
+    Args:
+        job_id (str): The unique identifier for the job.
+        path (str): The path to the file.
+
+    Returns:
+        str: The presigned URL of the file in the bucket
+    """
+    content_type = mimetypes.guess_type(path)[0] or "application/octet-stream"
+    if (
+        content_type.startswith("image/")
+        and os.path.getsize(path) <= COMFY_S3_PART_SIZE_BYTES
+    ):
+        return rp_upload.upload_image(job_id, path)
+
+    boto_client, _ = rp_upload.get_boto_client()
+    if boto_client is None:
+        # Without credentials rp_upload stores the file locally instead
+        return rp_upload.upload_image(job_id, path)
+
+    # Same bucket and key layout as rp_upload.upload_image()
+    bucket = time.strftime("%m-%y")
+    key = f"{job_id}/{str(uuid.uuid4())[:8]}{os.path.splitext(path)[1]}"
+    boto_client.upload_file(
+        path,
+        bucket,
+        key,
+        ExtraArgs={"ContentType": content_type},
+        Config=TransferConfig(
+            multipart_threshold=COMFY_S3_PART_SIZE_BYTES,
+            multipart_chunksize=COMFY_S3_PART_SIZE_BYTES,
+            max_concurrency=COMFY_S3_UPLOAD_CONCURRENCY,
+            use_threads=True,
+        ),
+    )
+    return boto_client.generate_presigned_url(
+        "get_object", Params={"Bucket": bucket, "Key": key}, ExpiresIn=604800
+    )
+
+
+def process_output_image(
+    job_id, node_id, image, output_path, use_bucket, options=None, timings=None
+):
+    """
+    Returns a single output file either as URL to the AWS S3 bucket or as base64 string.
+
+    Args:
+        job_id (str): The unique identifier for the job.
+        node_id (str): The node that created the image.
+        image (dict): The file as reported by ComfyUI, with "filename" and "subfolder".
+        output_path (str): The output folder of ComfyUI.
+        use_bucket (bool): Whether the file is uploaded to AWS S3.
+        options (dict, optional): The "output" options to transcode still images with.
+        timings (JobTimings, optional): Records the "output_encoding" and "s3_upload" stages.
+
+    Returns:
+        dict: The image with "node_id", "filename", "type" ("s3_url" or "base64") and "data",
+              or with an "error" if the file could not be processed, for example if
+              it is bigger than COMFY_BASE64_MAX_BYTES without a bucket. Transcoded images
+              also have the size of the image in ComfyUI ("original_bytes") and of the
+              returned image ("bytes").
+    """
+    if timings is None:
+        timings = JobTimings()
+    relative_path = os.path.join(image.get("subfolder", ""), image["filename"])
+    local_image_path = f"{output_path}/{relative_path}"
+    result = {"node_id": node_id, "filename": image["filename"]}
+
+    print(f"runpod-worker-comfy - {local_image_path}")
+
+    # The image is not in the output folder
+    if not os.path.exists(local_image_path):
+        result["error"] = (
+            f"the image does not exist in the specified output folder: {local_image_path}"
+        )
+        return result
+
     try:
-        while retries < COMFY_POLLING_MAX_RETRIES:
-            history = get_history(prompt_id)
+        transcoded = None
+        # Only still images are transcoded, animations and videos are returned as they are
+        content_type = mimetypes.guess_type(local_image_path)[0] or ""
+        if (
+            options
+            and content_type.startswith("image/")
+            and content_type != "image/gif"
+        ):
+            with timings.measure("output_encoding"):
+                transcoded = transcode_image(local_image_path, options)
+        if transcoded:
+            data, extension = transcoded
+            result["filename"] = os.path.splitext(image["filename"])[0] + extension
+            result["original_bytes"] = os.path.getsize(local_image_path)
+            result["bytes"] = len(data)
+
+        if use_bucket:
+            # URL to the file in AWS S3
+            result["type"] = "s3_url"
+            with timings.measure("s3_upload"):
+                if transcoded:
+                    # The content type is derived from the extension of the file
+                    folder = tempfile.mkdtemp()
+                    try:
+                        transcoded_path = os.path.join(folder, result["filename"])
+                        with open(transcoded_path, "wb") as f:
+                            f.write(data)
+                        result["data"] = upload_output_file(job_id, transcoded_path)
+                    finally:
+                        shutil.rmtree(folder, ignore_errors=True)
+                else:
+                    result["data"] = upload_output_file(job_id, local_image_path)
+        else:
+            # base64 file, as long as it fits into the response
+            result["type"] = "base64"
+            size = len(data) if transcoded else os.path.getsize(local_image_path)
+            if size > COMFY_BASE64_MAX_BYTES:
+                raise ValueError(
+                    f"{size} bytes are more than COMFY_BASE64_MAX_BYTES "
+                    f"({COMFY_BASE64_MAX_BYTES}), configure an AWS S3 bucket for big files"
+                )
+            with timings.measure("output_encoding"):
+                if transcoded:
+                    result["data"] = base64_encode_stream(BytesIO(data))
+                else:
+                    result["data"] = base64_encode(local_image_path)
+    except Exception as e:
+        result.pop("type", None)
+        result["error"] = f"Error processing {relative_path}: {e}"
+
+    return result
+
+
+def process_output_images(
+    outputs, job_id, output_path=None, options=None, timings=None
+):
+    """
+    This function takes the "outputs" from image generation and the job ID,
+    then determines the correct way to return the images, either as direct URLs
+    to an AWS S3 bucket or as base64 encoded strings, depending on the
+    environment configuration.
+
+    Args:
+        outputs (dict): A dictionary containing the outputs from image generation,
+                        typically includes node IDs and their respective output data.
+        job_id (str): The unique identifier for the job.
+        output_path (str, optional): Where the images are, the output folder of ComfyUI by default.
+        options (dict, optional): The "output" options of the job to transcode the images with.
+        timings (JobTimings, optional): Records the "output_encoding" and "s3_upload" stages.
+
+    Returns:
+        dict: A dictionary with the status ('success' or 'error'), the message and the
+              list of "images". The message is the first image (URL to the image in the
+              AWS S3 bucket or base64 encoded string), kept for clients that only expect
+              one image. Images that could not be processed are listed in "errors".
+              If no image could be processed, the message details the issue.
+
+    The function works as follows:
+    - It first determines the output path for the images from an environment variable,
+      defaulting to "/comfyui/output" if not set.
+    - It then collects every image, animation and video of every output node, ordered by node ID.
+    - It checks if the AWS S3 bucket is configured via the BUCKET_ENDPOINT_URL environment variable.
+    - Every image is then, in parallel with up to COMFY_OUTPUT_WORKERS threads, transcoded
+      if the job asked for it and either uploaded to the bucket (returning the URL) or
+      encoded in base64.
+    - If a file does not exist in the output folder or is too big for base64, an error is
+      reported for it.
+    """
+
+    # The path where ComfyUI stores the generated images
+    if output_path is None:
+        output_path = os.environ.get("COMFY_OUTPUT_PATH", "/comfyui/output")
+    use_bucket = bool(os.environ.get("BUCKET_ENDPOINT_URL", False))
+
+    output_images = collect_output_images(outputs)
+
+    print(f"runpod-worker-comfy - image generation is done")
+
+    if not output_images:
+        return {"status": "error", "message": "the workflow did not produce any images"}
+
+    workers = max(min(COMFY_OUTPUT_WORKERS, len(output_images)), 1)
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        results = list(
+            executor.map(
+                lambda item: process_output_image(
+                    job_id, item[0], item[1], output_path, use_bucket, options, timings
+                ),
+                output_images,
+            )
+        )
+
+    images = [result for result in results if "error" not in result]
+    errors = [result["error"] for result in results if "error" in result]
+
+    if not images:
+        print("runpod-worker-comfy - the image does not exist in the output folder")
+        return {"status": "error", "message": errors[0], "errors": errors}
+
+    destination = "uploaded to AWS S3" if use_bucket else "converted to base64"
+    print(
+        f"runpod-worker-comfy - {len(images)} image(s) were generated and {destination}"
+    )
+
+    result = {"status": "success", "message": images[0]["data"], "images": images}
+    if errors:
+        result["errors"] = errors
+    return result
+
+
+def merge_output_results(results):
+    """
+    Merge the results of several process_output_images() calls into one, ordered by node ID.
+
+    Args:
+        results (list): The results of process_output_images()
+
+    Returns:
+        dict: The merged result with the same structure as process_output_images()
+    """
+    # The images of one node are already in order, sorted() keeps them that way
+    images = sorted(
+        (image for result in results for image in result.get("images", [])),
+        key=lambda image: node_order(image["node_id"]),
+    )
+    errors = [error for result in results for error in result.get("errors", [])]
+
+    if not images:
+        return {
+            "status": "error",
+            "message": (
+                errors[0] if errors else "the workflow did not produce any images"
+            ),
+            "errors": errors,
+        }
+
+    merged = {
+        "status": "success",
+        "message": next((image["data"] for image in images if "data" in image), None),
+        "images": images,
+    }
+    if errors:
+        merged["errors"] = errors
+    return merged
+
+
+def uses_random_seed(workflow):
+    """
+    Whether the outputs of the workflow are random, so they must not come from the result cache
+
+    A seed that isn't a fixed number, like -1 which many nodes treat as "random", or a
+    "randomize" control makes the workflow random.
+
+    Args:
+        workflow (dict): The workflow in the API format
+
+    Returns:
+        bool: True if the workflow uses a randomized seed
+    """
+    for node in workflow.values():
+        inputs = node.get("inputs", {}) if isinstance(node, dict) else {}
+        for name, value in inputs.items():
+            if value == "randomize":
+                return True
+            if "seed" not in name.lower() or is_link(value):
+                continue
+            if isinstance(value, bool) or not isinstance(value, int) or value < 0:
+                return True
+    return False
+
+
+def result_cache_key(workflow, images):
+    """
+    The key of the result cache: a hash of the canonical JSON of the workflow and
+    the names and content hashes of the input images.
+
+    Args:
+        workflow (dict): The workflow in the API format
+        images (list): The input images with "name" and "image" (base64)
+
+    Returns:
+        str: The SHA-256 hex digest
+    """
+    digest = hashlib.sha256()
+    digest.update(json_dumps(workflow, sort_keys=True))
+    for name, image_digest in sorted(
+        (image["name"], hash_base64(image["image"])) for image in images or []
+    ):
+        digest.update(f"\n{name}:{image_digest}".encode("utf-8"))
+    return digest.hexdigest()
+
+
+class ResultCache:
+    """
+    On-disk store of the output images of finished jobs, for jobs that are exact repeats.
+
+    Every entry is a folder named after the result_cache_key of the job, which contains
+    the output files as ComfyUI wrote them and an outputs.json with the outputs of the
+    history, so a hit is processed (encoded or uploaded) exactly like a fresh result.
+    Entries expire after ttl seconds and the least recently used ones are evicted once
+    the total size is above max_bytes. The index is rebuilt from disk on start.
+
+    Args:
+        path (str): Folder of the cache
+        max_bytes (int): Maximum total size of the cached files
+        ttl (float): Seconds after which an entry is not used anymore
+    """
+
+    def __init__(
+        self,
+        path=COMFY_RESULT_CACHE_PATH,
+        max_bytes=COMFY_RESULT_CACHE_MAX_BYTES,
+        ttl=COMFY_RESULT_CACHE_TTL_S,
+    ):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.total_bytes = 0
+        self.lookups = 0
+        self.hits = 0
+        self.bytes_saved = 0
+        # key -> (size, created)
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._load_index()
+
+    def _load_index(self):
+        try:
+            names = os.listdir(self.path)
+        except OSError:
+            return
+        entries = []
+        for key in names:
+            index_file = os.path.join(self.path, key, "outputs.json")
+            if not os.path.isfile(index_file):
+                continue
+            size = sum(
+                os.path.getsize(os.path.join(root, name))
+                for root, _, files in os.walk(os.path.join(self.path, key))
+                for name in files
+            )
+            entries.append((os.path.getmtime(index_file), key, size))
+        for created, key, size in sorted(entries):
+            self._entries[key] = (size, created)
+            self.total_bytes += size
+
+    def get(self, key):
+        """
+        Returns (outputs, folder, size) of the entry, or None if there is no valid entry.
+        """
+        with self._lock:
+            self.lookups += 1
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            if time.time() - entry[1] > self.ttl:
+                self._remove(key)
+                return None
+            try:
+                with open(os.path.join(self.path, key, "outputs.json"), "rb") as f:
+                    outputs = json_loads(f.read())
+            except (OSError, ValueError):
+                self._remove(key)
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            self.bytes_saved += entry[0]
+            return outputs, os.path.join(self.path, key), entry[0]
+
+    def put(self, key, outputs, output_path):
+        """
+        Copies the output images of a finished job into the cache.
+
+        Args:
+            key (str): The result_cache_key of the job
+            outputs (dict): The outputs of the history of the prompt
+            output_path (str): The output folder of ComfyUI
+        """
+        images = collect_output_images(outputs)
+        staging = os.path.join(self.path, f".{key}-{uuid.uuid4().hex}")
+        size = 0
+        try:
+            for _, image in images:
+                relative_path = os.path.join(
+                    image.get("subfolder", ""), image["filename"]
+                )
+                target = os.path.join(staging, relative_path)
+                os.makedirs(os.path.dirname(target), exist_ok=True)
+                shutil.copyfile(os.path.join(output_path, relative_path), target)
+                size += os.path.getsize(target)
+            if size > self.max_bytes:
+                shutil.rmtree(staging, ignore_errors=True)
+                return
+            with open(os.path.join(staging, "outputs.json"), "wb") as f:
+                f.write(json_dumps(outputs))
+
+            with self._lock:
+                self._remove(key)
+                os.replace(staging, os.path.join(self.path, key))
+                self._entries[key] = (size, time.time())
+                self.total_bytes += size
+                while self.total_bytes > self.max_bytes:
+                    self._remove(next(iter(self._entries)))
+        except OSError as e:
+            shutil.rmtree(staging, ignore_errors=True)
+            print(f"runpod-worker-comfy - could not cache the result: {e}")
+
+    def stats(self, hit):
+        """The statistics of the cache that are added to the job response"""
+        return {
+            "hit": hit,
+            "hit_rate": round(self.hits / self.lookups, 4) if self.lookups else 0.0,
+            "bytes_saved": self.bytes_saved,
+        }
+
+    def _remove(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self.total_bytes -= entry[0]
+        shutil.rmtree(os.path.join(self.path, key), ignore_errors=True)
+
+
+# Outputs of earlier jobs, only used if COMFY_RESULT_CACHE is enabled
+result_cache = ResultCache() if COMFY_RESULT_CACHE else None
+
+
+class MemoryPolicy:
+    """
+    Decides after every job whether ComfyUI should release memory through /free, so that
+    VRAM and RAM don't creep up without restarting the whole worker (REFRESH_WORKER).
+
+    The decision is based on /system_stats: once a GPU has less than vram_below_mb of
+    free VRAM, the models are unloaded, unless every model of the job is hot, i.e. was
+    used by at least hot_jobs of the last HOT_MODELS_WINDOW jobs, so the models that
+    most jobs need stay loaded. Once more than ram_above_percent of the RAM is used, the
+    cached node outputs are freed. ComfyUI releases the memory between prompts, so
+    nothing is freed while other jobs of the worker are in flight. The decision, the
+    memory since the last job and the memory that was freed are logged, to tune the
+    thresholds.
+
+    Args:
+        vram_below_mb (int): Free VRAM in MiB below which the models are unloaded
+        ram_above_percent (float): Used RAM in percent above which memory is freed
+        hot_jobs (int): Number of recent jobs that make a model hot
+        settle_s (float): Seconds to wait before the freed memory is logged
+    """
+
+    def __init__(
+        self,
+        vram_below_mb=COMFY_FREE_VRAM_BELOW_MB,
+        ram_above_percent=COMFY_FREE_RAM_ABOVE_PERCENT,
+        hot_jobs=COMFY_HOT_MODEL_JOBS,
+        settle_s=FREE_MEMORY_SETTLE_S,
+    ):
+        self.vram_below_mb = vram_below_mb
+        self.ram_above_percent = ram_above_percent
+        self.hot_jobs = hot_jobs
+        self.settle_s = settle_s
+        self.recent_models = deque(maxlen=HOT_MODELS_WINDOW)
+        self.last_stats = None
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self):
+        return bool(self.vram_below_mb or self.ram_above_percent)
+
+    @staticmethod
+    def models_of(workflow):
+        """The model files that the nodes of the workflow load"""
+        models = set()
+        if not isinstance(workflow, dict):
+            return models
+        for node in workflow.values():
+            inputs = node.get("inputs") if isinstance(node, dict) else None
+            if not isinstance(inputs, dict):
+                continue
+            for value in inputs.values():
+                if isinstance(value, str) and value.lower().endswith(MODEL_EXTENSIONS):
+                    models.add(value)
+        return models
+
+    def is_hot(self, models):
+        """Whether every one of the models was used by at least hot_jobs recent jobs"""
+        if not models or not self.hot_jobs:
+            return False
+        return all(
+            sum(model in used for used in self.recent_models) >= self.hot_jobs
+            for model in models
+        )
+
+    def read_stats(self):
+        """
+        Returns the used RAM in percent and the free VRAM in MiB of the GPU with the least
+        free VRAM (None without a GPU), from /system_stats.
+        """
+        response = comfy.get("/system_stats", retries=0)
+        response.raise_for_status()
+        stats = response_json(response)
+        system = stats.get("system", {})
+        ram_total = system.get("ram_total") or 0
+        vram_free = [
+            device["vram_free"]
+            for device in stats.get("devices", [])
+            if device.get("type") != "cpu" and "vram_free" in device
+        ]
+        return {
+            "ram_used_percent": (
+                (ram_total - system.get("ram_free", 0)) / ram_total * 100
+                if ram_total
+                else None
+            ),
+            "vram_free_mb": min(vram_free) / 2**20 if vram_free else None,
+        }
+
+    def decide(self, stats, models):
+        """
+        Returns:
+            tuple: The body for /free, or None to keep everything, and the reason
+        """
+        vram_free = stats["vram_free_mb"]
+        ram_used = stats["ram_used_percent"]
+        # A threshold of 0 is disabled
+        vram_low = vram_free is not None and vram_free < self.vram_below_mb
+        ram_high = ram_used is not None and ram_used > (self.ram_above_percent or 100)
+        unload = vram_low and not self.is_hot(models)
+
+        reasons = []
+        if vram_low:
+            reasons.append(
+                f"free VRAM {vram_free:.0f} MiB < {self.vram_below_mb} MiB"
+                + ("" if unload else ", but the models are hot")
+            )
+        if ram_high:
+            reasons.append(f"used RAM {ram_used:.1f}% > {self.ram_above_percent:g}%")
+        if not (unload or ram_high):
+            return None, "; ".join(reasons) or "enough memory"
+        return {"unload_models": unload, "free_memory": ram_high}, "; ".join(reasons)
+
+    def after_job(self, workflow):
+        """
+        Records the models of a finished job and releases memory if the thresholds are
+        crossed.
+
+        Args:
+            workflow (dict): The workflow of the job
+
+        Returns:
+            dict: The body that was sent to /free, or None
+        """
+        with self._lock:
+            self.recent_models.append(self.models_of(workflow))
+            if in_flight_prompts:
+                print("runpod-worker-comfy - memory: other jobs are running, keep all")
+                return None
+            try:
+                stats = self.read_stats()
+                payload, reason = self.decide(stats, models=self.recent_models[-1])
+                if payload:
+                    comfy.post("/free", json=payload, retries=0).raise_for_status()
+            except (requests.RequestException, ValueError) as e:
+                print(f"runpod-worker-comfy - memory: could not check or free: {e}")
+                return None
+            last_stats, self.last_stats = self.last_stats, stats
+
+        action = "keep all"
+        if payload:
+            action = " and ".join(
+                name for name in ("unload_models", "free_memory") if payload[name]
+            )
+        print(
+            f"runpod-worker-comfy - memory after the job: "
+            f"{describe_memory(stats, last_stats)}, {action} ({reason})"
+        )
+        if payload:
+            # ComfyUI frees the memory in its prompt loop, give it a moment
+            threading.Thread(target=self._log_freed, args=(stats,), daemon=True).start()
+        return payload
+
+    def _log_freed(self, before):
+        time.sleep(self.settle_s)
+        try:
+            stats = self.read_stats()
+        except (requests.RequestException, ValueError):
+            return
+        with self._lock:
+            self.last_stats = stats
+        print(
+            f"runpod-worker-comfy - memory after /free: {describe_memory(stats, before)}"
+        )
+
+
+def describe_memory(stats, before=None):
+    """
+    Formats the memory of read_stats() and, in brackets, its change compared to before,
+    for the log.
+    """
+    parts = []
+    for key, label, unit, digits in (
+        ("vram_free_mb", "free VRAM", " MiB", 0),
+        ("ram_used_percent", "used RAM", "%", 1),
+    ):
+        value = stats[key]
+        if value is None:
+            continue
+        text = f"{label} {value:.{digits}f}{unit}"
+        if before and before[key] is not None:
+            text += f" ({value - before[key]:+.{digits}f}{unit})"
+        parts.append(text)
+    return ", ".join(parts) or "no memory stats"
+
+
+# Releases memory between jobs, only used if a threshold is configured
+memory_policy = MemoryPolicy()
+
+
+class JobTimings:
+    """
+    The seconds that a job spent in each of its stages, measured with time.monotonic().
+
+    The stages are "validation", "server_check", "workflow_validation", "image_decode",
+    "image_upload", "queue_submit", "queue_wait", "execution", "output_encoding" and
+    "s3_upload". Stages that run for several images at the same time (decoding,
+    uploading and encoding) add up the seconds of every image, so they can be longer
+    than the job itself.
+    """
+
+    def __init__(self):
+        self.started = time.monotonic()
+        self.stages = {}
+        self._lock = threading.Lock()
+
+    def add(self, stage, seconds):
+        with self._lock:
+            self.stages[stage] = self.stages.get(stage, 0) + seconds
+
+    @contextmanager
+    def measure(self, stage):
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            self.add(stage, time.monotonic() - started)
+
+    def add_wait(self, seconds, history=None, prompt_id=None):
+        """
+        Splits the time spent waiting for ComfyUI into "queue_wait" and "execution".
+
+        ComfyUI records when it started and finished the prompt in the history. Without
+        these timestamps the whole wait counts as "execution".
+        """
+        execution = None
+        if history and prompt_id in history:
+            timestamps = {
+                message[0]: message[1].get("timestamp")
+                for message in history[prompt_id].get("status", {}).get("messages", [])
+                if isinstance(message, list) and len(message) == 2
+            }
+            start = timestamps.get("execution_start")
+            end = next(
+                (
+                    timestamps[event]
+                    for event in (
+                        "execution_success",
+                        "execution_error",
+                        "execution_interrupted",
+                    )
+                    if timestamps.get(event) is not None
+                ),
+                None,
+            )
+            if start is not None and end is not None:
+                execution = min(max((end - start) / 1000, 0), seconds)
+
+        if execution is None:
+            self.add("execution", seconds)
+        else:
+            self.add("queue_wait", seconds - execution)
+            self.add("execution", execution)
+
+    def as_dict(self):
+        """
+        Returns:
+            dict: The seconds of every stage that the job went through and the "total"
+        """
+        with self._lock:
+            timings = {
+                stage: round(seconds, 4) for stage, seconds in self.stages.items()
+            }
+        timings["total"] = round(time.monotonic() - self.started, 4)
+        return timings
+
+
+class StageMetrics:
+    """
+    Histograms of the seconds that jobs spent in each stage, in the Prometheus text format.
+
+    The histograms are cumulative since the worker started, like every Prometheus
+    histogram, the rate over any window can be computed from them by Prometheus.
+    """
+
+    def __init__(self, buckets=METRICS_BUCKETS_S):
+        self.buckets = buckets
+        self.startup = {}
+        self._histograms = {}
+        self._lock = threading.Lock()
+
+    def observe_startup(self, phase, seconds):
+        """
+        Records the seconds from the start of the worker until a phase of the cold start
+        ("comfyui_ready", "warmup" or "first_job") was done, only the first time.
+
+        Returns:
+            bool: Whether this was the first time
+        """
+        with self._lock:
+            if phase in self.startup:
+                return False
+            self.startup[phase] = seconds
+            return True
+
+    def observe(self, timings):
+        """
+        Args:
+            timings (dict): The seconds of every stage, see JobTimings.as_dict()
+        """
+        with self._lock:
+            for stage, seconds in timings.items():
+                histogram = self._histograms.setdefault(
+                    stage, {"buckets": [0] * len(self.buckets), "sum": 0, "count": 0}
+                )
+                for i, bound in enumerate(self.buckets):
+                    if seconds <= bound:
+                        histogram["buckets"][i] += 1
+                histogram["sum"] += seconds
+                histogram["count"] += 1
 
-            # Exit the loop if we have found the history
-            if prompt_id in history and history[prompt_id].get("outputs"):
-                break
-            else:
-                # Wait before trying again
-                time.sleep(COMFY_POLLING_INTERVAL_MS / 1000)
-                retries += 1
-        else:
-            return {"error": "Max retries reached while waiting for image generation"}
-    except Exception as e:
-        return {"error": f"Error waiting for image generation: {str(e)}"}
+    def render(self):
+        """
+        Returns:
+            str: The histograms in the Prometheus text exposition format
+        """
+        name = "comfy_worker_stage_seconds"
+        lines = [
+            f"# HELP {name} Seconds that the jobs spent in each stage.",
+            f"# TYPE {name} histogram",
+        ]
+        with self._lock:
+            for stage in sorted(self._histograms):
+                histogram = self._histograms[stage]
+                for bound, count in zip(self.buckets, histogram["buckets"]):
+                    lines.append(
+                        f'{name}_bucket{{stage="{stage}",le="{bound:g}"}} {count}'
+                    )
+                lines.append(
+                    f'{name}_bucket{{stage="{stage}",le="+Inf"}} {histogram["count"]}'
+                )
+                lines.append(f'{name}_sum{{stage="{stage}"}} {histogram["sum"]:.6f}')
+                lines.append(f'{name}_count{{stage="{stage}"}} {histogram["count"]}')
+
+            if self.startup:
+                name = "comfy_worker_startup_seconds"
+                lines.append(
+                    f"# HELP {name} Seconds from the start of the worker until each "
+                    "phase of the cold start was done."
+                )
+                lines.append(f"# TYPE {name} gauge")
+                for phase, seconds in self.startup.items():
+                    lines.append(f'{name}{{phase="{phase}"}} {seconds:.3f}')
+        return "\n".join(lines) + "\n"
+
+    def write(self, path):
+        """
+        Writes the histograms to a file, replacing it at once, so that readers (like the
+        textfile collector of the Prometheus node exporter) never see a partial file.
+        """
+        folder = os.path.dirname(os.path.abspath(path))
+        os.makedirs(folder, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=folder, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "w") as f:
+                f.write(self.render())
+            os.replace(tmp_path, path)
+        except OSError:
+            os.unlink(tmp_path)
+            raise
+
+
+# The stage histograms of every job that this worker ran
+metrics = StageMetrics()
+
+
+def finish_job(result, timings):
+    """
+    Adds the timings of a finished job to the metrics and, if COMFY_TIMINGS is enabled,
+    to its result. The timings of the first job of the worker also contain the seconds
+    since the worker started ("cold_start").
+
+    Args:
+        result (dict): The result of the job
+        timings (JobTimings): The timings of the job
+
+    Returns:
+        dict: The result
+    """
+    job_timings = timings.as_dict()
+    metrics.observe(job_timings)
+    cold_start = time.monotonic() - WORKER_STARTED
+    if metrics.observe_startup("first_job", cold_start):
+        print(
+            f"runpod-worker-comfy - the first job finished {cold_start:.1f} s after the "
+            f"worker started ({metrics.startup})"
+        )
+        job_timings["cold_start"] = round(cold_start, 4)
+    if COMFY_METRICS_FILE:
+        try:
+            metrics.write(COMFY_METRICS_FILE)
+        except OSError as e:
+            print(f"runpod-worker-comfy - could not write the metrics: {e}")
+    if COMFY_TIMINGS:
+        return {**result, "timings": job_timings}
+    return result
+
+
+def release_memory(job_input, timings):
+    """
+    Lets the memory policy release the memory of ComfyUI after a job, see MemoryPolicy.
+    Does nothing if the worker is refreshed after the job anyway.
+
+    Args:
+        job_input (dict): The validated input of the finished job
+        timings (JobTimings): The timings of the job
+    """
+    if REFRESH_WORKER or not memory_policy.enabled:
+        return
+    # The models of a batch are those of its first variant
+    workflow = (job_input.get("variants") or [job_input["workflow"]])[0]
+    with timings.measure("memory_release"):
+        memory_policy.after_job(workflow)
+
+
+class _MetricsRequestHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?")[0] != "/metrics":
+            self.send_error(404)
+            return
+        body = metrics.render().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def start_metrics_server(port):
+    """
+    Serves the stage histograms on http://0.0.0.0:{port}/metrics in a background thread.
+
+    Args:
+        port (int): The port to listen on
+
+    Returns:
+        ThreadingHTTPServer: The running server
+    """
+    server = ThreadingHTTPServer(("0.0.0.0", port), _MetricsRequestHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    print(f"runpod-worker-comfy - serving metrics on port {server.server_address[1]}")
+    return server
+
+
+def cached_result(job_id, job_input, timings=None):
+    """
+    Looks up the result of an identical earlier job in the result cache.
+
+    Args:
+        job_id (str): The unique identifier for the job.
+        job_input (dict): The validated input of the job.
+        timings (JobTimings, optional): Records the stages of returning the cached outputs.
+
+    Returns:
+        tuple: (cache_key, result) where cache_key is None if the job must not use the cache
+               and result is the result to return if there was a hit, otherwise None.
+    """
+    if result_cache is None:
+        return None, None
+    if uses_random_seed(job_input["workflow"]):
+        return None, None
+    # What a URL points to can change while the job stays the same
+    if any("image" not in image for image in job_input.get("images") or []):
+        return None, None
+
+    key = result_cache_key(job_input["workflow"], job_input.get("images"))
+    entry = result_cache.get(key)
+    if entry is None:
+        return key, None
+
+    outputs, folder, size = entry
+    print(
+        f"runpod-worker-comfy - returning the cached result {key[:12]} ({size} bytes)"
+    )
+    result = process_output_images(
+        outputs, job_id, folder, job_input.get("output"), timings
+    )
+    if result["status"] != "success":
+        return key, None
+    return key, {**result, "cache": result_cache.stats(True)}
+
+
+def store_result(cache_key, result, outputs):
+    """
+    Stores the outputs of a successful job in the result cache and adds the statistics
+    of the cache to the result.
+
+    Args:
+        cache_key (str): The key from cached_result(), None if the job doesn't use the cache
+        result (dict): The result of process_output_images()
+        outputs (dict): The outputs of the history of the prompt
+
+    Returns:
+        dict: The result
+    """
+    if cache_key is None:
+        return result
+    if result.get("status") == "success" and not result.get("errors"):
+        result_cache.put(
+            cache_key, outputs, os.environ.get("COMFY_OUTPUT_PATH", "/comfyui/output")
+        )
+    return {**result, "cache": result_cache.stats(False)}
+
+
+def prepare_job(job_input, timings=None, job_id=None):
+    """
+    Makes sure that ComfyUI is ready for the job and uploads the input images.
+
+    Args:
+        job_input (dict): The validated input of the job.
+        timings (JobTimings, optional): Records the stages of the preparation.
+        job_id (str, optional): The job that the images belong to, see upload_input_images()
+
+    Returns:
+        tuple: (job_input, error_result) where job_input is the input with the workflow
+               (or its variants) pointing to the uploaded images, and error_result is the
+               result to return if the job can't be run, otherwise None.
+    """
+    if timings is None:
+        timings = JobTimings()
+
+    # Fail fast if ComfyUI is down, this doesn't send a request while it is up
+    with timings.measure("server_check"):
+        error_message = readiness.check()
+    if error_message:
+        return job_input, {"error": error_message}
+
+    # Upload images if they exist
+    upload_result, paths = upload_input_images(job_input.get("images"), timings, job_id)
+
+    if upload_result["status"] == "error":
+        return job_input, upload_result
+
+    job_input = {**job_input, "workflow": point_to_images(job_input["workflow"], paths)}
+    if "variants" in job_input:
+        job_input["variants"] = [
+            point_to_images(workflow, paths) for workflow in job_input["variants"]
+        ]
+
+    # Reject broken workflows before they reach the queue of ComfyUI, once the images
+    # they reference are in the input folder
+    if COMFY_VALIDATE_WORKFLOW:
+        workflows = job_input.get("variants") or [job_input["workflow"]]
+        template = job_input.get("template")
+        input_files = set(paths.values())
+        for index, workflow in enumerate(workflows):
+            with timings.measure("workflow_validation"):
+                if template:
+                    error_result = template.validate(workflow, input_files)
+                else:
+                    error_result = workflow_validator.validate(
+                        workflow, input_files=input_files
+                    )
+            if error_result:
+                if "variants" in job_input:
+                    error_result = {
+                        **error_result,
+                        "error": f"Variant {index}: {error_result['error']}",
+                    }
+                return job_input, error_result
+
+    return job_input, None
+
+
+def load_warmup_inputs(paths=COMFY_WARMUP_WORKFLOWS):
+    """
+    Reads the inputs of the warmup workflows.
+
+    Args:
+        paths (str): Comma separated JSON files, each with one {"input": ...} object
+                     (like test_input.json) or a list of them. Missing files are skipped.
+
+    Returns:
+        list: The "input" of every warmup job
+    """
+    inputs = []
+    for path in filter(None, (path.strip() for path in paths.split(","))):
+        if not os.path.exists(path):
+            print(f"runpod-worker-comfy - no warmup workflows at {path}")
+            continue
+        try:
+            with open(path, "rb") as f:
+                content = json_loads(f.read())
+        except (OSError, ValueError) as e:
+            print(
+                f"runpod-worker-comfy - could not read the warmup workflows {path}: {e}"
+            )
+            continue
+        for job in content if isinstance(content, list) else [content]:
+            if isinstance(job, dict) and "input" in job:
+                inputs.append(job["input"])
+    return inputs
+
+
+def remove_outputs(outputs):
+    """
+    Deletes the files that a prompt wrote to the output folder of ComfyUI.
+    """
+    output_path = os.environ.get("COMFY_OUTPUT_PATH", "/comfyui/output")
+    for _, image in collect_output_images(outputs or {}):
+        try:
+            os.remove(
+                os.path.join(output_path, image.get("subfolder", ""), image["filename"])
+            )
+        except OSError:
+            pass
+
+
+def warmup(inputs):
+    """
+    Runs the warmup workflows through ComfyUI, one after the other, before the worker
+    takes jobs, so that loading the models, initializing CLIP and VAE and compiling
+    the CUDA kernels doesn't add to the latency of the first job. The outputs of the
+    warmup workflows are deleted. A workflow that fails is reported and skipped.
+
+    Args:
+        inputs (list): The inputs of the warmup jobs, see load_warmup_inputs()
+    """
+    if not inputs:
+        return
+    error_message = readiness.check()
+    if error_message:
+        print(f"runpod-worker-comfy - skipping the warmup: {error_message}")
+        return
+
+    for index, job_input in enumerate(inputs, start=1):
+        started = time.monotonic()
+        job_input, error_message = validate_input(job_input)
+        if error_message:
+            print(f"runpod-worker-comfy - warmup workflow {index}: {error_message}")
+            continue
+        job_id = f"warmup-{index}"
+        upload_result, paths = upload_input_images(
+            job_input.get("images"), job_id=job_id
+        )
+        if upload_result["status"] == "error":
+            print(f"runpod-worker-comfy - warmup workflow {index}: {upload_result}")
+            continue
+
+        prompt_id, history, error_result = None, None, None
+        try:
+            workflow = point_to_images(job_input["workflow"], paths)
+            prompt_id = queue_workflow(workflow)["prompt_id"]
+            history, error_result = wait_for_completion(
+                prompt_id, deadline=started + COMFY_WARMUP_TIMEOUT_S
+            )
+        except Exception as e:
+            error_result = {"error": str(e)}
+        if prompt_id and history is None:
+            # Don't keep the GPU busy with a warmup that we gave up on
+            cancel_prompt(prompt_id)
+        input_staging.remove_job_inputs(job_id)
+        if error_result:
+            print(
+                f"runpod-worker-comfy - warmup workflow {index} failed: {error_result}"
+            )
+            continue
+
+        remove_outputs(history[prompt_id].get("outputs"))
+        print(
+            f"runpod-worker-comfy - warmup workflow {index} took "
+            f"{time.monotonic() - started:.1f} s"
+        )
+
+    metrics.observe_startup("warmup", time.monotonic() - WORKER_STARTED)
+
+
+def handler(job):
+    """
+    The main function that handles a job of generating an image.
+
+    This function validates the input, sends a prompt to ComfyUI for processing,
+    waits for ComfyUI to finish (websocket events, falling back to polling) and
+    retrieves generated images. The stages of the job are timed, see finish_job(), and
+    ComfyUI may release memory afterwards, see release_memory().
+
+    Args:
+        job (dict): A dictionary containing job details and input parameters.
+
+    Returns:
+        dict: A dictionary containing either an error message or a success status with generated images.
+    """
+    timings = JobTimings()
+
+    # Make sure that the input is valid
+    with timings.measure("validation"):
+        job_input, error_message = validate_input(job["input"])
+    if error_message:
+        return finish_job({"error": error_message}, timings)
+
+    result = run_job(job, job_input, timings)
+    input_staging.remove_job_inputs(job["id"])
+    release_memory(job_input, timings)
+    return finish_job(result, timings)
+
+
+def run_job(job, job_input, timings):
+    """
+    Runs a job for handler().
+
+    Args:
+        job (dict): A dictionary containing job details and input parameters.
+        job_input (dict): The validated input of the job.
+        timings (JobTimings): Records the stages of the job.
+
+    Returns:
+        dict: A dictionary containing either an error message or a success status with generated images.
+    """
+    if "variants" in job_input:
+        return run_batch(job, job_input, timings)
+    deadline = timings.started + job_input.get("timeout", COMFY_JOB_TIMEOUT_S)
+
+    # An identical job ran before, no need to run it again
+    cache_key, result = cached_result(job["id"], job_input, timings)
+    if result:
+        return {**result, "refresh_worker": REFRESH_WORKER}
+
+    job_input, error_result = prepare_job(job_input, timings, job["id"])
+    if error_result:
+        return error_result
+
+    # Subscribe to the execution events before queuing, so that no event is missed
+    client_id = str(uuid.uuid4())
+    ws = open_websocket(client_id) if COMFY_COMPLETION_MODE == "websocket" else None
+
+    try:
+        prompt_id, error_result = submit_workflow(
+            job_input["workflow"], client_id, timings
+        )
+        if error_result:
+            return error_result
+        history, error_result, _ = wait_for_job(
+            job["id"], prompt_id, ws, deadline, timings
+        )
+        if error_result:
+            return error_result
+    finally:
+        if ws is not None:
+            ws.close()
 
     # Get the generated image and return it as URL in an AWS bucket or as base64
-    images_result = process_output_images(history[prompt_id].get("outputs"), job["id"])
+    outputs = history[prompt_id].get("outputs")
+    images_result = store_result(
+        cache_key,
+        process_output_images(
+            outputs, job["id"], options=job_input.get("output"), timings=timings
+        ),
+        outputs,
+    )
 
     result = {**images_result, "refresh_worker": REFRESH_WORKER}
 
     return result
 
 
+def run_batch(job, job_input, timings):
+    """
+    Runs a batch job, which has several variants of a workflow, for run_job().
+
+    The input images are uploaded once and all variants are queued back to back, so
+    ComfyUI reuses what they have in common (loaded models, the outputs of nodes with
+    the same inputs, like the text encoding of a shared prompt). The outputs of every
+    variant are processed as soon as it is done, while ComfyUI works on the next one.
+    A variant that fails doesn't stop the others, but once the job times out or is
+    cancelled, the remaining variants are cancelled too.
+
+    Args:
+        job (dict): A dictionary containing job details and input parameters.
+        job_input (dict): The validated input of the job, with its "variants".
+        timings (JobTimings): Records the stages of the job.
+
+    Returns:
+        dict: The status, the result of every variant in "variants" (like the result
+              of a single job) and the "errors" of the variants that failed, or an
+              error if no variant succeeded.
+    """
+    deadline = timings.started + job_input.get("timeout", COMFY_JOB_TIMEOUT_S)
+
+    job_input, error_result = prepare_job(job_input, timings, job["id"])
+    if error_result:
+        return error_result
+    variants = job_input["variants"]
+
+    # Subscribe to the execution events before queuing, so that no event is missed
+    client_id = str(uuid.uuid4())
+    ws = open_websocket(client_id) if COMFY_COMPLETION_MODE == "websocket" else None
+
+    results = [None] * len(variants)
+    prompt_ids = [None] * len(variants)
+    try:
+        for index, workflow in enumerate(variants):
+            prompt_ids[index], results[index] = submit_workflow(
+                workflow, client_id, timings
+            )
+
+        # ComfyUI runs the prompts in the order they were queued
+        for index, prompt_id in enumerate(prompt_ids):
+            if prompt_id is None:
+                continue
+            later = [i for i in range(index + 1, len(prompt_ids)) if prompt_ids[i]]
+            history, error_result, stopped = wait_for_job(
+                job["id"],
+                prompt_id,
+                ws,
+                deadline,
+                timings,
+                [prompt_ids[i] for i in later],
+            )
+            if stopped:
+                for i in later:
+                    results[i] = {"error": f"The job {stopped} before this variant ran"}
+
+            if error_result:
+                results[index] = error_result
+            else:
+                results[index] = process_output_images(
+                    history[prompt_id].get("outputs"),
+                    job["id"],
+                    options=job_input.get("output"),
+                    timings=timings,
+                )
+            if stopped:
+                break
+    finally:
+        if ws is not None:
+            ws.close()
+
+    return {**merge_batch_results(results), "refresh_worker": REFRESH_WORKER}
+
+
+def merge_batch_results(results):
+    """
+    Combines the results of the variants of a batch job, see run_batch().
+
+    Args:
+        results (list): The result of process_output_images() or an {"error"} of every variant
+
+    Returns:
+        dict: The result of the batch
+    """
+    variants = []
+    errors = []
+    for index, result in enumerate(results):
+        if "error" in result:
+            details = {key: value for key, value in result.items() if key != "error"}
+            result = {"status": "error", "message": result["error"], **details}
+        if result.get("status") != "success":
+            errors.append(f"Variant {index}: {result['message']}")
+        variants.append(result)
+
+    print(
+        f"runpod-worker-comfy - {len(results) - len(errors)} of {len(results)} "
+        f"variants succeeded"
+    )
+    if len(errors) == len(results):
+        return {"error": errors[0], "details": errors, "variants": variants}
+    merged = {"status": "success", "variants": variants}
+    if errors:
+        merged["errors"] = errors
+    return merged
+
+
+def generator_handler(job):
+    """
+    Streaming variant of handler(), used when COMFY_STREAM_OUTPUT is enabled.
+
+    While ComfyUI runs the workflow, this yields which node is executing, the steps of
+    nodes that report progress (like samplers) and the images of every output node as
+    soon as that node finished, so clients of /stream get intermediate results early.
+    The last item is the result like handler() returns it, but the base64 images that
+    were already sent in an "output" update are left out of it ("streamed": True
+    instead of "data"). /run and /runsync return the list of every item, so each
+    image is in it once.
+
+    Args:
+        job (dict): A dictionary containing job details and input parameters.
+
+    Yields:
+        dict: {"status": "executing", "node_id", "node", "nodes"},
+              {"status": "progress", "node_id", "step", "total"},
+              {"status": "output", "node_id", "images"[, "errors"]}
+              and finally the result or {"error": ...}.
+    """
+    timings = JobTimings()
+
+    # Make sure that the input is valid
+    with timings.measure("validation"):
+        job_input, error_message = validate_input(job["input"])
+    if error_message:
+        yield finish_job({"error": error_message}, timings)
+        return
+
+    try:
+        for update in stream_job(job, job_input, timings):
+            if update.get("status") in ("executing", "progress", "output"):
+                yield update
+            else:
+                release_memory(job_input, timings)
+                yield finish_job(update, timings)
+    finally:
+        # Also when nobody reads the stream anymore
+        input_staging.remove_job_inputs(job["id"])
+
+
+def without_data(image):
+    """The image without its base64 data, for an image that was already streamed"""
+    if image.get("type") != "base64":
+        return image
+    image = {key: value for key, value in image.items() if key != "data"}
+    image["streamed"] = True
+    return image
+
+
+def stream_job(job, job_input, timings):
+    """
+    Runs a job for generator_handler().
+
+    Args:
+        job (dict): A dictionary containing job details and input parameters.
+        job_input (dict): The validated input of the job.
+        timings (JobTimings): Records the stages of the job.
+
+    Yields:
+        dict: The updates and finally the result, see generator_handler()
+    """
+    if "variants" in job_input:
+        # The variants of a batch are not streamed, only their result
+        yield run_batch(job, job_input, timings)
+        return
+    deadline = timings.started + job_input.get("timeout", COMFY_JOB_TIMEOUT_S)
+    options = job_input.get("output")
+
+    # An identical job ran before, no need to run it again
+    cache_key, result = cached_result(job["id"], job_input, timings)
+    if result:
+        yield result
+        return
+
+    job_input, error_result = prepare_job(job_input, timings, job["id"])
+    if error_result:
+        yield error_result
+        return
+    workflow = job_input["workflow"]
+
+    # Subscribe to the execution events before queuing, so that no event is missed
+    client_id = str(uuid.uuid4())
+    ws = open_websocket(client_id)
+
+    try:
+        prompt_id, error_result = submit_workflow(workflow, client_id, timings)
+        if error_result:
+            yield error_result
+            return
+
+        nodes = len(workflow)
+        executed_nodes = 0
+        streamed = {}
+        history, error_result = None, None
+        # Closing the events right away cancels the prompt if nobody reads the stream
+        with closing(
+            follow_prompt(job["id"], prompt_id, ws, deadline, timings)
+        ) as events:
+            for event_type, data in events:
+                if event_type == "executing":
+                    executed_nodes += 1
+                    yield {
+                        "status": "executing",
+                        "node_id": data.get("node"),
+                        "node": min(executed_nodes, nodes),
+                        "nodes": nodes,
+                    }
+                elif event_type == "progress":
+                    yield {
+                        "status": "progress",
+                        "node_id": data.get("node"),
+                        "step": data.get("value"),
+                        "total": data.get("max"),
+                    }
+                elif event_type == "executed":
+                    node_outputs = {data.get("node"): data.get("output") or {}}
+                    if collect_output_images(node_outputs):
+                        node_result = process_output_images(
+                            node_outputs, job["id"], options=options, timings=timings
+                        )
+                        update = {
+                            "status": "output",
+                            "node_id": data.get("node"),
+                            "images": node_result.get("images", []),
+                        }
+                        if node_result.get("errors"):
+                            update["errors"] = node_result["errors"]
+                        yield update
+                        streamed[data.get("node")] = node_result
+                elif event_type == "done":
+                    history, error_result = data
+        if error_result:
+            yield error_result
+            return
+    finally:
+        if ws is not None:
+            ws.close()
+
+    # Outputs of nodes that ComfyUI took from its cache are not sent as events
+    outputs = history[prompt_id].get("outputs")
+    remaining = {k: v for k, v in outputs.items() if k not in streamed}
+    # /run and /runsync return every update, so the images that were already sent
+    # are only referenced instead of being in the output twice
+    results = [
+        {**result, "images": [without_data(i) for i in result.get("images", [])]}
+        for result in streamed.values()
+    ]
+    if collect_output_images(remaining):
+        results.append(
+            process_output_images(
+                remaining, job["id"], options=options, timings=timings
+            )
+        )
+
+    yield store_result(cache_key, merge_output_results(results), outputs)
+
+
+# Runs the blocking handlers for async_handler and async_generator_handler
+job_executor = ThreadPoolExecutor(max_workers=max(COMFY_CONCURRENCY, 1))
+
+
+def cancel_job(job):
+    """
+    Cancels the prompt of a job that the RunPod SDK cancelled.
+
+    The thread that runs the job stops waiting once ComfyUI reports the interruption.
+
+    Args:
+        job (dict): The cancelled job
+    """
+    prompt_id = in_flight_prompts.pop(job["id"], None)
+    if prompt_id:
+        print(f"runpod-worker-comfy - job {job['id']} was cancelled")
+        cancel_prompt(prompt_id)
+
+
+def concurrency_modifier(current_concurrency):
+    """
+    Tells the RunPod SDK how many jobs this worker takes at the same time.
+
+    Args:
+        current_concurrency (int): The concurrency the SDK currently uses.
+
+    Returns:
+        int: COMFY_CONCURRENCY
+    """
+    return COMFY_CONCURRENCY
+
+
+async def async_handler(job):
+    """
+    Runs handler() in the job executor, so that several jobs are in flight at the same time.
+
+    ComfyUI still executes one prompt after the other, but while it works on one job the
+    next job already uploads its images and queues its prompt, and the previous job
+    encodes and uploads its outputs, so the GPU isn't idle between jobs.
+
+    Args:
+        job (dict): A dictionary containing job details and input parameters.
+
+    Returns:
+        dict: The result of handler().
+    """
+    loop = asyncio.get_running_loop()
+    try:
+        return await loop.run_in_executor(job_executor, handler, job)
+    except asyncio.CancelledError:
+        cancel_job(job)
+        raise
+
+
+async def async_generator_handler(job):
+    """
+    Like async_handler(), for the streaming generator_handler().
+
+    Args:
+        job (dict): A dictionary containing job details and input parameters.
+
+    Yields:
+        dict: The updates of generator_handler().
+    """
+    loop = asyncio.get_running_loop()
+    updates = generator_handler(job)
+    done = object()
+    while True:
+        try:
+            update = await loop.run_in_executor(job_executor, next, updates, done)
+        except asyncio.CancelledError:
+            cancel_job(job)
+            raise
+        if update is done:
+            return
+        yield update
+
+
+def start_worker():
+    """
+    Starts taking jobs with the handler that fits COMFY_STREAM_OUTPUT and COMFY_CONCURRENCY.
+
+    concurrency_modifier needs runpod 1.6.0 or newer, older versions ignore it and run
+    one job at a time.
+    """
+    concurrent = COMFY_CONCURRENCY > 1
+    if COMFY_STREAM_OUTPUT:
+        config = {
+            "handler": async_generator_handler if concurrent else generator_handler,
+            "return_aggregate_stream": True,
+            "refresh_worker": REFRESH_WORKER,
+        }
+    else:
+        config = {"handler": async_handler if concurrent else handler}
+    if concurrent:
+        config["concurrency_modifier"] = concurrency_modifier
+    runpod.serverless.start(config)
+
+
 # Start the handler only if this script is run directly
 if __name__ == "__main__":
-    runpod.serverless.start({"handler": handler})
+    # Wait for ComfyUI in the background, so that jobs don't have to
+    readiness.start()
+
+    # Load the models before the first job, the worker only takes jobs after this
+    warmup(load_warmup_inputs())
+
+    # Read the templates once, and check them as soon as ComfyUI is up
+    workflow_templates.load()
+    if COMFY_VALIDATE_WORKFLOW:
+        workflow_templates.validate_when_ready()
+
+    # The stage histograms can only be scraped when the API is served locally
+    if COMFY_METRICS_PORT and "--rp_serve_api" in sys.argv:
+        start_metrics_server(COMFY_METRICS_PORT)
+
+    start_worker()
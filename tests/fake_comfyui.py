@@ -0,0 +1,639 @@
+"""
+A small stand-in for the ComfyUI HTTP + WebSocket API.
+
+It only implements what rp_handler.py talks to and is used by the unit tests
+and the benchmarks. Prompts are executed one after another (like on a single
+GPU) by sleeping for `execution_time` seconds and then writing real PNGs
+(one per `batch_size` of the workflow) for every "SaveImage"-like node into
+`output_dir`. "PreviewImage" nodes report "temp" images.
+"""
+
+import base64
+import hashlib
+import json
+import os
+import queue
+import socket
+import struct
+import tempfile
+import threading
+import time
+import uuid
+import zlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+WEBSOCKET_MAGIC = "258EAFA5-E914-47DA-95CA-C5AB0DC85B11"
+
+
+def png_bytes(width=8, height=8, color=(255, 0, 0)):
+    """
+    Build a valid RGB PNG without any imaging library.
+    """
+
+    def chunk(kind, data):
+        body = kind + data
+        return (
+            struct.pack(">I", len(data))
+            + body
+            + struct.pack(">I", zlib.crc32(body) & 0xFFFFFFFF)
+        )
+
+    row = b"\x00" + bytes(color) * width
+    raw = row * height
+    return (
+        b"\x89PNG\r\n\x1a\n"
+        + chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, 8, 2, 0, 0, 0))
+        + chunk(b"IDAT", zlib.compress(raw))
+        + chunk(b"IEND", b"")
+    )
+
+
+def _encode_frame(payload, opcode=0x1):
+    header = bytes([0x80 | opcode])
+    length = len(payload)
+    if length < 126:
+        header += bytes([length])
+    elif length < 1 << 16:
+        header += bytes([126]) + struct.pack(">H", length)
+    else:
+        header += bytes([127]) + struct.pack(">Q", length)
+    return header + payload
+
+
+def _read_exact(sock, size):
+    data = b""
+    while len(data) < size:
+        chunk = sock.recv(size - len(data))
+        if not chunk:
+            raise ConnectionError("socket closed")
+        data += chunk
+    return data
+
+
+def _read_frame(sock):
+    first, second = _read_exact(sock, 2)
+    opcode = first & 0x0F
+    length = second & 0x7F
+    if length == 126:
+        length = struct.unpack(">H", _read_exact(sock, 2))[0]
+    elif length == 127:
+        length = struct.unpack(">Q", _read_exact(sock, 8))[0]
+    mask = _read_exact(sock, 4) if second & 0x80 else None
+    payload = _read_exact(sock, length)
+    if mask:
+        payload = bytes(b ^ mask[i % 4] for i, b in enumerate(payload))
+    return opcode, payload
+
+
+class FakeComfyUI:
+    """
+    Threaded fake ComfyUI server.
+
+    Args:
+        execution_time (float): Seconds every prompt "runs" on the fake GPU.
+        output_dir (str): Where generated PNGs are written. A temporary
+            directory is used if omitted.
+        websocket (bool): Whether `/ws` accepts connections.
+        upload_time (float): Seconds every `/upload/image` request takes.
+        object_info (dict): Node definitions served by `/object_info`, which
+            answers 404 if omitted.
+        targeted_interrupt (bool): Whether `/interrupt` only interrupts the
+            `prompt_id` in its body, like newer ComfyUI versions. Otherwise it
+            interrupts whatever runs, like ComfyUI 0.3.26.
+        image_size (tuple): (width, height) of the PNGs that are written.
+
+    Uploaded images are written to `input_dir`, `max_uploads_in_flight` is the
+    highest number of uploads that were handled at the same time.
+    """
+
+    def __init__(
+        self,
+        execution_time=0.05,
+        output_dir=None,
+        websocket=True,
+        upload_time=0,
+        object_info=None,
+        image_size=(8, 8),
+        targeted_interrupt=True,
+    ):
+        self.execution_time = execution_time
+        self.image_size = image_size
+        self.object_info = object_info
+        self.websocket_enabled = websocket
+        self.upload_time = upload_time
+        self.targeted_interrupt = targeted_interrupt
+        self._tmp = tempfile.TemporaryDirectory()
+        if output_dir is None:
+            output_dir = os.path.join(self._tmp.name, "output")
+            os.makedirs(output_dir)
+        self.output_dir = output_dir
+        self.input_dir = os.path.join(self._tmp.name, "input")
+        os.makedirs(self.input_dir)
+        self.history = {}
+        self.queued_at = {}
+        self.completed_at = {}
+        self.failure = None
+        self.rejection = None
+        self.request_counts = {}
+        self.uploads_in_flight = 0
+        self.max_uploads_in_flight = 0
+        # time.monotonic() of every request, by path
+        self.request_times = {}
+        self.connections = 0
+        self.running = None
+        self.interrupts = 0
+        # Reported by /system_stats, /free resets them like releasing the memory would
+        self.vram_total = self.ram_total = 16 * 2**30
+        self.vram_free = self.ram_free = 8 * 2**30
+        self.frees = []
+        # The content of the image every LoadImage node read, by prompt ID and node ID
+        self.loaded_images = {}
+        self._interrupt = threading.Event()
+        self._pending = queue.Queue()
+        self._clients = {}
+        self._lock = threading.Lock()
+        self._server = None
+        self._threads = []
+        self._stopped = threading.Event()
+
+    # ------------------------------------------------------------------ #
+    # Lifecycle
+    # ------------------------------------------------------------------ #
+    @property
+    def host(self):
+        """The "host:port" the server listens on."""
+        return f"127.0.0.1:{self._server.server_address[1]}"
+
+    def start(self):
+        fake = self
+
+        class Handler(_RequestHandler):
+            server_fake = fake
+
+        self._server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self._server.daemon_threads = True
+        serve = lambda: self._server.serve_forever(poll_interval=0.05)
+        for target in (serve, self._execute_loop):
+            thread = threading.Thread(target=target, daemon=True)
+            thread.start()
+            self._threads.append(thread)
+        return self
+
+    def stop(self):
+        self._stopped.set()
+        self._pending.put(None)
+        self._server.shutdown()
+        self._server.server_close()
+        with self._lock:
+            clients = [c for conns in self._clients.values() for c in conns]
+            self._clients.clear()
+        for conn in clients:
+            try:
+                conn.close()
+            except OSError:
+                pass
+        self._tmp.cleanup()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    # ------------------------------------------------------------------ #
+    # Test helpers
+    # ------------------------------------------------------------------ #
+    def fail_prompts(self, node_id="3", message="Simulated failure"):
+        """Make every following prompt fail at `node_id`."""
+        self.failure = (node_id, message)
+
+    def reject_prompts(self, body):
+        """Answer every following /prompt with HTTP 400 and `body`, like a failed validation."""
+        self.rejection = body
+
+    def drop_websockets(self):
+        """Close every open websocket connection."""
+        with self._lock:
+            clients = [c for conns in self._clients.values() for c in conns]
+            self._clients.clear()
+        for conn in clients:
+            try:
+                conn.shutdown(socket.SHUT_RDWR)
+                conn.close()
+            except OSError:
+                pass
+
+    def use_memory(self, vram_free_mb=None, ram_used_percent=None):
+        """Set the free VRAM and the used RAM that /system_stats reports."""
+        if vram_free_mb is not None:
+            self.vram_free = vram_free_mb * 2**20
+        if ram_used_percent is not None:
+            self.ram_free = int(self.ram_total * (1 - ram_used_percent / 100))
+
+    def count(self, path):
+        return self.request_counts.get(path, 0)
+
+    def gaps(self, path):
+        """Seconds between the requests to `path`, in order."""
+        times = self.request_times.get(path, [])
+        return [later - earlier for earlier, later in zip(times, times[1:])]
+
+    # ------------------------------------------------------------------ #
+    # Internals
+    # ------------------------------------------------------------------ #
+    def _send_event(self, client_id, event_type, data):
+        message = _encode_frame(json.dumps({"type": event_type, "data": data}).encode())
+        with self._lock:
+            connections = list(self._clients.get(client_id, []))
+        for conn in connections:
+            try:
+                conn.sendall(message)
+            except OSError:
+                pass
+
+    def _store_upload(self, content_type, body):
+        boundary = b"--" + content_type.split("boundary=")[1].encode()
+        fields, files = {}, {}
+        for part in body.split(boundary)[1:-1]:
+            headers, _, content = part[2:-2].partition(b"\r\n\r\n")
+            disposition = headers.split(b"\r\n")[0].decode()
+            params = dict(
+                item.strip().split("=", 1)
+                for item in disposition.split(";")[1:]
+                if "=" in item
+            )
+            name = params["name"].strip('"')
+            if "filename" in params:
+                files[name] = (params["filename"].strip('"'), content)
+            else:
+                fields[name] = content.decode()
+
+        filename, content = files["image"]
+        subfolder = fields.get("subfolder", "")
+        with self._lock:
+            self.uploads_in_flight += 1
+            self.max_uploads_in_flight = max(
+                self.max_uploads_in_flight, self.uploads_in_flight
+            )
+        try:
+            os.makedirs(os.path.join(self.input_dir, subfolder), exist_ok=True)
+            with open(os.path.join(self.input_dir, subfolder, filename), "wb") as f:
+                f.write(content)
+            time.sleep(self.upload_time)
+        finally:
+            with self._lock:
+                self.uploads_in_flight -= 1
+        return {"name": filename, "subfolder": subfolder, "type": "input"}
+
+    def _queue_prompt(self, body):
+        prompt_id = str(uuid.uuid4())
+        self.queued_at[prompt_id] = time.monotonic()
+        self._pending.put((prompt_id, body.get("prompt", {}), body.get("client_id")))
+        return prompt_id
+
+    def _execute_loop(self):
+        while not self._stopped.is_set():
+            item = self._pending.get()
+            if item is None:
+                return
+            self.running = item[0]
+            self._interrupt.clear()
+            self._execute(*item)
+            self.running = None
+
+    def _queue_status(self):
+        with self._pending.mutex:
+            pending = [item for item in self._pending.queue if item is not None]
+        running = self.running
+        return {
+            "queue_running": [[0, running, {}, {}, []]] if running else [],
+            "queue_pending": [
+                [number, prompt_id, {}, {}, []]
+                for number, (prompt_id, _, _) in enumerate(pending, start=1)
+            ],
+        }
+
+    def _system_stats(self):
+        return {
+            "system": {"ram_total": self.ram_total, "ram_free": self.ram_free},
+            "devices": [
+                {
+                    "name": "cuda:0 Fake GPU",
+                    "type": "cuda",
+                    "index": 0,
+                    "vram_total": self.vram_total,
+                    "vram_free": self.vram_free,
+                }
+            ],
+        }
+
+    def _free(self, flags):
+        self.frees.append(flags)
+        if flags.get("unload_models", flags.get("free_memory", False)):
+            self.vram_free = self.vram_total
+        if flags.get("free_memory"):
+            self.ram_free = self.ram_total // 2
+
+    def _delete_pending(self, prompt_ids):
+        with self._pending.mutex:
+            for item in list(self._pending.queue):
+                if item is not None and item[0] in prompt_ids:
+                    self._pending.queue.remove(item)
+
+    def _interrupt_running(self, prompt_id=None):
+        if not self.targeted_interrupt:
+            prompt_id = None
+        if self.running and prompt_id in (None, self.running):
+            self.interrupts += 1
+            self._interrupt.set()
+
+    def _execute(self, prompt_id, workflow, client_id):
+        send = lambda t, d: self._send_event(client_id, t, d)
+        started_at = int(time.time() * 1000)
+        send("execution_start", {"prompt_id": prompt_id, "timestamp": started_at})
+        failure = self.failure
+
+        nodes = {k: v for k, v in workflow.items() if isinstance(v, dict)}
+        node_time = self.execution_time / max(len(nodes), 1)
+        batch_size = max(
+            [
+                node["inputs"]["batch_size"]
+                for node in nodes.values()
+                if isinstance(node.get("inputs", {}).get("batch_size"), int)
+            ]
+            or [1]
+        )
+
+        outputs = {}
+        for node_id, node in nodes.items():
+            send("executing", {"node": node_id, "prompt_id": prompt_id})
+            if failure and failure[0] == node_id:
+                time.sleep(node_time)
+                self._fail(prompt_id, node_id, node, failure[1], send)
+                return
+
+            steps = node.get("inputs", {}).get("steps")
+            if isinstance(steps, int) and steps > 0:
+                for step in range(1, steps + 1):
+                    if self._interrupt.wait(node_time / steps):
+                        self._interrupted(prompt_id, node_id, node, send)
+                        return
+                    send(
+                        "progress",
+                        {
+                            "value": step,
+                            "max": steps,
+                            "prompt_id": prompt_id,
+                            "node": node_id,
+                        },
+                    )
+            elif self._interrupt.wait(node_time):
+                self._interrupted(prompt_id, node_id, node, send)
+                return
+
+            if node.get("class_type") == "LoadImage":
+                self._load_image(prompt_id, node_id, node)
+            output = self._node_output(prompt_id, node_id, node, batch_size)
+            if output:
+                outputs[node_id] = output
+                send(
+                    "executed",
+                    {"node": node_id, "output": output, "prompt_id": prompt_id},
+                )
+
+        self.history[prompt_id] = {
+            "outputs": outputs,
+            "status": {
+                "status_str": "success",
+                "completed": True,
+                "messages": [
+                    [
+                        "execution_start",
+                        {"prompt_id": prompt_id, "timestamp": started_at},
+                    ],
+                    [
+                        "execution_success",
+                        {"prompt_id": prompt_id, "timestamp": int(time.time() * 1000)},
+                    ],
+                ],
+            },
+        }
+        self.completed_at[prompt_id] = time.monotonic()
+        send("executing", {"node": None, "prompt_id": prompt_id})
+        send("execution_success", {"prompt_id": prompt_id})
+
+    def _load_image(self, prompt_id, node_id, node):
+        path = os.path.join(self.input_dir, str(node["inputs"].get("image")))
+        try:
+            with open(path, "rb") as f:
+                content = f.read()
+        except OSError:
+            content = None
+        self.loaded_images.setdefault(prompt_id, {})[node_id] = content
+
+    def _node_output(self, prompt_id, node_id, node, batch_size):
+        class_type = str(node.get("class_type", ""))
+        if class_type == "PreviewImage":
+            filename = f"preview_{node_id}.png"
+            return {"images": [{"filename": filename, "subfolder": "", "type": "temp"}]}
+        if "SaveImage" in class_type or class_type == "Image Save":
+            images = []
+            for index in range(batch_size):
+                filename = f"ComfyUI_{prompt_id[:8]}_{node_id}_{index:05}_.png"
+                with open(os.path.join(self.output_dir, filename), "wb") as f:
+                    f.write(png_bytes(*self.image_size, color=(index % 256, 0, 0)))
+                images.append({"filename": filename, "subfolder": "", "type": "output"})
+            return {"images": images}
+        return None
+
+    def _interrupted(self, prompt_id, node_id, node, send):
+        data = {
+            "prompt_id": prompt_id,
+            "node_id": node_id,
+            "node_type": node.get("class_type"),
+            "executed": [],
+        }
+        self.history[prompt_id] = {
+            "outputs": {},
+            "status": {
+                "status_str": "error",
+                "completed": False,
+                "messages": [
+                    ["execution_start", {"prompt_id": prompt_id}],
+                    ["execution_interrupted", data],
+                ],
+            },
+        }
+        self.completed_at[prompt_id] = time.monotonic()
+        send("execution_interrupted", data)
+
+    def _fail(self, prompt_id, node_id, node, message, send):
+        error = {
+            "prompt_id": prompt_id,
+            "node_id": node_id,
+            "node_type": node.get("class_type"),
+            "exception_message": message,
+            "exception_type": "RuntimeError",
+        }
+        self.history[prompt_id] = {
+            "outputs": {},
+            "status": {
+                "status_str": "error",
+                "completed": False,
+                "messages": [
+                    ["execution_start", {"prompt_id": prompt_id}],
+                    ["execution_error", error],
+                ],
+            },
+        }
+        self.completed_at[prompt_id] = time.monotonic()
+        send("execution_error", error)
+
+
+class _RequestHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True
+    server_fake = None
+
+    def setup(self):
+        super().setup()
+        with self.server_fake._lock:
+            self.server_fake.connections += 1
+
+    def log_message(self, *args):
+        pass
+
+    def _json(self, payload, status=200):
+        body = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _count(self, path):
+        fake = self.server_fake
+        with fake._lock:
+            fake.request_counts[path] = fake.request_counts.get(path, 0) + 1
+            fake.request_times.setdefault(path, []).append(time.monotonic())
+
+    def _body(self):
+        length = int(self.headers.get("Content-Length", 0))
+        return self.rfile.read(length) if length else b""
+
+    def do_GET(self):
+        fake = self.server_fake
+        url = urlparse(self.path)
+        self._count(
+            url.path.rsplit("/", 1)[0] if url.path.startswith("/history/") else url.path
+        )
+
+        if url.path == "/":
+            body = b"ok"
+            self.send_response(200)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+        elif url.path == "/queue":
+            self._json(fake._queue_status())
+        elif url.path == "/view":
+            self._view(parse_qs(url.query))
+        elif url.path == "/system_stats":
+            self._json(fake._system_stats())
+        elif url.path == "/object_info" and fake.object_info is not None:
+            self._json(fake.object_info)
+        elif url.path.startswith("/history/"):
+            prompt_id = url.path[len("/history/") :]
+            entry = fake.history.get(prompt_id)
+            self._json({prompt_id: entry} if entry else {})
+        elif url.path == "/ws" and fake.websocket_enabled:
+            self._upgrade(parse_qs(url.query).get("clientId", [""])[0])
+        else:
+            self._json({"error": "not found"}, 404)
+
+    def _view(self, query):
+        fake = self.server_fake
+        folder = {"input": fake.input_dir, "output": fake.output_dir}.get(
+            query.get("type", ["output"])[0]
+        )
+        path = os.path.join(
+            folder or "",
+            query.get("subfolder", [""])[0],
+            query.get("filename", [""])[0],
+        )
+        if folder is None or not os.path.isfile(path):
+            self._json({"error": "not found"}, 404)
+            return
+        with open(path, "rb") as f:
+            body = f.read()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/octet-stream")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        fake = self.server_fake
+        url = urlparse(self.path)
+        self._count(url.path)
+        body = self._body()
+
+        if url.path == "/prompt" and fake.rejection is not None:
+            self._json(fake.rejection, 400)
+        elif url.path == "/prompt":
+            prompt_id = fake._queue_prompt(json.loads(body))
+            self._json({"prompt_id": prompt_id, "number": 0, "node_errors": {}})
+        elif url.path == "/upload/image":
+            self._json(fake._store_upload(self.headers.get("Content-Type", ""), body))
+        elif url.path == "/queue":
+            fake._delete_pending(json.loads(body).get("delete", []))
+            self._json({})
+        elif url.path == "/free":
+            fake._free(json.loads(body))
+            self._json({})
+        elif url.path == "/interrupt":
+            fake._interrupt_running((json.loads(body) if body else {}).get("prompt_id"))
+            self._json({})
+        else:
+            self._json({"error": "not found"}, 404)
+
+    def _upgrade(self, client_id):
+        fake = self.server_fake
+        key = self.headers.get("Sec-WebSocket-Key", "")
+        accept = base64.b64encode(
+            hashlib.sha1((key + WEBSOCKET_MAGIC).encode()).digest()
+        ).decode()
+        self.send_response(101, "Switching Protocols")
+        self.send_header("Upgrade", "websocket")
+        self.send_header("Connection", "Upgrade")
+        self.send_header("Sec-WebSocket-Accept", accept)
+        self.end_headers()
+        self.wfile.flush()
+
+        conn = self.connection
+        with fake._lock:
+            fake._clients.setdefault(client_id, []).append(conn)
+        conn.sendall(
+            _encode_frame(
+                json.dumps(
+                    {"type": "status", "data": {"status": {}, "sid": client_id}}
+                ).encode()
+            )
+        )
+        try:
+            while True:
+                opcode, payload = _read_frame(conn)
+                if opcode == 0x8:
+                    conn.sendall(_encode_frame(payload, opcode=0x8))
+                    break
+                if opcode == 0x9:
+                    conn.sendall(_encode_frame(payload, opcode=0xA))
+        except (ConnectionError, OSError, ValueError):
+            pass
+        finally:
+            with fake._lock:
+                conns = fake._clients.get(client_id, [])
+                if conn in conns:
+                    conns.remove(conn)
+        self.close_connection = True
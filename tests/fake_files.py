@@ -0,0 +1,116 @@
+"""
+A small stand-in for an HTTP server that hosts the input images of jobs.
+
+It serves the files that were added with `add()` and answers conditional
+requests (If-None-Match) with 304 like a CDN or an S3 bucket, so tests can
+check what was downloaded. Every request can take `response_time` seconds,
+so tests can check that files are downloaded concurrently.
+"""
+
+import hashlib
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class FakeFileServer:
+    """
+    Threaded fake file server.
+
+    Args:
+        response_time (float): Seconds every request takes.
+
+    `requests` lists the (path, status) of every request, `max_in_flight` is the
+    highest number of requests that were handled at the same time.
+    """
+
+    def __init__(self, response_time=0):
+        self.response_time = response_time
+        self.files = {}
+        self.requests = []
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self._lock = threading.Lock()
+        self._server = None
+
+    # ------------------------------------------------------------------ #
+    # Lifecycle
+    # ------------------------------------------------------------------ #
+    def url(self, path):
+        """The URL of the file at `path`."""
+        return f"http://127.0.0.1:{self._server.server_address[1]}{path}"
+
+    def start(self):
+        fake = self
+
+        class Handler(_RequestHandler):
+            server_fake = fake
+
+        self._server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self._server.daemon_threads = True
+        threading.Thread(
+            target=lambda: self._server.serve_forever(poll_interval=0.05),
+            daemon=True,
+        ).start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    # ------------------------------------------------------------------ #
+    # Test helpers
+    # ------------------------------------------------------------------ #
+    def add(self, path, body, etag=True):
+        """Serve `body` at `path`, with an ETag of its content unless `etag` is False."""
+        self.files[path] = (
+            body,
+            f'"{hashlib.md5(body).hexdigest()}"' if etag else None,
+        )
+        return self.url(path)
+
+    def statuses(self, path):
+        """The status codes of the requests for `path`, in order."""
+        return [status for requested, status in self.requests if requested == path]
+
+
+class _RequestHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    server_fake = None
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        fake = self.server_fake
+        with fake._lock:
+            fake.in_flight += 1
+            fake.max_in_flight = max(fake.max_in_flight, fake.in_flight)
+        try:
+            time.sleep(fake.response_time)
+            path = self.path.split("?")[0]
+            body, etag = fake.files.get(path, (None, None))
+            if body is None:
+                status, body = 404, b"not found"
+            elif etag and self.headers.get("If-None-Match") == etag:
+                status, body = 304, b""
+            else:
+                status = 200
+            with fake._lock:
+                fake.requests.append((path, status))
+
+            self.send_response(status)
+            if etag:
+                self.send_header("ETag", etag)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+        finally:
+            with fake._lock:
+                fake.in_flight -= 1
@@ -0,0 +1,223 @@
+"""
+A small stand-in for an S3-compatible bucket storage.
+
+It only implements what boto3 needs to upload objects (PutObject and the
+multipart upload API, path-style) and to download them through presigned URLs
+(GetObject with If-None-Match) and is used by the unit tests and the
+benchmarks. Every UploadPart request can take `part_time` seconds, so tests
+can check that parts are uploaded concurrently.
+"""
+
+import hashlib
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, unquote, urlparse
+from xml.sax.saxutils import escape
+
+
+class FakeS3:
+    """
+    Threaded fake S3 server.
+
+    Args:
+        part_time (float): Seconds every UploadPart request takes.
+
+    Completed objects are in `objects`, keyed by (bucket, key), with their
+    "body", "content_type" and the number of "parts" (0 for PutObject).
+    """
+
+    def __init__(self, part_time=0):
+        self.part_time = part_time
+        self.objects = {}
+        self.uploads = {}
+        self.in_flight_parts = 0
+        self.max_in_flight_parts = 0
+        self._lock = threading.Lock()
+        self._server = None
+
+    # ------------------------------------------------------------------ #
+    # Lifecycle
+    # ------------------------------------------------------------------ #
+    @property
+    def endpoint_url(self):
+        """The URL to use as BUCKET_ENDPOINT_URL."""
+        return f"http://127.0.0.1:{self._server.server_address[1]}"
+
+    def start(self):
+        fake = self
+
+        class Handler(_RequestHandler):
+            server_fake = fake
+
+        self._server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self._server.daemon_threads = True
+        threading.Thread(
+            target=lambda: self._server.serve_forever(poll_interval=0.05),
+            daemon=True,
+        ).start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    # ------------------------------------------------------------------ #
+    # S3 operations
+    # ------------------------------------------------------------------ #
+    def _upload_part(self, upload_id, part_number, body):
+        with self._lock:
+            self.in_flight_parts += 1
+            self.max_in_flight_parts = max(
+                self.max_in_flight_parts, self.in_flight_parts
+            )
+        try:
+            time.sleep(self.part_time)
+            with self._lock:
+                self.uploads[upload_id]["parts"][part_number] = body
+        finally:
+            with self._lock:
+                self.in_flight_parts -= 1
+
+    def _complete(self, upload_id):
+        with self._lock:
+            upload = self.uploads.pop(upload_id)
+            parts = upload["parts"]
+            self.objects[upload["bucket"], upload["key"]] = {
+                "body": b"".join(parts[number] for number in sorted(parts)),
+                "content_type": upload["content_type"],
+                "parts": len(parts),
+            }
+
+
+def _decode_aws_chunked(body):
+    """
+    Returns the payload of a body in the "aws-chunked" encoding that newer
+    versions of botocore use to send trailing checksums.
+    """
+    payload = b""
+    while body:
+        header, body = body.split(b"\r\n", 1)
+        size = int(header.split(b";")[0], 16)
+        if size == 0:
+            break
+        payload += body[:size]
+        body = body[size + 2 :]
+    return payload
+
+
+class _RequestHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    server_fake = None
+
+    def log_message(self, *args):
+        pass
+
+    def _xml(self, body="", status=200, headers=None):
+        data = body.encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/xml")
+        self.send_header("Content-Length", str(len(data)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _body(self):
+        length = int(self.headers.get("Content-Length", 0))
+        body = self.rfile.read(length) if length else b""
+        if "aws-chunked" in self.headers.get("Content-Encoding", ""):
+            body = _decode_aws_chunked(body)
+        return body
+
+    def _target(self):
+        url = urlparse(self.path)
+        bucket, _, key = url.path.lstrip("/").partition("/")
+        query = {name: values[0] for name, values in parse_qs(url.query).items()}
+        if url.query.endswith("uploads") or "uploads=" in url.query:
+            query["uploads"] = ""
+        return bucket, unquote(key), query
+
+    def do_PUT(self):
+        fake = self.server_fake
+        bucket, key, query = self._target()
+        body = self._body()
+        etag = f'"{uuid.uuid4().hex}"'
+
+        if "uploadId" in query:
+            fake._upload_part(query["uploadId"], int(query["partNumber"]), body)
+        else:
+            with fake._lock:
+                fake.objects[bucket, key] = {
+                    "body": body,
+                    "content_type": self.headers.get("Content-Type"),
+                    "parts": 0,
+                }
+        self._xml(headers={"ETag": etag})
+
+    def do_POST(self):
+        fake = self.server_fake
+        bucket, key, query = self._target()
+        self._body()
+
+        if "uploads" in query:
+            upload_id = uuid.uuid4().hex
+            with fake._lock:
+                fake.uploads[upload_id] = {
+                    "bucket": bucket,
+                    "key": key,
+                    "content_type": self.headers.get("Content-Type"),
+                    "parts": {},
+                }
+            self._xml(
+                "<InitiateMultipartUploadResult>"
+                f"<Bucket>{escape(bucket)}</Bucket><Key>{escape(key)}</Key>"
+                f"<UploadId>{upload_id}</UploadId>"
+                "</InitiateMultipartUploadResult>"
+            )
+        elif "uploadId" in query:
+            fake._complete(query["uploadId"])
+            self._xml(
+                "<CompleteMultipartUploadResult>"
+                f"<Bucket>{escape(bucket)}</Bucket><Key>{escape(key)}</Key>"
+                f'<ETag>"{uuid.uuid4().hex}"</ETag>'
+                "</CompleteMultipartUploadResult>"
+            )
+        else:
+            self._xml("<Error><Code>NotImplemented</Code></Error>", 501)
+
+    def do_GET(self):
+        fake = self.server_fake
+        bucket, key, _ = self._target()
+        with fake._lock:
+            stored = fake.objects.get((bucket, key))
+        if stored is None:
+            self._xml("<Error><Code>NoSuchKey</Code></Error>", 404)
+            return
+        etag = f'"{hashlib.md5(stored["body"]).hexdigest()}"'
+        not_modified = self.headers.get("If-None-Match") == etag
+        body = b"" if not_modified else stored["body"]
+        self.send_response(304 if not_modified else 200)
+        self.send_header("ETag", etag)
+        self.send_header(
+            "Content-Type", stored["content_type"] or "binary/octet-stream"
+        )
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_DELETE(self):
+        fake = self.server_fake
+        _, _, query = self._target()
+        with fake._lock:
+            fake.uploads.pop(query.get("uploadId"), None)
+        self.send_response(204)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
@@ -1,19 +1,65 @@
 import unittest
-from unittest.mock import patch, MagicMock, mock_open, Mock
+from unittest.mock import patch, MagicMock, mock_open
 import sys
 import os
 import json
+import asyncio
 import base64
+import copy
+import tempfile
+import threading
+import time
+import requests
+from io import BytesIO
 
 # Make sure that "src" is known and can be used to import rp_handler.py
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "src")))
 from src import rp_handler
+from tests.fake_comfyui import FakeComfyUI, png_bytes
+from tests.fake_files import FakeFileServer
+from tests.fake_s3 import FakeS3
 
 # Local folder for test resources
 RUNPOD_WORKER_COMFY_TEST_RESOURCES_IMAGES = "./test_resources/images"
+# Histories and responses of ComfyUI for workflows that failed
+TEST_RESOURCES_HISTORIES = os.path.join(
+    os.path.dirname(__file__), "..", "test_resources", "histories"
+)
 
+with open(os.path.join(os.path.dirname(__file__), "..", "test_input.json")) as f:
+    WORKFLOW = json.load(f)["input"]["workflow"]
+
+
+with open(
+    os.path.join(os.path.dirname(__file__), "..", "test_resources", "object_info.json")
+) as f:
+    OBJECT_INFO = json.load(f)
+
+
+def load_history(name):
+    with open(os.path.join(TEST_RESOURCES_HISTORIES, name)) as f:
+        return json.load(f)
+
+
+class HandlerTestCase(unittest.TestCase):
+    """Replaces module state of rp_handler and environment variables for one test"""
+
+    def patch_handler(self, **values):
+        for name, value in values.items():
+            patcher = patch.object(rp_handler, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def patch_env(self, **values):
+        patcher = patch.dict(os.environ, values)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+
+class TestRunpodWorkerComfy(HandlerTestCase):
+    def setUp(self):
+        self.patch_handler(input_image_cache=rp_handler.InputImageCache())
 
-class TestRunpodWorkerComfy(unittest.TestCase):
     def test_valid_input_with_workflow_only(self):
         input_data = {"workflow": {"key": "value"}}
         validated_data, error = rp_handler.validate_input(input_data)
@@ -43,7 +89,28 @@ class TestRunpodWorkerComfy(unittest.TestCase):
         validated_data, error = rp_handler.validate_input(input_data)
         self.assertIsNotNone(error)
         self.assertEqual(
-            error, "'images' must be a list of objects with 'name' and 'image' keys"
+            error,
+            "'images' must be a list of objects with 'name' and 'image' or 'url' keys",
+        )
+
+    def test_input_with_image_urls(self):
+        images = [
+            {"name": "a.png", "url": "https://example.com/a.png"},
+            {"name": "b.png", "url": "s3://bucket/b.png"},
+        ]
+        validated_data, error = rp_handler.validate_input(
+            {"workflow": {}, "images": images}
+        )
+        self.assertIsNone(error)
+        self.assertEqual(validated_data["images"], images)
+
+    def test_input_with_unsupported_image_url(self):
+        validated_data, error = rp_handler.validate_input(
+            {"workflow": {}, "images": [{"name": "a.png", "url": "file:///etc/a.png"}]}
+        )
+        self.assertEqual(
+            error,
+            "The 'url' of image 'a.png' must start with http://, https://, s3://",
         )
 
     def test_invalid_json_string_input(self):
@@ -58,13 +125,56 @@ class TestRunpodWorkerComfy(unittest.TestCase):
         self.assertIsNone(error)
         self.assertEqual(validated_data, {"workflow": {"key": "value"}, "images": None})
 
+    def test_valid_input_with_timeout(self):
+        input_data = {"workflow": {"key": "value"}, "timeout": 30}
+        validated_data, error = rp_handler.validate_input(input_data)
+        self.assertIsNone(error)
+        self.assertEqual(validated_data["timeout"], 30)
+
+    def test_input_with_invalid_timeout(self):
+        for timeout in (0, -1, "30", True):
+            input_data = {"workflow": {"key": "value"}, "timeout": timeout}
+            validated_data, error = rp_handler.validate_input(input_data)
+            self.assertEqual(error, "'timeout' must be a positive number of seconds")
+
+    def test_valid_input_with_output_options(self):
+        input_data = {
+            "workflow": {"key": "value"},
+            "output": {"format": "JPG", "quality": 80, "max_dimension": 512},
+        }
+        validated_data, error = rp_handler.validate_input(input_data)
+        self.assertIsNone(error)
+        self.assertEqual(
+            validated_data["output"],
+            {"format": "jpeg", "quality": 80, "max_dimension": 512},
+        )
+
+    def test_input_with_invalid_output_options(self):
+        for output, expected in (
+            ("webp", "'output' must be an object"),
+            (
+                {"format": "bmp"},
+                "'output.format' must be one of: png, webp, jpeg, avif",
+            ),
+            ({"quality": 0}, "'output.quality' must be between 1 and 100"),
+            ({"quality": 101}, "'output.quality' must be between 1 and 100"),
+            (
+                {"max_dimension": 1.5},
+                "'output.max_dimension' must be a positive integer",
+            ),
+            ({"size": 512}, "Unknown 'output' option(s): size"),
+        ):
+            input_data = {"workflow": {"key": "value"}, "output": output}
+            validated_data, error = rp_handler.validate_input(input_data)
+            self.assertEqual(error, expected)
+
     def test_empty_input(self):
         input_data = None
         validated_data, error = rp_handler.validate_input(input_data)
         self.assertIsNotNone(error)
         self.assertEqual(error, "Please provide input")
 
-    @patch("rp_handler.requests.get")
+    @patch.object(rp_handler.comfy.session, "get")
     def test_check_server_server_up(self, mock_requests):
         mock_response = MagicMock()
         mock_response.status_code = 200
@@ -73,46 +183,34 @@ class TestRunpodWorkerComfy(unittest.TestCase):
         result = rp_handler.check_server("http://127.0.0.1:8188", 1, 50)
         self.assertTrue(result)
 
-    @patch("rp_handler.requests.get")
+    @patch.object(rp_handler.comfy.session, "get")
     def test_check_server_server_down(self, mock_requests):
-        mock_requests.get.side_effect = rp_handler.requests.RequestException()
+        mock_requests.side_effect = rp_handler.requests.RequestException()
         result = rp_handler.check_server("http://127.0.0.1:8188", 1, 50)
         self.assertFalse(result)
 
-    @patch("rp_handler.urllib.request.urlopen")
-    def test_queue_prompt(self, mock_urlopen):
+    @patch.object(rp_handler.comfy.session, "request")
+    def test_queue_prompt(self, mock_request):
         mock_response = MagicMock()
-        mock_response.read.return_value = json.dumps({"prompt_id": "123"}).encode()
-        mock_urlopen.return_value = mock_response
+        mock_response.content = b'{"prompt_id": "123"}'
+        mock_request.return_value = mock_response
         result = rp_handler.queue_workflow({"prompt": "test"})
         self.assertEqual(result, {"prompt_id": "123"})
 
-    @patch("rp_handler.urllib.request.urlopen")
-    def test_get_history(self, mock_urlopen):
-        # Mock response data as a JSON string
-        mock_response_data = json.dumps({"key": "value"}).encode("utf-8")
-
-        # Define a mock response function for `read`
-        def mock_read():
-            return mock_response_data
-
-        # Create a mock response object
-        mock_response = Mock()
-        mock_response.read = mock_read
-
-        # Mock the __enter__ and __exit__ methods to support the context manager
-        mock_response.__enter__ = lambda s: s
-        mock_response.__exit__ = Mock()
-
-        # Set the return value of the urlopen mock
-        mock_urlopen.return_value = mock_response
+    @patch.object(rp_handler.comfy.session, "request")
+    def test_get_history(self, mock_request):
+        mock_response = MagicMock()
+        mock_response.content = b'{"123": {"key": "value"}}'
+        mock_request.return_value = mock_response
 
         # Call the function under test
         result = rp_handler.get_history("123")
 
         # Assertions
-        self.assertEqual(result, {"key": "value"})
-        mock_urlopen.assert_called_with("http://127.0.0.1:8188/history/123")
+        self.assertEqual(result, {"123": {"key": "value"}})
+        mock_request.assert_called_with(
+            "GET", "http://127.0.0.1:8188/history/123", timeout=rp_handler.comfy.timeout
+        )
 
     @patch("builtins.open", new_callable=mock_open, read_data=b"test")
     def test_base64_encode(self, mock_file):
@@ -122,6 +220,18 @@ class TestRunpodWorkerComfy(unittest.TestCase):
 
         self.assertEqual(result, test_data)
 
+    @patch.object(rp_handler, "BASE64_CHUNK_BYTES", 6)
+    def test_base64_encode_in_chunks(self):
+        for size in (0, 1, 5, 6, 7, 12, 100):
+            data = os.urandom(size)
+            with tempfile.NamedTemporaryFile() as f:
+                f.write(data)
+                f.flush()
+
+                result = rp_handler.base64_encode(f.name)
+
+            self.assertEqual(result, base64.b64encode(data).decode("utf-8"))
+
     @patch("rp_handler.os.path.exists")
     @patch("rp_handler.rp_upload.upload_image")
     @patch.dict(
@@ -201,7 +311,7 @@ class TestRunpodWorkerComfy(unittest.TestCase):
         self.assertIn("simulated_uploaded", result["message"])
         self.assertEqual(result["status"], "success")
 
-    @patch("rp_handler.requests.post")
+    @patch.object(rp_handler.comfy.session, "request")
     def test_upload_images_successful(self, mock_post):
         mock_response = unittest.mock.Mock()
         mock_response.status_code = 200
@@ -217,7 +327,7 @@ class TestRunpodWorkerComfy(unittest.TestCase):
         self.assertEqual(len(responses), 3)
         self.assertEqual(responses["status"], "success")
 
-    @patch("rp_handler.requests.post")
+    @patch.object(rp_handler.comfy.session, "request")
     def test_upload_images_failed(self, mock_post):
         mock_response = unittest.mock.Mock()
         mock_response.status_code = 400
@@ -232,3 +342,2228 @@ class TestRunpodWorkerComfy(unittest.TestCase):
 
         self.assertEqual(len(responses), 3)
         self.assertEqual(responses["status"], "error")
+
+
+class TestJSON(unittest.TestCase):
+    def test_same_result_with_and_without_orjson(self):
+        value = {"3": {"inputs": {"seed": 2**63, "text": "Grüße", "cfg": 7.5}}}
+
+        for orjson in (rp_handler.orjson, None):
+            with patch.object(rp_handler, "orjson", orjson):
+                data = rp_handler.json_dumps(value)
+                self.assertEqual(json.loads(data), value)
+                self.assertEqual(rp_handler.json_loads(data), value)
+                self.assertEqual(rp_handler.json_loads(data.decode()), value)
+
+    def test_falls_back_to_the_json_module(self):
+        # Integers beyond 64 bits and NaN aren't supported by orjson
+        self.assertEqual(rp_handler.json_dumps({"seed": 2**70}), b'{"seed":%d}' % 2**70)
+        self.assertEqual(str(rp_handler.json_loads('{"v": NaN}')["v"]), "nan")
+
+        with self.assertRaises(json.JSONDecodeError):
+            rp_handler.json_loads("{")
+
+
+class TestComfyUIClient(unittest.TestCase):
+    def setUp(self):
+        self.client = rp_handler.ComfyUIClient("127.0.0.1:1", retries=2, backoff=0)
+
+    def test_get_is_retried_on_503(self):
+        unavailable, ok = MagicMock(status_code=503), MagicMock(status_code=200)
+        with patch.object(
+            self.client.session, "request", side_effect=[unavailable, unavailable, ok]
+        ) as mock_request:
+            response = self.client.get("/history/123")
+
+        self.assertIs(response, ok)
+        self.assertEqual(mock_request.call_count, 3)
+
+    def test_post_is_not_retried_after_read_timeout(self):
+        with patch.object(
+            self.client.session,
+            "request",
+            side_effect=rp_handler.requests.exceptions.ReadTimeout(),
+        ) as mock_request:
+            with self.assertRaises(rp_handler.requests.exceptions.ReadTimeout):
+                self.client.post("/prompt", data=b"{}")
+
+        self.assertEqual(mock_request.call_count, 1)
+
+    def test_post_is_retried_when_connection_is_refused(self):
+        with patch.object(
+            self.client.session, "request", wraps=self.client.session.request
+        ) as mock_request:
+            with self.assertRaises(rp_handler.requests.ConnectionError):
+                self.client.post("/prompt", data=b"{}")
+
+        self.assertEqual(mock_request.call_count, 3)
+
+    def test_requests_have_timeouts(self):
+        client = rp_handler.ComfyUIClient(connect_timeout=1, read_timeout=2)
+        with patch.object(client.session, "request") as mock_request:
+            client.get("/")
+
+        self.assertEqual(mock_request.call_args.kwargs["timeout"], (1, 2))
+
+    def test_connections_are_reused(self):
+        with FakeComfyUI() as fake:
+            client = rp_handler.ComfyUIClient(fake.host)
+            for _ in range(5):
+                client.get_history("123")
+
+            self.assertEqual(fake.connections, 1)
+
+    def test_requests_are_sent_straight_to_the_adapter(self):
+        with FakeComfyUI() as fake:
+            client = rp_handler.ComfyUIClient(fake.host)
+            with patch.object(
+                rp_handler.requests.Session, "prepare_request"
+            ) as mock_prepare:
+                self.assertIn("prompt_id", client.queue_prompt({}))
+                self.assertEqual(client.get_history("123"), {})
+
+            mock_prepare.assert_not_called()
+
+
+class TestUploadImages(HandlerTestCase):
+    def setUp(self):
+        self.fake = FakeComfyUI(upload_time=0.2).start()
+        self.addCleanup(self.fake.stop)
+        self.cache = rp_handler.InputImageCache(input_path=self.fake.input_dir)
+        self.patch_handler(
+            comfy=rp_handler.ComfyUIClient(self.fake.host),
+            input_image_cache=self.cache,
+        )
+
+    def read_input(self, name):
+        with open(os.path.join(self.fake.input_dir, name), "rb") as f:
+            return f.read()
+
+    @patch.object(rp_handler, "COMFY_UPLOAD_WORKERS", 4)
+    def test_images_are_uploaded_concurrently(self):
+        images = [
+            {
+                "name": f"image{i}.png",
+                "image": base64.b64encode(png_bytes(color=(i, 0, 0))).decode(),
+            }
+            for i in range(4)
+        ]
+
+        result, paths = rp_handler.upload_input_images(images)
+
+        self.assertEqual(result["status"], "success")
+        self.assertEqual(
+            result["details"], [f"Successfully uploaded image{i}.png" for i in range(4)]
+        )
+        self.assertGreater(self.fake.max_uploads_in_flight, 1)
+        self.assertLessEqual(self.fake.max_uploads_in_flight, 4)
+        for i in range(4):
+            self.assertEqual(
+                self.read_input(paths[f"image{i}.png"]), png_bytes(color=(i, 0, 0))
+            )
+
+    def test_failed_image_is_reported(self):
+        images = [
+            {"name": "good.png", "image": base64.b64encode(png_bytes()).decode()},
+            {"name": "bad.png", "image": "not base64!"},
+        ]
+
+        result = rp_handler.upload_images(images)
+
+        self.assertEqual(result["status"], "error")
+        self.assertEqual(len(result["details"]), 1)
+        self.assertIn("Error uploading bad.png", result["details"][0])
+
+    def test_identical_image_is_not_uploaded_again(self):
+        images = [
+            {"name": "style.png", "image": base64.b64encode(png_bytes()).decode()}
+        ]
+
+        rp_handler.upload_images(images)
+        result = rp_handler.upload_images(images)
+
+        self.assertEqual(result["status"], "success")
+        self.assertEqual(self.fake.count("/upload/image"), 1)
+
+    def test_different_image_with_same_name_is_uploaded(self):
+        paths = []
+        for color in ((255, 0, 0), (0, 255, 0)):
+            data = base64.b64encode(png_bytes(color=color)).decode()
+            _, uploaded = rp_handler.upload_input_images(
+                [{"name": "mask.png", "image": data}]
+            )
+            paths.append(uploaded["mask.png"])
+
+            self.assertEqual(self.read_input(paths[-1]), png_bytes(color=color))
+
+        self.assertEqual(self.fake.count("/upload/image"), 2)
+        # The first image is still there for the prompts that reference it
+        self.assertNotEqual(paths[0], paths[1])
+        self.assertEqual(self.read_input(paths[0]), png_bytes(color=(255, 0, 0)))
+
+    def test_least_recently_used_image_is_evicted(self):
+        self.cache.max_bytes = 2 * len(png_bytes())
+        images = {
+            name: [{"name": name, "image": base64.b64encode(png_bytes()).decode()}]
+            for name in ("a.png", "b.png", "c.png")
+        }
+
+        rp_handler.upload_images(images["a.png"])
+        _, paths = rp_handler.upload_input_images(images["b.png"])
+        rp_handler.upload_images(images["a.png"])
+        rp_handler.upload_images(images["c.png"])
+
+        self.assertEqual(self.fake.count("/upload/image"), 3)
+        # A queued prompt of another job may still reference the forgotten image
+        self.assertTrue(
+            os.path.exists(os.path.join(self.fake.input_dir, paths["b.png"]))
+        )
+        self.assertLessEqual(self.cache.total_bytes, self.cache.max_bytes)
+
+        rp_handler.upload_images(images["b.png"])
+        self.assertEqual(self.fake.count("/upload/image"), 4)
+
+    @patch.object(rp_handler, "BASE64_DECODE_CHUNK_SIZE", 8)
+    def test_decode_in_chunks(self):
+        data = os.urandom(100)
+        encoded = base64.encodebytes(data).decode()
+
+        with rp_handler.decode_base64_to_file(encoded) as blob:
+            self.assertEqual(blob.read(), data)
+        with rp_handler.decode_base64_to_file(
+            "data:image/png;base64," + base64.b64encode(data).decode()
+        ) as blob:
+            self.assertEqual(blob.read(), data)
+
+
+class TestImageURLs(HandlerTestCase):
+    def setUp(self):
+        self.fake = FakeComfyUI().start()
+        self.addCleanup(self.fake.stop)
+        self.files = FakeFileServer(response_time=0.2).start()
+        self.addCleanup(self.files.stop)
+        self.folder = tempfile.TemporaryDirectory()
+        self.addCleanup(self.folder.cleanup)
+        self.cache = rp_handler.DownloadCache(path=self.folder.name)
+        self.patch_handler(
+            comfy=rp_handler.ComfyUIClient(self.fake.host),
+            input_image_cache=rp_handler.InputImageCache(
+                input_path=self.fake.input_dir
+            ),
+            download_cache=self.cache,
+        )
+
+    def read_input(self, name):
+        with open(os.path.join(self.fake.input_dir, name), "rb") as f:
+            return f.read()
+
+    def upload(self, name, url):
+        result, paths = rp_handler.upload_input_images([{"name": name, "url": url}])
+        self.assertEqual(result["status"], "success", result)
+        self.paths = paths
+        return result
+
+    @patch.object(rp_handler, "COMFY_UPLOAD_WORKERS", 4)
+    def test_images_are_downloaded_concurrently(self):
+        images = [
+            {
+                "name": f"image{i}.png",
+                "url": self.files.add(f"/image{i}.png", png_bytes(color=(i, 0, 0))),
+            }
+            for i in range(4)
+        ]
+
+        result, paths = rp_handler.upload_input_images(images)
+
+        self.assertEqual(result["status"], "success", result)
+        self.assertGreater(self.files.max_in_flight, 1)
+        self.assertLessEqual(self.files.max_in_flight, 4)
+        for i in range(4):
+            self.assertEqual(
+                self.read_input(paths[f"image{i}.png"]), png_bytes(color=(i, 0, 0))
+            )
+
+    def test_unchanged_image_is_downloaded_once(self):
+        url = self.files.add("/style.png", png_bytes())
+
+        self.upload("style.png", url)
+        result = self.upload("style.png", url)
+
+        self.assertEqual(self.files.statuses("/style.png"), [200, 304])
+        self.assertEqual(self.fake.count("/upload/image"), 1)
+        self.assertIn("already in the input folder", result["details"][0])
+        self.assertEqual(self.cache.hits, 1)
+
+    def test_changed_image_is_downloaded_again(self):
+        url = self.files.add("/mask.png", png_bytes(color=(255, 0, 0)))
+        self.upload("mask.png", url)
+        self.files.add("/mask.png", png_bytes(color=(0, 255, 0)))
+
+        self.upload("mask.png", url)
+
+        self.assertEqual(self.files.statuses("/mask.png"), [200, 200])
+        self.assertEqual(self.fake.count("/upload/image"), 2)
+        self.assertEqual(
+            self.read_input(self.paths["mask.png"]), png_bytes(color=(0, 255, 0))
+        )
+
+    def test_image_without_etag_is_not_cached(self):
+        url = self.files.add("/dynamic.png", png_bytes(), etag=False)
+
+        self.upload("dynamic.png", url)
+        self.upload("dynamic.png", url)
+
+        self.assertEqual(self.files.statuses("/dynamic.png"), [200, 200])
+        self.assertEqual(self.fake.count("/upload/image"), 2)
+        self.assertEqual(self.cache.total_bytes, 0)
+        self.assertEqual(os.listdir(self.folder.name), [])
+
+    def test_least_recently_used_image_is_evicted(self):
+        self.cache.max_bytes = 2 * len(png_bytes())
+        urls = {
+            name: self.files.add(f"/{name}", png_bytes())
+            for name in ("a.png", "b.png", "c.png")
+        }
+
+        for name in ("a.png", "b.png", "a.png", "c.png", "b.png"):
+            self.upload(name, urls[name])
+
+        self.assertEqual(self.files.statuses("/a.png"), [200, 304])
+        self.assertEqual(self.files.statuses("/b.png"), [200, 200])
+        self.assertLessEqual(self.cache.total_bytes, self.cache.max_bytes)
+
+    def test_index_is_loaded_from_disk(self):
+        url = self.files.add("/style.png", png_bytes())
+        self.upload("style.png", url)
+
+        cache = rp_handler.DownloadCache(path=self.folder.name)
+        with patch.object(rp_handler, "download_cache", cache):
+            self.upload("other.png", url)
+
+        self.assertEqual(self.files.statuses("/style.png"), [200, 304])
+        self.assertEqual(self.read_input(self.paths["other.png"]), png_bytes())
+
+    def test_foreign_files_in_the_cache_are_skipped(self):
+        url = self.files.add("/style.png", png_bytes())
+        self.upload("style.png", url)
+        for name, content in (
+            ("list.json", "[1]"),
+            ("cut_off.json", '{"url": "http://exa'),
+            ("other.json", '{"name": "not from the cache"}'),
+        ):
+            with open(os.path.join(self.folder.name, name), "w") as f:
+                f.write(content)
+            # The image that the entry belongs to
+            open(os.path.join(self.folder.name, name[: -len(".json")]), "w").close()
+
+        cache = rp_handler.DownloadCache(path=self.folder.name)
+
+        self.assertEqual(list(cache._entries), [url])
+
+    def test_failed_download_is_reported(self):
+        result = rp_handler.upload_images(
+            [{"name": "missing.png", "url": self.files.url("/missing.png")}]
+        )
+
+        self.assertEqual(result["status"], "error")
+        self.assertIn("Error downloading missing.png", result["details"][0])
+        self.assertIn("404", result["details"][0])
+
+    def test_image_is_downloaded_from_s3(self):
+        with FakeS3() as s3, patch.dict(
+            os.environ,
+            {
+                "BUCKET_ENDPOINT_URL": s3.endpoint_url,
+                "BUCKET_ACCESS_KEY_ID": "key",
+                "BUCKET_SECRET_ACCESS_KEY": "secret",
+            },
+        ):
+            s3.objects["assets", "faces/face.png"] = {
+                "body": png_bytes(),
+                "content_type": "image/png",
+                "parts": 0,
+            }
+            self.upload("face.png", "s3://assets/faces/face.png")
+            self.upload("face.png", "s3://assets/faces/face.png")
+
+        self.assertEqual(self.read_input(self.paths["face.png"]), png_bytes())
+        self.assertEqual(self.cache.hits, 1)
+
+    @patch.dict(os.environ, {"BUCKET_ENDPOINT_URL": ""})
+    def test_s3_needs_a_bucket(self):
+        result = rp_handler.upload_images(
+            [{"name": "face.png", "url": "s3://assets/face.png"}]
+        )
+
+        self.assertEqual(result["status"], "error")
+        self.assertIn("BUCKET_ENDPOINT_URL", result["details"][0])
+
+
+class TestInputStaging(HandlerTestCase):
+    def setUp(self):
+        self.fake = FakeComfyUI().start()
+        self.addCleanup(self.fake.stop)
+        self.folder = tempfile.TemporaryDirectory()
+        self.addCleanup(self.folder.cleanup)
+        self.staging = rp_handler.InputStaging("auto", self.fake.input_dir)
+        self.patch_handler(
+            comfy=rp_handler.ComfyUIClient(self.fake.host),
+            input_image_cache=rp_handler.InputImageCache(
+                input_path=self.fake.input_dir
+            ),
+            download_cache=rp_handler.DownloadCache(path=self.folder.name),
+            input_staging=self.staging,
+        )
+
+    def read_input(self, name):
+        with open(os.path.join(self.fake.input_dir, name), "rb") as f:
+            return f.read()
+
+    def test_images_are_written_into_the_shared_input_folder(self):
+        images = [
+            {
+                "name": f"image{i}.png",
+                "image": base64.b64encode(png_bytes(color=(i, 0, 0))).decode(),
+            }
+            for i in range(3)
+        ]
+
+        result, paths = rp_handler.upload_input_images(images)
+
+        self.assertEqual(result["status"], "success", result)
+        self.assertTrue(self.staging.local)
+        self.assertEqual(self.fake.count("/upload/image"), 0)
+        for i in range(3):
+            self.assertEqual(
+                self.read_input(paths[f"image{i}.png"]), png_bytes(color=(i, 0, 0))
+            )
+        # Only the images are left, no staging folders or files of the check
+        self.assertEqual(
+            sorted(os.listdir(self.fake.input_dir)),
+            [".staging", rp_handler.INPUT_CACHE_FOLDER],
+        )
+        self.assertEqual(os.listdir(os.path.join(self.fake.input_dir, ".staging")), [])
+
+    def test_identical_image_is_not_written_again(self):
+        images = [
+            {"name": "style.png", "image": base64.b64encode(png_bytes()).decode()}
+        ]
+
+        rp_handler.upload_images(images)
+        result = rp_handler.upload_images(images)
+
+        self.assertIn("already in the input folder", result["details"][0])
+
+    def test_downloaded_images_are_written_into_the_input_folder(self):
+        with FakeFileServer() as files:
+            url = files.add("/face.png", png_bytes())
+            result, paths = rp_handler.upload_input_images(
+                [{"name": "face.png", "url": url}]
+            )
+
+        self.assertEqual(result["status"], "success", result)
+        self.assertEqual(self.fake.count("/upload/image"), 0)
+        self.assertEqual(self.read_input(paths["face.png"]), png_bytes())
+
+    def test_names_outside_of_the_input_folder_are_rejected(self):
+        data = base64.b64encode(png_bytes()).decode()
+
+        result = rp_handler.upload_images([{"name": "../evil.png", "image": data}])
+
+        self.assertEqual(result["status"], "error")
+        self.assertIn("outside of the input folder", result["details"][0])
+
+    def test_images_are_uploaded_if_comfyui_reads_another_folder(self):
+        staging = rp_handler.InputStaging("auto", self.folder.name)
+        data = base64.b64encode(png_bytes()).decode()
+
+        with patch.object(rp_handler, "input_staging", staging):
+            result = rp_handler.upload_images([{"name": "a.png", "image": data}])
+
+        self.assertEqual(result["status"], "success", result)
+        self.assertFalse(staging.local)
+        self.assertEqual(self.fake.count("/upload/image"), 1)
+        self.assertEqual(os.listdir(self.folder.name), [])
+
+    def test_images_are_uploaded_in_the_http_mode(self):
+        staging = rp_handler.InputStaging("http", self.fake.input_dir)
+        data = base64.b64encode(png_bytes()).decode()
+
+        with patch.object(rp_handler, "input_staging", staging):
+            rp_handler.upload_images([{"name": "a.png", "image": data}])
+
+        self.assertEqual(self.fake.count("/upload/image"), 1)
+        self.assertEqual(self.fake.count("/view"), 0)
+
+
+class TestOutputImages(HandlerTestCase):
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.output_dir = tmp.name
+        self.patch_env(COMFY_OUTPUT_PATH=self.output_dir)
+
+    def write_output(self, filename, content):
+        with open(os.path.join(self.output_dir, filename), "wb") as f:
+            f.write(content)
+        return {"filename": filename, "subfolder": "", "type": "output"}
+
+    def test_every_image_is_returned_in_node_order(self):
+        outputs = {
+            "10": {
+                "images": [
+                    self.write_output("b_00001_.png", b"b1"),
+                    self.write_output("b_00002_.png", b"b2"),
+                ]
+            },
+            "9": {"images": [self.write_output("a_00001_.png", b"a1")]},
+            "11": {
+                "images": [{"filename": "preview.png", "subfolder": "", "type": "temp"}]
+            },
+        }
+
+        result = rp_handler.process_output_images(outputs, "123")
+
+        self.assertEqual(result["status"], "success")
+        self.assertEqual(
+            [(image["node_id"], image["filename"]) for image in result["images"]],
+            [("9", "a_00001_.png"), ("10", "b_00001_.png"), ("10", "b_00002_.png")],
+        )
+        self.assertEqual(
+            [base64.b64decode(image["data"]) for image in result["images"]],
+            [b"a1", b"b1", b"b2"],
+        )
+        self.assertEqual(result["message"], result["images"][0]["data"])
+        self.assertNotIn("errors", result)
+
+    def test_missing_image_is_reported(self):
+        outputs = {
+            "9": {
+                "images": [
+                    self.write_output("a.png", b"a"),
+                    {"filename": "missing.png", "subfolder": "", "type": "output"},
+                ]
+            }
+        }
+
+        result = rp_handler.process_output_images(outputs, "123")
+
+        self.assertEqual(result["status"], "success")
+        self.assertEqual(len(result["images"]), 1)
+        self.assertEqual(len(result["errors"]), 1)
+        self.assertIn("missing.png", result["errors"][0])
+
+    @patch.dict(os.environ, {"BUCKET_ENDPOINT_URL": "http://example.com"})
+    @patch.object(rp_handler, "COMFY_OUTPUT_WORKERS", 8)
+    @patch("rp_handler.rp_upload.upload_image")
+    def test_images_are_uploaded_concurrently(self, mock_upload_image):
+        def upload(job_id, path):
+            time.sleep(0.2)
+            return f"http://example.com/{os.path.basename(path)}"
+
+        mock_upload_image.side_effect = upload
+        outputs = {
+            "9": {
+                "images": [
+                    self.write_output(f"image_{i:05}_.png", b"image") for i in range(8)
+                ]
+            }
+        }
+
+        started = time.monotonic()
+        result = rp_handler.process_output_images(outputs, "123")
+        elapsed = time.monotonic() - started
+
+        self.assertEqual(
+            [image["data"] for image in result["images"]],
+            [f"http://example.com/image_{i:05}_.png" for i in range(8)],
+        )
+        self.assertTrue(all(image["type"] == "s3_url" for image in result["images"]))
+        self.assertLess(elapsed, 0.8)
+
+    def test_batch_and_multiple_save_nodes(self):
+        with open("./test_resources/workflows/workflow_webp.json") as f:
+            workflow = json.load(f)["input"]["workflow"]
+        workflow = copy.deepcopy(workflow)
+        workflow["5"]["inputs"]["batch_size"] = 2
+        workflow["13"] = {
+            "inputs": {"filename_prefix": "ComfyUI", "images": ["8", 0]},
+            "class_type": "SaveImage",
+        }
+
+        with FakeComfyUI(output_dir=self.output_dir) as fake, patch.object(
+            rp_handler, "comfy", rp_handler.ComfyUIClient(fake.host)
+        ):
+            result = rp_handler.handler({"id": "1", "input": {"workflow": workflow}})
+
+        self.assertEqual(result["status"], "success")
+        self.assertEqual(
+            [image["node_id"] for image in result["images"]], ["10", "10", "13", "13"]
+        )
+
+    def test_images_are_transcoded(self):
+        outputs = {
+            "9": {"images": [self.write_output("a.png", png_bytes(64, 32))]},
+        }
+        options = {"format": "webp", "quality": 50, "max_dimension": 16}
+
+        result = rp_handler.process_output_images(outputs, "123", options=options)
+
+        image = result["images"][0]
+        self.assertEqual(image["filename"], "a.webp")
+        self.assertEqual(image["original_bytes"], len(png_bytes(64, 32)))
+        data = base64.b64decode(image["data"])
+        self.assertEqual(image["bytes"], len(data))
+        with rp_handler.Image.open(BytesIO(data)) as img:
+            self.assertEqual(img.format, "WEBP")
+            self.assertEqual(img.size, (16, 8))
+
+    def test_images_are_kept_without_options(self):
+        outputs = {"9": {"images": [self.write_output("a.png", png_bytes())]}}
+
+        result = rp_handler.process_output_images(outputs, "123")
+
+        image = result["images"][0]
+        self.assertEqual(base64.b64decode(image["data"]), png_bytes())
+        self.assertNotIn("bytes", image)
+
+    @patch.dict(os.environ, {"BUCKET_ENDPOINT_URL": "http://example.com"})
+    @patch("rp_handler.rp_upload.upload_image")
+    def test_transcoded_images_are_uploaded(self, mock_upload_image):
+        uploaded = {}
+
+        def upload(job_id, path):
+            with open(path, "rb") as f:
+                uploaded[os.path.basename(path)] = f.read()
+            return f"http://example.com/{os.path.basename(path)}"
+
+        mock_upload_image.side_effect = upload
+        outputs = {"9": {"images": [self.write_output("a.png", png_bytes())]}}
+
+        result = rp_handler.process_output_images(
+            outputs, "123", options={"format": "jpeg"}
+        )
+
+        self.assertEqual(result["images"][0]["data"], "http://example.com/a.jpeg")
+        self.assertEqual(len(uploaded["a.jpeg"]), result["images"][0]["bytes"])
+        self.assertTrue(uploaded["a.jpeg"].startswith(b"\xff\xd8"))
+
+    def test_videos_and_animations_are_returned(self):
+        outputs = {
+            "9": {"images": [self.write_output("a.png", png_bytes())]},
+            "12": {
+                "gifs": [
+                    {
+                        **self.write_output("clip_00001.mp4", b"mp4"),
+                        "format": "video/h264-mp4",
+                    },
+                    self.write_output("clip_00001.gif", b"GIF89a"),
+                ]
+            },
+        }
+
+        result = rp_handler.process_output_images(
+            outputs, "123", options={"format": "webp"}
+        )
+
+        self.assertEqual(
+            [(image["node_id"], image["filename"]) for image in result["images"]],
+            [("9", "a.webp"), ("12", "clip_00001.mp4"), ("12", "clip_00001.gif")],
+        )
+        self.assertEqual(base64.b64decode(result["images"][1]["data"]), b"mp4")
+        self.assertNotIn("bytes", result["images"][1])
+
+    @patch.object(rp_handler, "COMFY_BASE64_MAX_BYTES", 1024)
+    def test_files_bigger_than_the_base64_limit_are_reported(self):
+        outputs = {
+            "9": {"images": [self.write_output("a.png", png_bytes())]},
+            "12": {"videos": [self.write_output("clip.mp4", os.urandom(2048))]},
+        }
+
+        result = rp_handler.process_output_images(outputs, "123")
+
+        self.assertEqual([image["filename"] for image in result["images"]], ["a.png"])
+        self.assertIn("COMFY_BASE64_MAX_BYTES", result["errors"][0])
+
+    @patch.object(rp_handler, "COMFY_S3_PART_SIZE_BYTES", 5 * 1024 * 1024)
+    @patch.object(rp_handler, "COMFY_S3_UPLOAD_CONCURRENCY", 4)
+    def test_big_files_are_uploaded_in_parts(self):
+        video = os.urandom(21 * 1024 * 1024)
+        outputs = {"12": {"gifs": [self.write_output("clip.mp4", video)]}}
+
+        with FakeS3(part_time=0.1) as s3, patch.dict(
+            os.environ,
+            {
+                "BUCKET_ENDPOINT_URL": s3.endpoint_url,
+                "BUCKET_ACCESS_KEY_ID": "key",
+                "BUCKET_SECRET_ACCESS_KEY": "secret",
+            },
+        ):
+            result = rp_handler.process_output_images(outputs, "123")
+
+        self.assertEqual(result["status"], "success", result)
+        self.assertEqual(result["images"][0]["type"], "s3_url")
+        (bucket, key), uploaded = next(iter(s3.objects.items()))
+        self.assertIn(f"/{bucket}/{key}", result["images"][0]["data"])
+        self.assertTrue(key.startswith("123/") and key.endswith(".mp4"))
+        self.assertEqual(uploaded["content_type"], "video/mp4")
+        self.assertEqual(uploaded["parts"], 5)
+        self.assertEqual(uploaded["body"], video)
+        self.assertGreater(s3.max_in_flight_parts, 1)
+        self.assertLessEqual(s3.max_in_flight_parts, 4)
+
+
+class TestCompletionDetection(HandlerTestCase):
+    def setUp(self):
+        self.fake = FakeComfyUI(execution_time=0.2).start()
+        self.addCleanup(self.fake.stop)
+        self.patch_handler(comfy=rp_handler.ComfyUIClient(self.fake.host))
+        self.patch_env(COMFY_OUTPUT_PATH=self.fake.output_dir)
+
+    def run_job(self):
+        job = {"id": "job-1", "input": {"workflow": WORKFLOW}}
+        return rp_handler.handler(job)
+
+    @patch.object(rp_handler, "COMFY_COMPLETION_MODE", "websocket")
+    def test_websocket_mode_does_not_poll(self):
+        result = self.run_job()
+
+        self.assertEqual(result["status"], "success")
+        # Only the final history lookup to read the outputs
+        self.assertEqual(self.fake.count("/history"), 1)
+
+    @patch.object(rp_handler, "COMFY_COMPLETION_MODE", "polling")
+    def test_polling_mode(self):
+        result = self.run_job()
+
+        self.assertEqual(result["status"], "success")
+        self.assertGreater(self.fake.count("/queue"), 1)
+        # The history is only read once the prompt left the queue
+        self.assertEqual(self.fake.count("/history"), 1)
+
+    @patch.object(rp_handler, "COMFY_COMPLETION_MODE", "websocket")
+    def test_falls_back_to_polling_when_websocket_drops(self):
+        threading.Timer(0.05, self.fake.drop_websockets).start()
+
+        result = self.run_job()
+
+        self.assertEqual(result["status"], "success")
+        self.assertGreater(self.fake.count("/queue"), 0)
+
+    @patch.object(rp_handler, "COMFY_COMPLETION_MODE", "polling")
+    @patch.object(rp_handler, "COMFY_POLLING_MIN_INTERVAL_MS", 10)
+    @patch.object(rp_handler, "COMFY_POLLING_MAX_INTERVAL_MS", 100)
+    def test_polling_backs_off(self):
+        self.fake.execution_time = 1
+
+        result = self.run_job()
+
+        self.assertEqual(result["status"], "success")
+        # 10, 15, 22, ... and then every 100 ms instead of every 10 ms
+        self.assertLess(self.fake.count("/queue"), 16)
+        gaps = self.fake.gaps("/queue")
+        for index, gap in enumerate(gaps):
+            self.assertGreaterEqual(gap, min(0.01 * 1.5**index, 0.1) * 0.9)
+        self.assertGreaterEqual(gaps[-1], 0.09)
+
+    @patch.object(rp_handler, "COMFY_POLLING_MIN_INTERVAL_MS", 10)
+    @patch.object(rp_handler, "COMFY_POLLING_MAX_INTERVAL_MS", 1000)
+    def test_polling_tightens_when_prompt_moves_up(self):
+        first = rp_handler.queue_workflow(WORKFLOW)["prompt_id"]
+        second = rp_handler.queue_workflow(WORKFLOW)["prompt_id"]
+        self.assertEqual(rp_handler.get_queue_position(second), 1)
+
+        polls_before = self.fake.count("/queue")
+        deadline = time.monotonic() + 5
+        history = rp_handler.wait_for_prompt_polling(second, deadline)
+
+        self.assertTrue(rp_handler.has_outputs(history, second))
+        self.assertIsNone(rp_handler.get_queue_position(first))
+        # Backing off for the whole time, every poll after the first prompt finished
+        # would have come later than the one before
+        started = self.fake.completed_at[first]
+        times = self.fake.request_times["/queue"][polls_before:-1]
+        before = [b - a for a, b in zip(times, times[1:]) if b <= started]
+        after = [b - a for a, b in zip(times, times[1:]) if a >= started]
+        self.assertLess(min(after), max(before))
+
+    def test_polls_only_parse_responses_about_the_prompt(self):
+        self.fake.execution_time = 0.5
+        prompt_id = rp_handler.queue_workflow(WORKFLOW)["prompt_id"]
+
+        with patch.object(
+            rp_handler, "json_loads", wraps=rp_handler.json_loads
+        ) as json_loads:
+            self.assertEqual(rp_handler.get_history(prompt_id), {})
+            self.assertIsNone(rp_handler.get_queue_position("another-prompt"))
+            self.assertEqual(json_loads.call_count, 0)
+
+            self.assertEqual(rp_handler.get_queue_position(prompt_id), 0)
+            self.assertEqual(json_loads.call_count, 1)
+
+        deadline = time.monotonic() + 5
+        history = rp_handler.wait_for_prompt_polling(prompt_id, deadline)
+        self.assertTrue(rp_handler.has_outputs(history, prompt_id))
+
+    @patch.object(rp_handler, "COMFY_COMPLETION_MODE", "polling")
+    def test_timeout_from_input(self):
+        self.fake.execution_time = 5
+        job = {"id": "job-1", "input": {"workflow": WORKFLOW, "timeout": 0.05}}
+
+        result = rp_handler.handler(job)
+
+        self.assertEqual(
+            result, {"error": "Timeout reached while waiting for image generation"}
+        )
+        # The prompt was still running and was cancelled
+        self.assertEqual(self.fake.interrupts, 1)
+        self.assertEqual(self.fake.count("/history"), 0)
+
+    @patch.object(rp_handler, "COMFY_COMPLETION_MODE", "websocket")
+    @patch.object(rp_handler, "COMFY_JOB_TIMEOUT_S", 0.05)
+    def test_default_timeout_with_websocket(self):
+        result = self.run_job()
+
+        self.assertEqual(
+            result, {"error": "Timeout reached while waiting for image generation"}
+        )
+
+    @patch.object(rp_handler, "COMFY_COMPLETION_MODE", "websocket")
+    def test_websocket_reports_execution_error(self):
+        self.fake.fail_prompts("4", "Checkpoint not found")
+
+        result = self.run_job()
+
+        self.assertIn("Checkpoint not found", result["error"])
+
+
+class TestGeneratorHandler(HandlerTestCase):
+    def setUp(self):
+        self.fake = FakeComfyUI(execution_time=0.5).start()
+        self.addCleanup(self.fake.stop)
+        self.patch_handler(comfy=rp_handler.ComfyUIClient(self.fake.host))
+        self.patch_env(COMFY_OUTPUT_PATH=self.fake.output_dir)
+
+        # A second sampler runs after the first SaveImage node
+        self.workflow = copy.deepcopy(WORKFLOW)
+        self.workflow["10"] = {
+            "inputs": {"steps": 5, "samples": ["3", 0]},
+            "class_type": "KSampler",
+        }
+
+    def stream(self):
+        updates = []
+        for update in rp_handler.generator_handler(
+            {"id": "job-1", "input": {"workflow": self.workflow}}
+        ):
+            updates.append((time.monotonic(), update))
+        return updates
+
+    def test_streams_progress_and_images_before_the_end(self):
+        updates = self.stream()
+        statuses = [update["status"] for _, update in updates]
+
+        progress = [u for _, u in updates if u["status"] == "progress"]
+        self.assertEqual(
+            progress[0], {"status": "progress", "node_id": "3", "step": 1, "total": 20}
+        )
+        self.assertEqual(len(progress), 25)
+        self.assertIn("executing", statuses)
+
+        outputs = [(t, u) for t, u in updates if u["status"] == "output"]
+        self.assertEqual(len(outputs), 1)
+        streamed_at, output = outputs[0]
+        self.assertEqual(output["node_id"], "9")
+        self.assertEqual(output["images"][0]["type"], "base64")
+        prompt_id = next(iter(self.fake.completed_at))
+        self.assertLess(streamed_at, self.fake.completed_at[prompt_id])
+
+        final = updates[-1][1]
+        self.assertEqual(final["status"], "success")
+        # The streamed image is only referenced, /run returns every update
+        self.assertEqual(
+            final["images"],
+            [
+                {
+                    "node_id": "9",
+                    "filename": output["images"][0]["filename"],
+                    "type": "base64",
+                    "streamed": True,
+                }
+            ],
+        )
+        self.assertIsNone(final["message"])
+
+    def test_final_result_when_websocket_drops(self):
+        threading.Timer(0.05, self.fake.drop_websockets).start()
+
+        final = self.stream()[-1][1]
+
+        self.assertEqual(final["status"], "success")
+        self.assertEqual([image["node_id"] for image in final["images"]], ["9"])
+        # Images that weren't streamed are in the result with their data
+        self.assertEqual(final["message"], final["images"][0]["data"])
+
+    def test_streams_error(self):
+        self.fake.fail_prompts("4", "Checkpoint not found")
+
+        final = self.stream()[-1][1]
+
+        self.assertIn("Checkpoint not found", final["error"])
+
+
+class TestConcurrentJobs(HandlerTestCase):
+    def setUp(self):
+        self.fake = FakeComfyUI(execution_time=0.2, upload_time=0.1).start()
+        self.addCleanup(self.fake.stop)
+        self.patch_handler(
+            comfy=rp_handler.ComfyUIClient(self.fake.host),
+            input_image_cache=rp_handler.InputImageCache(),
+            job_executor=rp_handler.ThreadPoolExecutor(max_workers=3),
+        )
+        self.patch_env(COMFY_OUTPUT_PATH=self.fake.output_dir)
+
+    def jobs(self, count):
+        return [
+            {
+                "id": f"job-{i}",
+                "input": {
+                    "workflow": WORKFLOW,
+                    "images": [
+                        {
+                            "name": f"input_{i}.png",
+                            "image": base64.b64encode(
+                                png_bytes(color=(i, 0, 0))
+                            ).decode(),
+                        }
+                    ],
+                },
+            }
+            for i in range(count)
+        ]
+
+    @patch.object(rp_handler, "COMFY_CONCURRENCY", 3)
+    def test_concurrency_modifier(self):
+        self.assertEqual(rp_handler.concurrency_modifier(1), 3)
+
+    @patch.object(rp_handler, "COMFY_CONCURRENCY", 3)
+    @patch.object(rp_handler, "COMFY_STREAM_OUTPUT", False)
+    @patch.object(rp_handler.runpod.serverless, "start")
+    def test_worker_config(self, mock_start):
+        rp_handler.start_worker()
+
+        mock_start.assert_called_once_with(
+            {
+                "handler": rp_handler.async_handler,
+                "concurrency_modifier": rp_handler.concurrency_modifier,
+            }
+        )
+
+    @patch.object(rp_handler, "COMFY_CONCURRENCY", 3)
+    @patch.object(rp_handler, "COMFY_STREAM_OUTPUT", True)
+    @patch.object(rp_handler, "REFRESH_WORKER", True)
+    @patch.object(rp_handler.runpod.serverless, "start")
+    def test_streaming_worker_config(self, mock_start):
+        rp_handler.start_worker()
+
+        mock_start.assert_called_once_with(
+            {
+                "handler": rp_handler.async_generator_handler,
+                "return_aggregate_stream": True,
+                "refresh_worker": True,
+                "concurrency_modifier": rp_handler.concurrency_modifier,
+            }
+        )
+
+    @patch.object(rp_handler, "COMFY_CONCURRENCY", 1)
+    @patch.object(rp_handler, "COMFY_STREAM_OUTPUT", False)
+    @patch.object(rp_handler.runpod.serverless, "start")
+    def test_single_job_worker_config(self, mock_start):
+        rp_handler.start_worker()
+
+        mock_start.assert_called_once_with({"handler": rp_handler.handler})
+
+    def test_next_prompt_is_queued_while_comfyui_is_busy(self):
+        async def run_all():
+            return await asyncio.gather(
+                *(rp_handler.async_handler(job) for job in self.jobs(3))
+            )
+
+        results = asyncio.run(run_all())
+
+        self.assertEqual([r["status"] for r in results], ["success"] * 3)
+        queued = sorted(self.fake.queued_at.values())
+        completed = sorted(self.fake.completed_at.values())
+        # The uploads of the other jobs didn't wait for the first prompt to finish
+        self.assertLess(queued[-1], completed[0])
+
+    def same_name_jobs(self, colors):
+        workflow = {
+            **WORKFLOW,
+            "20": {"class_type": "LoadImage", "inputs": {"image": "mask.png"}},
+        }
+        return [
+            {
+                "id": f"job-{i}",
+                "input": {
+                    "workflow": workflow,
+                    "images": [
+                        {
+                            "name": "mask.png",
+                            "image": base64.b64encode(png_bytes(color=color)).decode(),
+                        }
+                    ],
+                },
+            }
+            for i, color in enumerate(colors)
+        ]
+
+    def run_concurrently(self, jobs):
+        async def run_all():
+            return await asyncio.gather(*(rp_handler.async_handler(j) for j in jobs))
+
+        return asyncio.run(run_all())
+
+    def test_images_with_the_same_name_do_not_collide(self):
+        colors = [(255, 0, 0), (0, 255, 0)]
+        jobs = self.same_name_jobs(colors)
+
+        results = self.run_concurrently(jobs)
+
+        self.assertEqual([r["status"] for r in results], ["success"] * 2)
+        # Every prompt read the image of its own job
+        loaded = [images["20"] for images in self.fake.loaded_images.values()]
+        self.assertCountEqual(loaded, [png_bytes(color=color) for color in colors])
+        self.assertEqual(
+            jobs[0]["input"]["workflow"]["20"]["inputs"]["image"], "mask.png"
+        )
+
+    def test_uncached_images_are_kept_in_the_folder_of_the_job(self):
+        colors = [(255, 0, 0), (0, 255, 0)]
+        self.patch_handler(input_image_cache=rp_handler.InputImageCache(max_bytes=0))
+        for mode in ("local", "http"):
+            with self.subTest(mode=mode), patch.object(
+                rp_handler,
+                "input_staging",
+                rp_handler.InputStaging(mode, self.fake.input_dir),
+            ):
+                self.fake.loaded_images.clear()
+
+                results = self.run_concurrently(self.same_name_jobs(colors))
+
+                self.assertEqual([r["status"] for r in results], ["success"] * 2)
+                loaded = [images["20"] for images in self.fake.loaded_images.values()]
+                self.assertCountEqual(
+                    loaded, [png_bytes(color=color) for color in colors]
+                )
+                # The folders of the jobs are deleted once their prompts are done
+                self.assertEqual(
+                    [
+                        name
+                        for name in os.listdir(self.fake.input_dir)
+                        if name != ".staging"
+                    ],
+                    [],
+                )
+
+    def test_async_generator_handler(self):
+        async def collect(job):
+            return [update async for update in rp_handler.async_generator_handler(job)]
+
+        updates = asyncio.run(collect(self.jobs(1)[0]))
+
+        self.assertEqual(updates[-1]["status"], "success")
+        self.assertIn("progress", [update["status"] for update in updates])
+
+
+class TestReadiness(HandlerTestCase):
+    def setUp(self):
+        self.fake = FakeComfyUI().start()
+        self.addCleanup(self.fake.stop)
+        self.client = rp_handler.ComfyUIClient(self.fake.host, retries=0)
+        self.readiness = rp_handler.ComfyUIReadiness(
+            startup_timeout=2, max_failures=2, interval_ms=10, max_interval_ms=50
+        )
+        self.patch_handler(
+            comfy=self.client,
+            readiness=self.readiness,
+            input_image_cache=rp_handler.InputImageCache(),
+            # Only count the requests of the jobs themselves
+            COMFY_VALIDATE_WORKFLOW=False,
+        )
+        self.patch_env(COMFY_OUTPUT_PATH=self.fake.output_dir)
+
+    def run_job(self):
+        return rp_handler.handler({"id": "job-1", "input": {"workflow": WORKFLOW}})
+
+    def test_probes_only_once(self):
+        for _ in range(3):
+            self.assertEqual(self.run_job()["status"], "success")
+
+        self.assertEqual(self.readiness.state, "ready")
+        self.assertEqual(self.fake.count("/"), 1)
+
+    def test_startup_timeout(self):
+        self.client.host = "127.0.0.1:1"
+        self.readiness.startup_timeout = 0.2
+
+        started = time.monotonic()
+        result = self.run_job()
+
+        self.assertIn("did not become ready within 0.2 seconds", result["error"])
+        self.assertLess(time.monotonic() - started, 1)
+
+    def test_fails_fast_while_down_and_recovers(self):
+        self.assertIsNone(self.readiness.check())
+
+        # ComfyUI goes away
+        self.client.host = "127.0.0.1:1"
+        for _ in range(2):
+            self.assertIn("Error queuing workflow", self.run_job()["error"])
+
+        with patch.object(
+            self.client, "request", wraps=self.client.request
+        ) as mock_request:
+            result = self.run_job()
+        self.assertEqual(
+            result, {"error": "ComfyUI at http://127.0.0.1:1 is not reachable"}
+        )
+        # The job gave up without sending anything
+        mock_request.assert_not_called()
+        self.assertEqual(self.readiness.state, "down")
+
+        # ComfyUI is back
+        self.client.host = self.fake.host
+        deadline = time.monotonic() + 2
+        while self.readiness.state != "ready" and time.monotonic() < deadline:
+            time.sleep(0.01)
+        self.assertEqual(self.run_job()["status"], "success")
+
+
+class TestCancellation(HandlerTestCase):
+    def setUp(self):
+        self.patch_handler(
+            readiness=rp_handler.ComfyUIReadiness(),
+            input_image_cache=rp_handler.InputImageCache(),
+            in_flight_prompts={},
+        )
+
+    def fake_comfyui(self, execution_time=0.6, targeted_interrupt=True):
+        fake = FakeComfyUI(
+            execution_time=execution_time, targeted_interrupt=targeted_interrupt
+        ).start()
+        self.addCleanup(fake.stop)
+        self.patch_handler(comfy=rp_handler.ComfyUIClient(fake.host))
+        self.patch_env(COMFY_OUTPUT_PATH=fake.output_dir)
+        return fake
+
+    def timed_out_prompt(self, fake):
+        """The history of the prompt of a timed out job once the next job is done"""
+        timed_out = {"id": "job-1", "input": {"workflow": WORKFLOW, "timeout": 0.1}}
+        self.assertIn("Timeout reached", rp_handler.handler(timed_out)["error"])
+
+        result = rp_handler.handler({"id": "job-2", "input": {"workflow": WORKFLOW}})
+        self.assertEqual(result["status"], "success")
+        first = list(fake.queued_at)[0]
+        return fake.history[first]
+
+    def test_next_job_does_not_wait_for_the_timed_out_prompt(self):
+        fake = self.fake_comfyui()
+        with patch.object(rp_handler, "cancel_prompt"):
+            history = self.timed_out_prompt(fake)
+        # Without cancellation the next prompt waits until this one finished
+        self.assertEqual(history["status"]["status_str"], "success")
+
+        fake = self.fake_comfyui()
+        history = self.timed_out_prompt(fake)
+
+        self.assertEqual(fake.interrupts, 1)
+        self.assertEqual(history["status"]["status_str"], "error")
+        self.assertEqual(history["outputs"], {})
+        self.assertEqual(rp_handler.in_flight_prompts, {})
+
+    def test_pending_prompt_is_deleted(self):
+        fake = self.fake_comfyui(execution_time=0.2)
+        first = rp_handler.queue_workflow(WORKFLOW)["prompt_id"]
+        second = rp_handler.queue_workflow(WORKFLOW)["prompt_id"]
+
+        rp_handler.cancel_prompt(second)
+
+        self.assertIsNone(rp_handler.get_queue_position(second))
+        # The prompt of the other job keeps running
+        self.assertEqual(fake.interrupts, 0)
+        history, error = rp_handler.wait_for_completion(first)
+        self.assertIsNone(error)
+        self.assertNotIn(second, fake.history)
+
+    def test_finished_prompt_does_not_interrupt_the_next_one(self):
+        # Like ComfyUI 0.3.26, /interrupt stops whatever runs
+        fake = self.fake_comfyui(execution_time=0.3, targeted_interrupt=False)
+        first = rp_handler.queue_workflow(WORKFLOW)["prompt_id"]
+        rp_handler.wait_for_completion(first)
+        second = rp_handler.queue_workflow(WORKFLOW)["prompt_id"]
+        while rp_handler.get_queue_position(second) != 0:
+            time.sleep(0.01)
+
+        rp_handler.cancel_prompt(first)
+
+        self.assertEqual(fake.interrupts, 0)
+        history, error = rp_handler.wait_for_completion(second)
+        self.assertIsNone(error)
+
+    def test_cancelled_async_job_interrupts_prompt(self):
+        fake = self.fake_comfyui(execution_time=5)
+        job = {"id": "job-1", "input": {"workflow": WORKFLOW}}
+
+        async def cancel_after_start():
+            task = asyncio.ensure_future(rp_handler.async_handler(job))
+            while not rp_handler.in_flight_prompts:
+                await asyncio.sleep(0.01)
+            task.cancel()
+            with self.assertRaises(asyncio.CancelledError):
+                await task
+
+        started = time.monotonic()
+        asyncio.run(cancel_after_start())
+
+        self.assertLess(time.monotonic() - started, 1)
+        self.assertEqual(fake.interrupts, 1)
+
+
+class TestExecutionErrors(HandlerTestCase):
+    def setUp(self):
+        self.fake = FakeComfyUI(execution_time=0.2).start()
+        self.addCleanup(self.fake.stop)
+        self.patch_handler(
+            comfy=rp_handler.ComfyUIClient(self.fake.host),
+            readiness=rp_handler.ComfyUIReadiness(),
+            input_image_cache=rp_handler.InputImageCache(),
+        )
+        self.patch_env(COMFY_OUTPUT_PATH=self.fake.output_dir)
+
+    def run_job(self):
+        job = {"id": "job-1", "input": {"workflow": WORKFLOW, "timeout": 30}}
+        return rp_handler.handler(job)
+
+    def test_missing_checkpoint_history(self):
+        history = load_history("execution_error_missing_checkpoint.json")
+        prompt_id = next(iter(history))
+
+        result, error = rp_handler.history_result(history, prompt_id)
+
+        self.assertIsNone(result)
+        self.assertTrue(
+            error["error"].startswith(
+                "ComfyUI execution error in node 4 (CheckpointLoaderSimple): "
+                "[Errno 2] No such file or directory"
+            )
+        )
+        self.assertEqual(error["details"]["exception_type"], "FileNotFoundError")
+
+    def test_out_of_memory_history_with_partial_outputs(self):
+        history = load_history("execution_error_out_of_memory.json")
+        prompt_id = next(iter(history))
+        history[prompt_id]["outputs"] = {
+            "12": {"images": [{"filename": "preview.png", "type": "temp"}]}
+        }
+
+        result, error = rp_handler.history_result(history, prompt_id)
+
+        self.assertIsNone(result)
+        self.assertEqual(
+            error["details"],
+            {
+                "type": "execution_error",
+                "node_id": "3",
+                "node_type": "KSampler",
+                "exception_type": "torch.OutOfMemoryError",
+                "exception_message": history[prompt_id]["status"]["messages"][-1][1][
+                    "exception_message"
+                ],
+            },
+        )
+
+    def test_interrupted_history(self):
+        history = load_history("execution_interrupted.json")
+        prompt_id = next(iter(history))
+
+        result, error = rp_handler.history_result(history, prompt_id)
+
+        self.assertEqual(error["error"], "ComfyUI execution was interrupted")
+        self.assertEqual(error["details"]["node_id"], "3")
+
+    @patch.object(rp_handler, "COMFY_COMPLETION_MODE", "polling")
+    def test_polling_fails_fast(self):
+        self.fake.fail_prompts(
+            "3", "Allocation on device 0 would exceed allowed memory"
+        )
+
+        started = time.monotonic()
+        result = self.run_job()
+
+        self.assertLess(time.monotonic() - started, 1)
+        self.assertIn("would exceed allowed memory", result["error"])
+        self.assertEqual(result["details"]["node_id"], "3")
+
+    @patch.object(rp_handler, "COMFY_COMPLETION_MODE", "websocket")
+    def test_websocket_error_is_structured(self):
+        self.fake.fail_prompts("4", "Checkpoint not found")
+
+        result = self.run_job()
+
+        self.assertEqual(
+            result["error"],
+            "ComfyUI execution error in node 4 (CheckpointLoaderSimple): Checkpoint not found",
+        )
+        self.assertEqual(result["details"]["exception_type"], "RuntimeError")
+
+    def test_rejected_workflow_reports_node_errors(self):
+        self.fake.reject_prompts(load_history("prompt_response_node_errors.json"))
+
+        result = self.run_job()
+
+        self.assertEqual(
+            result["error"],
+            "Error queuing workflow: Prompt outputs failed validation: "
+            "node 4 (CheckpointLoaderSimple): Value not in list: "
+            "ckpt_name: 'sd_xl_base_1.0.safetensors' not in ['flux1-schnell-fp8.safetensors']; "
+            "node 3 (KSampler): Value 200 bigger than max of 100: cfg",
+        )
+        self.assertEqual(result["details"]["type"], "prompt_outputs_failed_validation")
+        self.assertEqual(
+            [e["node_id"] for e in result["details"]["node_errors"]], ["4", "3"]
+        )
+        self.assertEqual(self.fake.history, {})
+
+
+class TestWorkflowValidation(HandlerTestCase):
+    def setUp(self):
+        self.object_info = copy.deepcopy(OBJECT_INFO)
+        self.fake = FakeComfyUI(object_info=self.object_info).start()
+        self.addCleanup(self.fake.stop)
+        self.cache_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.cache_dir.cleanup)
+        self.custom_nodes = os.path.join(self.cache_dir.name, "custom_nodes")
+        os.makedirs(self.custom_nodes)
+        self.patch_handler(
+            comfy=rp_handler.ComfyUIClient(self.fake.host),
+            readiness=rp_handler.ComfyUIReadiness(),
+            input_image_cache=rp_handler.InputImageCache(),
+            workflow_validator=self.validator(),
+        )
+        self.patch_env(COMFY_OUTPUT_PATH=self.fake.output_dir)
+
+    def validator(self):
+        return rp_handler.WorkflowValidator(
+            os.path.join(self.cache_dir.name, "cache"), self.custom_nodes
+        )
+
+    def broken_workflow(self):
+        workflow = copy.deepcopy(WORKFLOW)
+        workflow["3"]["inputs"]["cfg"] = 200
+        workflow["3"]["inputs"]["sampler_name"] = "euler_magic"
+        workflow["3"]["inputs"]["latent_image"] = ["50", 0]
+        workflow["4"]["inputs"] = {}
+        workflow["5"]["inputs"]["width"] = "wide"
+        workflow["6"]["inputs"]["clip"] = ["4", 7]
+        workflow["7"]["inputs"]["clip"] = ["5", 0]
+        workflow["10"] = {"inputs": {"samples": ["8", 0]}, "class_type": "LatentLoop"}
+        workflow["11"] = {
+            "inputs": {"image": ["12", 0]},
+            "class_type": "ImageScale",
+        }
+        workflow["12"] = {
+            "inputs": {
+                "image": ["11", 0],
+                "upscale_method": "bilinear",
+                "width": 64,
+                "height": 64,
+                "crop": "disabled",
+            },
+            "class_type": "ImageScale",
+        }
+        workflow["13"] = {"inputs": {"images": ["12", 0]}, "class_type": "PreviewImage"}
+        return workflow
+
+    def test_valid_workflows(self):
+        with open("test_resources/workflows/workflow_sdxl_turbo.json") as f:
+            turbo = json.load(f)["input"]["workflow"]
+        load_image = {
+            "inputs": {"image": "uploaded_by_this_job.png"},
+            "class_type": "LoadImage",
+        }
+
+        for workflow in (WORKFLOW, turbo, {**WORKFLOW, "20": load_image}):
+            self.assertEqual(rp_handler.check_workflow(workflow, OBJECT_INFO), [])
+
+    def test_reports_every_problem(self):
+        errors = rp_handler.check_workflow(self.broken_workflow(), OBJECT_INFO)
+
+        self.assertEqual(
+            [(e["node_id"], e["type"], e["details"]) for e in errors],
+            [
+                ("10", "missing_node_type", ""),
+                ("3", "value_bigger_than_max", "cfg"),
+                (
+                    "3",
+                    "value_not_in_list",
+                    "sampler_name: 'euler_magic' not in ['euler', 'euler_cfg_pp', "
+                    "'euler_ancestral', 'heun', 'dpm_2', 'dpmpp_2m', 'dpmpp_2m_sde', "
+                    "'dpmpp_3m_sde', 'ddim', 'uni_pc', ... (11 in total)]",
+                ),
+                ("3", "bad_linked_input", "latent_image"),
+                ("4", "required_input_missing", "ckpt_name"),
+                ("5", "invalid_input_type", "width, 'wide'"),
+                ("6", "bad_linked_input", "clip"),
+                ("7", "return_type_mismatch", "clip"),
+                ("11", "required_input_missing", "upscale_method"),
+                ("11", "required_input_missing", "width"),
+                ("11", "required_input_missing", "height"),
+                ("11", "required_input_missing", "crop"),
+                ("11", "dependency_cycle", ""),
+                ("12", "dependency_cycle", ""),
+            ],
+        )
+
+    def test_only_what_the_outputs_depend_on_is_checked(self):
+        unused = {"inputs": {"width": "wide"}, "class_type": "ImageScale"}
+        without_outputs = {k: v for k, v in WORKFLOW.items() if k != "9"}
+
+        self.assertEqual(
+            rp_handler.check_workflow({**WORKFLOW, "20": unused}, OBJECT_INFO), []
+        )
+        self.assertEqual(
+            [
+                e["type"]
+                for e in rp_handler.check_workflow(without_outputs, OBJECT_INFO)
+            ],
+            ["prompt_no_outputs"],
+        )
+
+    def test_images_of_the_job_are_valid_input_files(self):
+        # A loader that lists the input folder without offering an upload
+        self.object_info["LoadImageFromInput"] = {
+            "input": {"required": {"image": [["example.png"], {}]}},
+            "output": ["IMAGE"],
+        }
+        workflow = {
+            **WORKFLOW,
+            "20": {"inputs": {"image": "mask.png"}, "class_type": "LoadImageFromInput"},
+            "21": {"inputs": {"images": ["20", 0]}, "class_type": "PreviewImage"},
+        }
+        image = {"name": "mask.png", "image": base64.b64encode(png_bytes()).decode()}
+
+        result = rp_handler.handler(
+            {"id": "job-1", "input": {"workflow": workflow, "images": [image]}}
+        )
+        self.assertEqual(result["status"], "success", result)
+
+        result = rp_handler.handler({"id": "job-2", "input": {"workflow": workflow}})
+        self.assertEqual(
+            result["details"]["node_errors"][0]["type"], "value_not_in_list"
+        )
+
+    def test_rejects_before_queuing(self):
+        job = {"id": "job-1", "input": {"workflow": self.broken_workflow()}}
+
+        started = time.monotonic()
+        result = rp_handler.handler(job)
+
+        self.assertLess(time.monotonic() - started, 0.5)
+        self.assertTrue(
+            result["error"].startswith(
+                "Invalid workflow: node 10 (LatentLoop): Node type 'LatentLoop' is not installed; "
+                "node 3 (KSampler): Value 200.0 bigger than max of 100.0: cfg; "
+            )
+        )
+        self.assertEqual(result["details"]["type"], "invalid_workflow")
+        self.assertEqual(len(result["details"]["node_errors"]), 14)
+        self.assertEqual(self.fake.count("/prompt"), 0)
+
+    def test_node_definitions_are_fetched_once_and_cached_on_disk(self):
+        for _ in range(2):
+            result = rp_handler.handler({"id": "job", "input": {"workflow": WORKFLOW}})
+            self.assertEqual(result["status"], "success")
+        self.assertEqual(self.fake.count("/object_info"), 1)
+
+        # A new worker with the same custom nodes
+        self.assertIsNone(self.validator().validate(WORKFLOW))
+        self.assertEqual(self.fake.count("/object_info"), 1)
+
+        # A new worker with other custom nodes
+        os.makedirs(os.path.join(self.custom_nodes, "ComfyUI-Impact-Pack"))
+        self.assertIsNone(self.validator().validate(WORKFLOW))
+        self.assertEqual(self.fake.count("/object_info"), 2)
+
+    def test_outdated_node_definitions_are_refreshed(self):
+        validator = self.validator()
+        self.assertIsNone(validator.validate(WORKFLOW))
+
+        # A new model shows up, e.g. on the network volume
+        workflow = copy.deepcopy(WORKFLOW)
+        workflow["4"]["inputs"]["ckpt_name"] = "new_model.safetensors"
+        ckpt_names = self.object_info["CheckpointLoaderSimple"]["input"]["required"]
+        ckpt_names["ckpt_name"][0].append("new_model.safetensors")
+
+        # Not refreshed again right away
+        self.assertIn("new_model.safetensors", validator.validate(workflow)["error"])
+        self.assertEqual(self.fake.count("/object_info"), 1)
+
+        validator.fetched_at -= rp_handler.OBJECT_INFO_REFRESH_INTERVAL_S + 1
+        self.assertIsNone(validator.validate(workflow))
+        self.assertEqual(self.fake.count("/object_info"), 2)
+
+    def test_skipped_without_node_definitions(self):
+        self.fake.object_info = None
+
+        self.assertIsNone(self.validator().validate({"1": {"class_type": "Nope"}}))
+
+
+class TestResultCache(HandlerTestCase):
+    def setUp(self):
+        self.fake = FakeComfyUI().start()
+        self.addCleanup(self.fake.stop)
+        self.cache_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.cache_dir.cleanup)
+        self.patch_handler(
+            comfy=rp_handler.ComfyUIClient(self.fake.host),
+            readiness=rp_handler.ComfyUIReadiness(),
+            input_image_cache=rp_handler.InputImageCache(),
+            result_cache=self.cache(),
+        )
+        self.patch_env(COMFY_OUTPUT_PATH=self.fake.output_dir)
+
+    def cache(self, **kwargs):
+        return rp_handler.ResultCache(self.cache_dir.name, **kwargs)
+
+    def run_job(self, workflow=WORKFLOW, images=None):
+        job_input = {"workflow": workflow}
+        if images:
+            job_input["images"] = images
+        return rp_handler.handler({"id": "job-1", "input": job_input})
+
+    def test_random_seeds(self):
+        def with_seed(seed):
+            workflow = copy.deepcopy(WORKFLOW)
+            workflow["3"]["inputs"]["seed"] = seed
+            return workflow
+
+        self.assertFalse(rp_handler.uses_random_seed(WORKFLOW))
+        self.assertFalse(rp_handler.uses_random_seed(with_seed(["12", 0])))
+        for seed in (-1, 1.5, "random"):
+            self.assertTrue(rp_handler.uses_random_seed(with_seed(seed)))
+        workflow = with_seed(42)
+        workflow["3"]["inputs"]["control_after_generate"] = "randomize"
+        self.assertTrue(rp_handler.uses_random_seed(workflow))
+
+    def test_key_is_canonical(self):
+        reordered = {k: WORKFLOW[k] for k in reversed(list(WORKFLOW))}
+        image = base64.b64encode(png_bytes()).decode()
+        other_image = base64.b64encode(png_bytes(color=(0, 0, 255))).decode()
+
+        key = rp_handler.result_cache_key(WORKFLOW, [{"name": "a.png", "image": image}])
+
+        self.assertEqual(
+            key,
+            rp_handler.result_cache_key(reordered, [{"name": "a.png", "image": image}]),
+        )
+        self.assertNotEqual(
+            key,
+            rp_handler.result_cache_key(
+                WORKFLOW, [{"name": "a.png", "image": other_image}]
+            ),
+        )
+
+    def test_repeated_job_is_served_from_cache(self):
+        images = [{"name": "a.png", "image": base64.b64encode(png_bytes()).decode()}]
+        first = self.run_job(images=images)
+        second = self.run_job(images=images)
+
+        self.assertEqual(self.fake.count("/prompt"), 1)
+        self.assertEqual(
+            first["cache"], {"hit": False, "hit_rate": 0.0, "bytes_saved": 0}
+        )
+        self.assertEqual(
+            second["cache"],
+            {
+                "hit": True,
+                "hit_rate": 0.5,
+                "bytes_saved": len(png_bytes(color=(0, 0, 0))),
+            },
+        )
+        self.assertEqual(second["images"], first["images"])
+
+        # Other input images, other result
+        images = [
+            {"name": "a.png", "image": base64.b64encode(png_bytes(4, 4)).decode()}
+        ]
+        self.assertFalse(self.run_job(images=images)["cache"]["hit"])
+        self.assertEqual(self.fake.count("/prompt"), 2)
+
+    def test_url_images_bypass_cache(self):
+        with FakeFileServer() as files:
+            images = [{"name": "a.png", "url": files.add("/a.png", png_bytes())}]
+            with patch.object(
+                rp_handler,
+                "download_cache",
+                rp_handler.DownloadCache(os.path.join(self.cache_dir.name, "dl")),
+            ):
+                results = [self.run_job(images=images) for _ in range(2)]
+
+        for result in results:
+            self.assertEqual(result["status"], "success", result)
+            self.assertNotIn("cache", result)
+        self.assertEqual(self.fake.count("/prompt"), 2)
+
+    def test_random_seed_bypasses_cache(self):
+        workflow = copy.deepcopy(WORKFLOW)
+        workflow["3"]["inputs"]["seed"] = -1
+
+        for _ in range(2):
+            self.assertNotIn("cache", self.run_job(workflow))
+
+        self.assertEqual(self.fake.count("/prompt"), 2)
+        self.assertEqual(os.listdir(self.cache_dir.name), [])
+
+    def test_expired_entries_are_not_used(self):
+        with patch.object(rp_handler, "result_cache", self.cache(ttl=0)):
+            self.run_job()
+            time.sleep(0.01)
+            self.assertFalse(self.run_job()["cache"]["hit"])
+
+        self.assertEqual(self.fake.count("/prompt"), 2)
+
+    def test_least_recently_used_entries_are_evicted(self):
+        size = len(png_bytes())
+        cache = self.cache(max_bytes=2 * size)
+        outputs = {
+            "9": {"images": [{"filename": "a.png", "subfolder": "", "type": "output"}]}
+        }
+        with open(os.path.join(self.fake.output_dir, "a.png"), "wb") as f:
+            f.write(png_bytes())
+
+        for key in ("first", "second", "third"):
+            cache.put(key, outputs, self.fake.output_dir)
+            if key == "second":
+                cache.get("first")
+
+        self.assertIsNotNone(cache.get("first"))
+        self.assertIsNone(cache.get("second"))
+        self.assertEqual(cache.total_bytes, 2 * size)
+        self.assertEqual(sorted(os.listdir(self.cache_dir.name)), ["first", "third"])
+
+        # A restarted worker finds the entries on disk
+        self.assertIsNotNone(self.cache().get("third"))
+
+
+class TestTimings(HandlerTestCase):
+    def setUp(self):
+        self.fake = FakeComfyUI(execution_time=0.3).start()
+        self.addCleanup(self.fake.stop)
+        self.metrics_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.metrics_dir.cleanup)
+        self.patch_handler(
+            comfy=rp_handler.ComfyUIClient(self.fake.host),
+            readiness=rp_handler.ComfyUIReadiness(),
+            input_image_cache=rp_handler.InputImageCache(),
+            metrics=rp_handler.StageMetrics(),
+            COMFY_VALIDATE_WORKFLOW=False,
+        )
+        self.patch_env(COMFY_OUTPUT_PATH=self.fake.output_dir)
+        # Not the first job of the worker, that one also reports the cold start
+        rp_handler.metrics.observe_startup("first_job", 0)
+
+    def run_job(self, handler=rp_handler.handler):
+        job_input = {
+            "workflow": WORKFLOW,
+            "images": [
+                {"name": "a.png", "image": base64.b64encode(png_bytes()).decode()}
+            ],
+        }
+        result = handler({"id": "job-1", "input": job_input})
+        if handler is rp_handler.generator_handler:
+            result = list(result)[-1]
+        self.assertEqual(result["status"], "success", result)
+        return result
+
+    @patch.object(rp_handler, "COMFY_TIMINGS", True)
+    def test_stages_are_timed(self):
+        for handler in (rp_handler.handler, rp_handler.generator_handler):
+            # The input image must not be in the input folder already
+            with patch.object(
+                rp_handler, "input_image_cache", rp_handler.InputImageCache()
+            ):
+                timings = self.run_job(handler)["timings"]
+
+            self.assertEqual(
+                set(timings),
+                {
+                    "validation",
+                    "server_check",
+                    "image_decode",
+                    "image_upload",
+                    "queue_submit",
+                    "queue_wait",
+                    "execution",
+                    "output_encoding",
+                    "total",
+                },
+            )
+            self.assertGreaterEqual(timings["execution"], 0.25)
+            self.assertLess(timings["queue_wait"], 0.25)
+            self.assertGreaterEqual(timings["total"], timings["execution"])
+
+    def test_timings_are_not_returned_by_default(self):
+        self.assertNotIn("timings", self.run_job())
+
+    def test_wait_is_split_by_the_timestamps_of_comfyui(self):
+        history = load_history("execution_error_out_of_memory.json")
+        prompt_id = next(iter(history))
+        messages = history[prompt_id]["status"]["messages"]
+        started = messages[0][1]["timestamp"]
+        ended = messages[-1][1]["timestamp"]
+
+        timings = rp_handler.JobTimings()
+        timings.add_wait(10, history, prompt_id)
+        timings.add_wait(2)
+
+        self.assertAlmostEqual(
+            timings.stages["execution"], (ended - started) / 1000 + 2
+        )
+        self.assertAlmostEqual(
+            timings.stages["queue_wait"], 10 - (ended - started) / 1000
+        )
+
+    def test_metrics_are_written_in_the_prometheus_format(self):
+        path = os.path.join(self.metrics_dir.name, "worker.prom")
+        with patch.object(rp_handler, "COMFY_METRICS_FILE", path):
+            self.run_job()
+            self.run_job()
+
+        with open(path) as f:
+            lines = f.read().splitlines()
+        self.assertIn("# TYPE comfy_worker_stage_seconds histogram", lines)
+        self.assertIn('comfy_worker_stage_seconds_count{stage="execution"} 2', lines)
+        self.assertIn(
+            'comfy_worker_stage_seconds_bucket{stage="execution",le="0.1"} 0', lines
+        )
+        self.assertIn(
+            'comfy_worker_stage_seconds_bucket{stage="execution",le="1"} 2', lines
+        )
+        self.assertIn(
+            'comfy_worker_stage_seconds_bucket{stage="total",le="+Inf"} 2', lines
+        )
+
+    def test_metrics_are_served(self):
+        self.run_job()
+        server = rp_handler.start_metrics_server(0)
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+
+        response = requests.get(f"http://127.0.0.1:{server.server_address[1]}/metrics")
+
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(
+            'comfy_worker_stage_seconds_count{stage="total"} 1', response.text
+        )
+
+
+class TestWarmup(HandlerTestCase):
+    def setUp(self):
+        self.fake = FakeComfyUI().start()
+        self.addCleanup(self.fake.stop)
+        self.folder = tempfile.TemporaryDirectory()
+        self.addCleanup(self.folder.cleanup)
+        self.patch_handler(
+            comfy=rp_handler.ComfyUIClient(self.fake.host),
+            readiness=rp_handler.ComfyUIReadiness(),
+            metrics=rp_handler.StageMetrics(),
+            COMFY_VALIDATE_WORKFLOW=False,
+        )
+        self.patch_env(COMFY_OUTPUT_PATH=self.fake.output_dir)
+
+    def write(self, name, content):
+        path = os.path.join(self.folder.name, name)
+        with open(path, "w") as f:
+            json.dump(content, f)
+        return path
+
+    def test_warmup_inputs_are_loaded(self):
+        single = self.write("single.json", {"input": {"workflow": WORKFLOW}})
+        several = self.write(
+            "several.json",
+            [{"input": {"workflow": WORKFLOW}}, {"input": {"workflow": {}}}],
+        )
+        missing = os.path.join(self.folder.name, "missing.json")
+
+        inputs = rp_handler.load_warmup_inputs(f"{single}, {missing},{several}")
+
+        self.assertEqual(
+            inputs, [{"workflow": WORKFLOW}, {"workflow": WORKFLOW}, {"workflow": {}}]
+        )
+
+    def test_warmup_runs_the_workflows(self):
+        rp_handler.warmup([{"workflow": WORKFLOW}, {"workflow": WORKFLOW}])
+
+        self.assertEqual(self.fake.count("/prompt"), 2)
+        self.assertEqual(len(self.fake.completed_at), 2)
+        # The outputs of the warmup are not kept
+        self.assertEqual(os.listdir(self.fake.output_dir), [])
+        self.assertIn("comfyui_ready", rp_handler.metrics.startup)
+        self.assertIn("warmup", rp_handler.metrics.startup)
+
+    def test_failed_warmup_workflows_are_skipped(self):
+        self.fake.fail_prompts()
+
+        rp_handler.warmup([{"workflow": WORKFLOW}, {"missing": "workflow"}])
+
+        self.assertEqual(self.fake.count("/prompt"), 1)
+        self.assertIn("warmup", rp_handler.metrics.startup)
+
+    def test_no_warmup_without_workflows(self):
+        rp_handler.warmup([])
+
+        self.assertEqual(self.fake.count("/"), 0)
+        self.assertEqual(rp_handler.metrics.startup, {})
+
+    @patch.object(rp_handler, "COMFY_TIMINGS", True)
+    def test_first_job_reports_the_cold_start(self):
+        job = {"id": "job-1", "input": {"workflow": WORKFLOW}}
+
+        first = rp_handler.handler(job)
+        second = rp_handler.handler(job)
+
+        self.assertGreater(first["timings"]["cold_start"], 0)
+        self.assertNotIn("cold_start", second["timings"])
+        self.assertIn(
+            'comfy_worker_startup_seconds{phase="first_job"}',
+            rp_handler.metrics.render(),
+        )
+
+
+class TestMemoryPolicy(HandlerTestCase):
+    def setUp(self):
+        self.fake = FakeComfyUI().start()
+        self.addCleanup(self.fake.stop)
+        self.policy = rp_handler.MemoryPolicy(
+            vram_below_mb=2048, ram_above_percent=90, hot_jobs=2, settle_s=0
+        )
+        self.patch_handler(
+            comfy=rp_handler.ComfyUIClient(self.fake.host),
+            readiness=rp_handler.ComfyUIReadiness(),
+            metrics=rp_handler.StageMetrics(),
+            memory_policy=self.policy,
+            COMFY_VALIDATE_WORKFLOW=False,
+        )
+        self.patch_env(COMFY_OUTPUT_PATH=self.fake.output_dir)
+
+    def run_job(self, workflow=WORKFLOW, job_input=None):
+        job_input = job_input or {"workflow": workflow}
+        result = rp_handler.handler({"id": "job-1", "input": job_input})
+        self.assertEqual(result["status"], "success", result)
+        return result
+
+    def test_models_of_the_workflow(self):
+        self.assertEqual(
+            rp_handler.MemoryPolicy.models_of(WORKFLOW), {"sd_xl_base_1.0.safetensors"}
+        )
+        self.assertEqual(rp_handler.MemoryPolicy.models_of("not a workflow"), set())
+
+    @patch.object(rp_handler, "COMFY_TIMINGS", True)
+    def test_enough_memory_is_kept(self):
+        result = self.run_job()
+
+        self.assertEqual(self.fake.count("/system_stats"), 1)
+        self.assertEqual(self.fake.frees, [])
+        self.assertIn("memory_release", result["timings"])
+        self.assertIsNotNone(self.policy.last_stats)
+
+    def test_models_are_unloaded_when_the_vram_is_low(self):
+        self.fake.use_memory(vram_free_mb=1024)
+
+        self.run_job()
+
+        self.assertEqual(
+            self.fake.frees, [{"unload_models": True, "free_memory": False}]
+        )
+
+    def test_hot_models_stay_loaded(self):
+        self.fake.use_memory(vram_free_mb=1024)
+        self.run_job()
+        self.fake.use_memory(vram_free_mb=1024)
+
+        # The second job in a row that uses the checkpoint makes it hot
+        self.run_job()
+
+        self.assertEqual(len(self.fake.frees), 1)
+
+    def test_hot_models_of_string_and_template_inputs(self):
+        templates = rp_handler.WorkflowTemplates()
+        templates.templates = {"sdxl": rp_handler.WorkflowTemplate("sdxl", WORKFLOW)}
+
+        with patch.object(rp_handler, "workflow_templates", templates):
+            for job_input in (
+                json.dumps({"workflow": WORKFLOW}),
+                {"template": "sdxl", "overrides": {"3.inputs.seed": 1}},
+            ):
+                self.fake.use_memory(vram_free_mb=1024)
+                self.run_job(job_input=job_input)
+
+        # The checkpoint of the first job is hot for the second one
+        self.assertEqual(len(self.fake.frees), 1)
+
+    def test_memory_is_freed_when_the_ram_is_high(self):
+        self.fake.use_memory(ram_used_percent=95)
+
+        self.run_job()
+
+        self.assertEqual(
+            self.fake.frees, [{"unload_models": False, "free_memory": True}]
+        )
+
+    def test_nothing_is_freed_while_other_jobs_run(self):
+        self.fake.use_memory(vram_free_mb=1024)
+
+        with patch.dict(rp_handler.in_flight_prompts, {"job-2": "prompt-2"}):
+            self.run_job()
+
+        self.assertEqual(self.fake.count("/system_stats"), 0)
+        self.assertEqual(self.fake.frees, [])
+
+    @patch.object(rp_handler, "REFRESH_WORKER", True)
+    def test_nothing_is_freed_when_the_worker_is_refreshed(self):
+        self.fake.use_memory(vram_free_mb=1024)
+
+        self.run_job()
+
+        self.assertEqual(self.fake.count("/system_stats"), 0)
+
+    def test_disabled_without_thresholds(self):
+        with patch.object(rp_handler, "memory_policy", rp_handler.MemoryPolicy(0, 0)):
+            self.run_job()
+
+        self.assertEqual(self.fake.count("/system_stats"), 0)
+
+
+class TestBatch(HandlerTestCase):
+    def setUp(self):
+        self.fake = FakeComfyUI(execution_time=0.2).start()
+        self.addCleanup(self.fake.stop)
+        self.patch_handler(
+            comfy=rp_handler.ComfyUIClient(self.fake.host),
+            readiness=rp_handler.ComfyUIReadiness(),
+            input_image_cache=rp_handler.InputImageCache(),
+            metrics=rp_handler.StageMetrics(),
+            COMFY_VALIDATE_WORKFLOW=False,
+        )
+        self.patch_env(COMFY_OUTPUT_PATH=self.fake.output_dir)
+
+    def test_overrides_create_variants(self):
+        variants, error = rp_handler.validate_batch(
+            {
+                "workflow": WORKFLOW,
+                "overrides": [{"3.inputs.seed": 1}, {"3.inputs.seed": 2}],
+            }
+        )
+
+        self.assertIsNone(error)
+        self.assertEqual([v["3"]["inputs"]["seed"] for v in variants], [1, 2])
+        self.assertNotIn(WORKFLOW["3"]["inputs"]["seed"], (1, 2))
+        # Nodes without overrides are shared with the base workflow
+        self.assertIs(variants[0]["9"], WORKFLOW["9"])
+
+    def test_an_object_of_overrides_is_a_single_job(self):
+        job_input, error = rp_handler.validate_input(
+            {"workflow": WORKFLOW, "overrides": {"3.inputs.seed": 7}}
+        )
+
+        self.assertIsNone(error)
+        self.assertNotIn("variants", job_input)
+        self.assertEqual(job_input["workflow"]["3"]["inputs"]["seed"], 7)
+
+    def test_invalid_batches_are_rejected(self):
+        for job_input, expected in (
+            (
+                {"workflow": WORKFLOW, "overrides": [{"42.inputs.seed": 1}]},
+                "Override 0: '42.inputs.seed': node 42 is not in the workflow",
+            ),
+            (
+                {"workflow": WORKFLOW, "overrides": [{"3": 1}]},
+                "Override 0: '3' must name a value of the node, like '3.inputs.seed'",
+            ),
+            (
+                {"workflow": WORKFLOW, "overrides": [{"3.missing.seed": 1}]},
+                "Override 0: '3.missing.seed': 'missing' is not in the workflow",
+            ),
+            (
+                {"overrides": [{}], "workflows": [WORKFLOW]},
+                "Use either 'overrides' or 'workflows', not both",
+            ),
+            (
+                {"workflow": WORKFLOW, "workflows": [WORKFLOW]},
+                "Use either 'workflow' or 'workflows', not both",
+            ),
+            ({"workflows": []}, "A batch needs at least one variant"),
+            ({"workflows": "not a list"}, "'workflows' must be a list of workflows"),
+        ):
+            _, error = rp_handler.validate_input(job_input)
+            self.assertEqual(error, expected)
+
+    @patch.object(rp_handler, "COMFY_BATCH_MAX_VARIANTS", 2)
+    def test_batch_size_is_limited(self):
+        _, error = rp_handler.validate_input({"workflows": [WORKFLOW] * 3})
+
+        self.assertEqual(error, "A batch can have at most 2 variants, got 3")
+
+    def test_variants_are_queued_back_to_back(self):
+        job_input = {
+            "workflow": WORKFLOW,
+            "overrides": [{"3.inputs.seed": seed} for seed in range(3)],
+            "images": [
+                {"name": "a.png", "image": base64.b64encode(png_bytes()).decode()}
+            ],
+        }
+
+        result = rp_handler.handler({"id": "batch", "input": job_input})
+
+        self.assertEqual(result["status"], "success", result)
+        self.assertEqual(len(result["variants"]), 3)
+        for variant in result["variants"]:
+            self.assertEqual(variant["status"], "success")
+            self.assertEqual(len(variant["images"]), 1)
+        self.assertNotIn("errors", result)
+        self.assertEqual(self.fake.count("/upload/image"), 1)
+        self.assertEqual(self.fake.count("/prompt"), 3)
+        # Every prompt was queued before the first one was done
+        self.assertLess(
+            max(self.fake.queued_at.values()), min(self.fake.completed_at.values())
+        )
+
+    def test_failed_variant_does_not_stop_the_others(self):
+        failing = {**WORKFLOW, "99": {"class_type": "Broken", "inputs": {}}}
+        self.fake.fail_prompts(node_id="99")
+
+        result = rp_handler.handler(
+            {"id": "batch", "input": {"workflows": [WORKFLOW, failing, WORKFLOW]}}
+        )
+
+        self.assertEqual(result["status"], "success", result)
+        self.assertEqual(
+            [variant["status"] for variant in result["variants"]],
+            ["success", "error", "success"],
+        )
+        self.assertEqual(len(result["errors"]), 1)
+        self.assertTrue(result["errors"][0].startswith("Variant 1: "))
+
+    def test_remaining_variants_are_cancelled_after_the_timeout(self):
+        self.fake.execution_time = 0.3
+
+        result = rp_handler.handler(
+            {"id": "batch", "input": {"workflows": [WORKFLOW] * 3, "timeout": 0.5}}
+        )
+
+        self.assertEqual(
+            [variant["status"] for variant in result["variants"]],
+            ["success", "error", "error"],
+        )
+        self.assertEqual(
+            result["variants"][2]["message"],
+            "The job timed out before this variant ran",
+        )
+        # The second variant was interrupted, the third one never ran
+        self.assertEqual(self.fake.interrupts, 1)
+        self.assertEqual(len(self.fake.history), 2)
+
+    def test_batch_fails_if_no_variant_succeeds(self):
+        self.fake.fail_prompts()
+
+        result = rp_handler.handler(
+            {"id": "batch", "input": {"workflows": [WORKFLOW, WORKFLOW]}}
+        )
+
+        self.assertTrue(result["error"].startswith("Variant 0: "))
+        self.assertEqual(len(result["details"]), 2)
+
+    def test_batch_with_the_generator_handler(self):
+        job_input = {
+            "workflow": WORKFLOW,
+            "overrides": [{"3.inputs.seed": 1}, {"3.inputs.seed": 2}],
+        }
+
+        updates = list(rp_handler.generator_handler({"id": "b", "input": job_input}))
+
+        self.assertEqual(len(updates), 1)
+        self.assertEqual(len(updates[0]["variants"]), 2)
+
+
+class TestTemplates(HandlerTestCase):
+    def setUp(self):
+        self.fake = FakeComfyUI(object_info=copy.deepcopy(OBJECT_INFO)).start()
+        self.addCleanup(self.fake.stop)
+        self.folder = tempfile.TemporaryDirectory()
+        self.addCleanup(self.folder.cleanup)
+        templates = os.path.join(self.folder.name, "templates")
+        os.makedirs(templates)
+        with open(os.path.join(templates, "sdxl.json"), "w") as f:
+            json.dump(WORKFLOW, f)
+        # The format of test_input.json works as well
+        with open(os.path.join(templates, "turbo.json"), "w") as f:
+            json.dump({"input": {"workflow": WORKFLOW}}, f)
+        with open(os.path.join(templates, "broken.json"), "w") as f:
+            f.write("{")
+        with open(os.path.join(templates, "notes.txt"), "w") as f:
+            f.write("not a template")
+
+        self.templates = rp_handler.WorkflowTemplates(templates)
+        self.patch_handler(
+            comfy=rp_handler.ComfyUIClient(self.fake.host),
+            readiness=rp_handler.ComfyUIReadiness(),
+            input_image_cache=rp_handler.InputImageCache(),
+            workflow_templates=self.templates,
+            workflow_validator=rp_handler.WorkflowValidator(
+                os.path.join(self.folder.name, "cache"),
+                os.path.join(self.folder.name, "custom_nodes"),
+            ),
+        )
+        self.patch_env(COMFY_OUTPUT_PATH=self.fake.output_dir)
+
+    def test_templates_are_read_once(self):
+        self.assertEqual(sorted(self.templates.load()), ["sdxl", "turbo"])
+        self.assertEqual(self.templates.get("turbo").workflow, WORKFLOW)
+        self.assertIs(self.templates.load(), self.templates.load())
+
+    def test_overrides_only_copy_what_they_change(self):
+        template = self.templates.get("sdxl")
+
+        variant, error = template.apply({"3.inputs.seed": 1, "3.inputs.steps": 4})
+
+        self.assertIsNone(error)
+        self.assertEqual(variant["3"]["inputs"]["seed"], 1)
+        self.assertEqual(variant["3"]["inputs"]["steps"], 4)
+        self.assertEqual(variant["3"]["inputs"]["cfg"], WORKFLOW["3"]["inputs"]["cfg"])
+        self.assertEqual(template.workflow, WORKFLOW)
+        self.assertIs(variant["4"], template.workflow["4"])
+        # Only values that the template has can be set
+        self.assertEqual(
+            template.apply({"6._meta.title": "Prompt"}),
+            (None, "'6._meta.title' is not a value of the template 'sdxl'"),
+        )
+
+    def test_images_are_pointed_to_in_a_copy_of_the_template(self):
+        template = self.templates.get("sdxl")
+        variant, _ = template.apply({"6.inputs.text": "mask.png"})
+
+        workflow = rp_handler.point_to_images(variant, {"mask.png": "job-1/mask.png"})
+
+        self.assertEqual(workflow["6"]["inputs"]["text"], "job-1/mask.png")
+        self.assertEqual(variant["6"]["inputs"]["text"], "mask.png")
+        self.assertEqual(template.workflow, WORKFLOW)
+        self.assertIs(workflow["4"], template.workflow["4"])
+
+    def test_template_jobs_are_validated(self):
+        job_input, error = rp_handler.validate_input(
+            {"template": "sdxl", "overrides": {"6.inputs.text": "a red fox"}}
+        )
+        self.assertIsNone(error)
+        self.assertEqual(job_input["workflow"]["6"]["inputs"]["text"], "a red fox")
+        self.assertIs(job_input["template"], self.templates.get("sdxl"))
+
+        job_input, error = rp_handler.validate_input(
+            {"template": "sdxl", "overrides": [{"3.inputs.seed": s} for s in (1, 2)]}
+        )
+        self.assertIsNone(error)
+        self.assertEqual(
+            [v["3"]["inputs"]["seed"] for v in job_input["variants"]], [1, 2]
+        )
+
+        for job_input, expected in (
+            (
+                {"template": "flux"},
+                "Unknown template 'flux', available: sdxl, turbo",
+            ),
+            (
+                {"template": "sdxl", "workflow": WORKFLOW},
+                "Use either 'template' or 'workflow', not both",
+            ),
+            (
+                {"template": "sdxl", "overrides": {"3.inputs.nope": 1}},
+                "'3.inputs.nope' is not a value of the template 'sdxl'",
+            ),
+            (
+                {"template": "sdxl", "overrides": [{}, {"9.inputs": 1}]},
+                "Override 1: '9.inputs' is not a value of the template 'sdxl'",
+            ),
+        ):
+            _, error = rp_handler.validate_input(job_input)
+            self.assertEqual(error, expected)
+
+    def test_only_the_changed_nodes_are_checked(self):
+        checked = []
+        check_workflow = rp_handler.check_workflow
+
+        def record(workflow, object_info, node_ids=None, input_files=()):
+            checked.append(node_ids)
+            return check_workflow(workflow, object_info, node_ids, input_files)
+
+        with patch.object(rp_handler, "check_workflow", record):
+            for seed in (1, 2):
+                result = rp_handler.handler(
+                    {
+                        "id": f"job-{seed}",
+                        "input": {
+                            "template": "sdxl",
+                            "overrides": {"3.inputs.seed": seed},
+                        },
+                    }
+                )
+                self.assertEqual(result["status"], "success", result)
+
+            result = rp_handler.handler(
+                {
+                    "id": "job-3",
+                    "input": {"template": "sdxl", "overrides": {"3.inputs.cfg": 200}},
+                }
+            )
+            # A link to another node makes the whole workflow be checked
+            rp_handler.handler(
+                {
+                    "id": "job-4",
+                    "input": {
+                        "template": "sdxl",
+                        "overrides": {"4.inputs.ckpt_name": ["8", 0]},
+                    },
+                }
+            )
+
+        self.assertEqual(checked, [None, ["3"], ["3"], ["3"], None])
+        self.assertEqual(
+            result["error"],
+            "Invalid workflow: node 3 (KSampler): Value 200.0 bigger than max of 100.0: cfg",
+        )
+        self.assertEqual(self.fake.count("/prompt"), 2)
+
+    def test_templates_are_checked_once_comfyui_is_ready(self):
+        # ComfyUI is still starting, the probe only reaches it after a while
+        rp_handler.comfy.host = "127.0.0.1:1"
+        thread = self.templates.validate_when_ready()
+        time.sleep(0.1)
+        self.assertFalse(self.templates.get("sdxl").valid)
+        rp_handler.comfy.host = self.fake.host
+
+        thread.join(timeout=5)
+
+        self.assertTrue(all(t.valid for t in self.templates.load().values()))
+        self.assertEqual(self.fake.count("/object_info"), 1)
+
+    def test_broken_templates_are_reported(self):
+        self.templates.get("sdxl").workflow["4"]["class_type"] = "MissingLoader"
+
+        result = rp_handler.handler({"id": "job", "input": {"template": "sdxl"}})
+
+        self.assertTrue(
+            result["error"].startswith(
+                "Template 'sdxl': Invalid workflow: node 4 (MissingLoader): "
+            ),
+            result,
+        )
+        self.assertFalse(self.templates.get("sdxl").valid)